@@ -0,0 +1,224 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# In-process stand-ins for the parts of the boto3 S3 and CloudWatch Logs
+# clients that the readers use. Each call waits for `latency` seconds, like
+# a request would.
+
+from __future__ import division, print_function
+
+from bisect import bisect_left, bisect_right
+from io import BytesIO
+from time import sleep
+
+S3_PAGE_SIZE = 1000
+LOGS_PAGE_SIZE = 10000
+# CloudWatch Logs pages are also limited to about this many bytes
+LOGS_PAGE_BYTES = 1024 * 1024
+
+
+class _FakePaginator(object):
+    def __init__(self, method, token_name, next_token_name, is_done):
+        self.method = method
+        self.token_name = token_name
+        self.next_token_name = next_token_name
+        self.is_done = is_done
+
+    def paginate(self, **kwargs):
+        kwargs = kwargs.copy()
+        while True:
+            response = self.method(**kwargs)
+            yield response
+            if self.is_done(response):
+                break
+            kwargs[self.token_name] = response[self.next_token_name]
+
+
+class _FakeBody(BytesIO):
+    # Like botocore's StreamingBody, which has read and close methods
+    pass
+
+
+class FakeS3Client(object):
+    """
+    Serves the files in `all_files`, a dictionary of keys and contents.
+    """
+    def __init__(self, all_files, latency=0):
+        self.all_files = all_files
+        self.all_keys = sorted(all_files)
+        self.latency = latency
+        self.call_count = 0
+
+    def _wait(self):
+        self.call_count += 1
+        if self.latency:
+            sleep(self.latency)
+
+    def list_objects_v2(
+        self,
+        Bucket,
+        Prefix='',
+        Delimiter=None,
+        StartAfter=None,
+        ContinuationToken=None,
+        MaxKeys=S3_PAGE_SIZE,
+    ):
+        # The continuation token is the position of the next key
+        self._wait()
+        if ContinuationToken is not None:
+            i = int(ContinuationToken)
+        else:
+            i = max(
+                bisect_left(self.all_keys, Prefix),
+                bisect_right(self.all_keys, StartAfter or ''),
+            )
+        contents = []
+        common_prefixes = []
+        while (i < len(self.all_keys)) and (
+            len(contents) + len(common_prefixes) < MaxKeys
+        ):
+            key = self.all_keys[i]
+            if not key.startswith(Prefix):
+                break
+
+            rest = key[len(Prefix):]
+            if Delimiter and (Delimiter in rest):
+                # Skip past everything else with this common prefix
+                common_prefix = '{}{}{}'.format(
+                    Prefix, rest.split(Delimiter, 1)[0], Delimiter
+                )
+                common_prefixes.append({'Prefix': common_prefix})
+                while (i < len(self.all_keys)) and (
+                    self.all_keys[i].startswith(common_prefix)
+                ):
+                    i += 1
+                continue
+
+            contents.append(
+                {
+                    'Key': key,
+                    'ETag': '"{:x}"'.format(hash(key) & 0xffffffff),
+                    'Size': len(self.all_files[key]),
+                }
+            )
+            i += 1
+
+        response = {
+            'Contents': contents,
+            'CommonPrefixes': common_prefixes,
+            'IsTruncated': (
+                (i < len(self.all_keys)) and
+                self.all_keys[i].startswith(Prefix)
+            ),
+        }
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = str(i)
+        return response
+
+    def get_object(self, Bucket, Key):
+        self._wait()
+        return {'Body': _FakeBody(self.all_files[Key])}
+
+    def get_paginator(self, operation_name):
+        return _FakePaginator(
+            getattr(self, operation_name),
+            'ContinuationToken',
+            'NextContinuationToken',
+            lambda response: not response['IsTruncated'],
+        )
+
+
+class FakeLogsClient(object):
+    """
+    Serves the events in `log_streams`, a dictionary of log stream names and
+    lists of events (sorted by timestamp). Filter patterns are ignored.
+    """
+    def __init__(self, log_streams, latency=0, page_size=LOGS_PAGE_SIZE):
+        self.log_streams = log_streams
+        self.latency = latency
+        self.page_size = page_size
+        self.call_count = 0
+        # The matching events for each query, so that each page doesn't need
+        # to find them again
+        self.query_events = {}
+
+    def _wait(self):
+        self.call_count += 1
+        if self.latency:
+            sleep(self.latency)
+
+    def describe_log_streams(self, logGroupName, nextToken=None):
+        self._wait()
+        all_streams = []
+        for stream_name, all_events in sorted(self.log_streams.items()):
+            if not all_events:
+                continue
+            all_streams.append(
+                {
+                    'logStreamName': stream_name,
+                    'firstEventTimestamp': all_events[0]['timestamp'],
+                    'lastEventTimestamp': all_events[-1]['timestamp'],
+                    'lastIngestionTime': all_events[-1]['ingestionTime'],
+                }
+            )
+
+        return {'logStreams': all_streams}
+
+    def filter_log_events(
+        self,
+        logGroupName,
+        logStreamNames=None,
+        startTime=0,
+        endTime=None,
+        nextToken=None,
+        **kwargs
+    ):
+        # The next token is the number of matching events already returned
+        self._wait()
+        stream_names = tuple(logStreamNames or sorted(self.log_streams))
+        query = (stream_names, startTime, endTime)
+        all_events = self.query_events.get(query)
+        if all_events is None:
+            all_events = [
+                dict(event, logStreamName=stream_name)
+                for stream_name in stream_names
+                for event in self.log_streams[stream_name]
+                if (startTime <= event['timestamp']) and (
+                    (endTime is None) or (event['timestamp'] < endTime)
+                )
+            ]
+            all_events.sort(key=lambda x: x['timestamp'])
+            self.query_events[query] = all_events
+
+        offset = nextToken or 0
+        events = []
+        page_bytes = 0
+        for event in all_events[offset:offset + self.page_size]:
+            events.append(event)
+            page_bytes += len(event['message'])
+            if page_bytes >= LOGS_PAGE_BYTES:
+                break
+
+        response = {'events': events}
+        if offset + len(events) < len(all_events):
+            response['nextToken'] = offset + len(events)
+        return response
+
+    def get_paginator(self, operation_name):
+        return _FakePaginator(
+            getattr(self, operation_name),
+            'nextToken',
+            'nextToken',
+            lambda response: 'nextToken' not in response,
+        )
@@ -0,0 +1,403 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measures the throughput and memory use of parsing, the readers, the CLI
+# actions, and aggregation on synthetic data. Run with:
+#   python -m benchmarks.run --records=100000 --latency=20
+
+from __future__ import division, print_function
+
+import json
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from datetime import timedelta
+from multiprocessing import Pipe, Process
+from shutil import rmtree
+from tempfile import mkdtemp
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from flowlogs_reader import (
+    aggregated_batches,
+    aggregated_records,
+    FlowLogsReader,
+    FlowRecord,
+    LazyFlowRecord,
+    LocalFlowLogsReader,
+    S3FlowLogsReader,
+)
+from flowlogs_reader.__main__ import actions
+from flowlogs_reader.columnar import iter_batches, np
+
+from .fakes import FakeLogsClient, FakeS3Client
+from .synthetic import SyntheticFlowLogs
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+# The registered benchmarks, in the order they're run. Each is a function
+# that takes a BenchmarkData and returns the number of records it handled.
+benchmarks = []
+
+# Arguments for the CLI actions
+ACTION_ARGS = {
+    'print': [],
+    'ipset': [],
+    'ipcount': [],
+    'findip': ['10.0.0.0/16'],
+    'aggregate': [],
+    'top': ['k=20'],
+}
+
+# Readers are given this many threads where they take them
+MAX_WORKERS = 8
+
+
+class BenchmarkData(object):
+    """
+    The synthetic records, laid out for each of the readers. `latency` is
+    the time in seconds that each fake client call takes.
+    """
+    def __init__(self, synthetic, latency=0):
+        self.synthetic = synthetic
+        self.latency = latency
+        self.s3_files = synthetic.get_s3_files()
+        self.log_streams = synthetic.get_log_streams()
+        self.local_dir = mkdtemp()
+        synthetic.write_local(self.local_dir)
+
+    def close(self):
+        rmtree(self.local_dir)
+
+    def get_reader_kwargs(self):
+        # The files' time stamps and the events' timestamps are at the ends
+        # of the records, so leave some room after the last one
+        return {
+            'start_time': self.synthetic.start_time,
+            'end_time': self.synthetic.end_time + timedelta(minutes=10),
+        }
+
+    def s3_reader(self, **kwargs):
+        kwargs.update(self.get_reader_kwargs())
+        return S3FlowLogsReader(
+            'example-bucket',
+            boto_client=FakeS3Client(self.s3_files, self.latency),
+            **kwargs
+        )
+
+    def cwl_reader(self, **kwargs):
+        kwargs.update(self.get_reader_kwargs())
+        return FlowLogsReader(
+            'example-group',
+            boto_client=FakeLogsClient(self.log_streams, self.latency),
+            **kwargs
+        )
+
+    def local_reader(self, **kwargs):
+        kwargs.update(self.get_reader_kwargs())
+        return LocalFlowLogsReader(self.local_dir, **kwargs)
+
+
+def benchmark(name, requires_numpy=False):
+    def decorator(func):
+        benchmarks.append((name, func, requires_numpy))
+        return func
+
+    return decorator
+
+
+def _count(iterable):
+    return sum(1 for x in iterable)
+
+
+@contextmanager
+def _no_output():
+    # The CLI actions print their results; they're thrown away here
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as f:
+        sys.stdout = f
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+@benchmark('baseline')
+def bench_baseline(data):
+    # The memory used by the input data and the modules
+    return 0
+
+
+@benchmark('parse')
+def bench_parse(data):
+    return _count(FlowRecord.from_message(x) for x in data.synthetic.messages)
+
+
+@benchmark('parse_lazy')
+def bench_parse_lazy(data):
+    # Only one attribute is accessed, which is when lazy parsing helps
+    return _count(
+        LazyFlowRecord({'message': x}).bytes for x in data.synthetic.messages
+    )
+
+
+@benchmark('iter_batches', requires_numpy=True)
+def bench_iter_batches(data):
+    return sum(
+        len(batch) + len(batch.unsupported)
+        for batch in iter_batches(data.synthetic.messages)
+    )
+
+
+@benchmark('s3_reader')
+def bench_s3_reader(data):
+    return _count(data.s3_reader())
+
+
+@benchmark('s3_reader_threads')
+def bench_s3_reader_threads(data):
+    return _count(data.s3_reader(max_workers=MAX_WORKERS))
+
+
+@benchmark('s3_reader_batches', requires_numpy=True)
+def bench_s3_reader_batches(data):
+    return sum(len(x) for x in data.s3_reader().iter_batches())
+
+
+@benchmark('local_reader')
+def bench_local_reader(data):
+    return _count(data.local_reader())
+
+
+@benchmark('local_reader_threads')
+def bench_local_reader_threads(data):
+    return _count(data.local_reader(max_workers=MAX_WORKERS))
+
+
+@benchmark('cwl_reader')
+def bench_cwl_reader(data):
+    return _count(data.cwl_reader())
+
+
+@benchmark('cwl_reader_threads')
+def bench_cwl_reader_threads(data):
+    return _count(data.cwl_reader(max_workers=MAX_WORKERS))
+
+
+@benchmark('cwl_reader_shards')
+def bench_cwl_reader_shards(data):
+    return _count(
+        data.cwl_reader(max_workers=MAX_WORKERS, time_shards=MAX_WORKERS)
+    )
+
+
+@benchmark('aggregated_records')
+def bench_aggregated_records(data):
+    all_records = (FlowRecord.from_message(x) for x in data.synthetic.messages)
+    _count(aggregated_records(all_records))
+    return len(data.synthetic.messages)
+
+
+@benchmark('aggregated_batches', requires_numpy=True)
+def bench_aggregated_batches(data):
+    _count(aggregated_batches(iter_batches(data.synthetic.messages)))
+    return len(data.synthetic.messages)
+
+
+def _bench_action(action):
+    def bench_action(data):
+        reader = data.s3_reader()
+        with _no_output():
+            actions[action](reader, *ACTION_ARGS[action])
+        return len(data.synthetic.messages)
+
+    return bench_action
+
+
+for _action in sorted(ACTION_ARGS):
+    benchmark('action_' + _action)(_bench_action(_action))
+
+
+def _get_peak_rss():
+    # Returns the most memory this process has used, in bytes
+    if resource is None:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB and macOS reports bytes
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+def run_benchmark(func, data):
+    """
+    Runs a benchmark function in this process and returns a dict with its
+    results.
+    """
+    start = _timer()
+    count = func(data)
+    elapsed = _timer() - start
+    size = data.synthetic.size if count else 0
+    return {
+        'records': count,
+        'seconds': elapsed,
+        'records_per_second': (count / elapsed) if elapsed else None,
+        'mb_per_second': (
+            (size / (1024 * 1024) / elapsed) if elapsed else None
+        ),
+        'peak_rss': _get_peak_rss(),
+    }
+
+
+def get_benchmark(name):
+    for benchmark_name, func, requires_numpy in benchmarks:
+        if benchmark_name == name:
+            return func
+
+    raise KeyError(name)
+
+
+def _run_child(name, data, connection):
+    # The benchmark is looked up by name, since the function itself may not
+    # be picklable
+    try:
+        connection.send(run_benchmark(get_benchmark(name), data))
+    except Exception as e:
+        connection.send({'error': repr(e)})
+    finally:
+        connection.close()
+
+
+def run_isolated(name, data):
+    """
+    Runs the benchmark called `name` in its own process, so that its peak
+    memory use can be measured, and returns a dict with its results.
+    """
+    parent_connection, child_connection = Pipe(duplex=False)
+    process = Process(
+        target=_run_child, args=(name, data, child_connection)
+    )
+    process.start()
+    child_connection.close()
+    try:
+        result = parent_connection.recv()
+    except EOFError:
+        result = {'error': 'exit code {}'.format(process.exitcode)}
+    process.join()
+    return result
+
+
+def _format(value, template):
+    return '-' if value is None else template.format(value)
+
+
+def print_results(all_results):
+    row_format = '{:<22}{:>10}{:>10}{:>14}{:>10}{:>12}'
+    print(
+        row_format.format(
+            'benchmark', 'records', 'seconds', 'records/s', 'MB/s', 'peak MB'
+        )
+    )
+    for name, result in all_results:
+        if 'error' in result:
+            print('{:<22}{}'.format(name, result['error']))
+            continue
+
+        peak_rss = result['peak_rss']
+        print(
+            row_format.format(
+                name,
+                result['records'],
+                _format(result['seconds'], '{:.3f}'),
+                _format(result['records_per_second'], '{:.0f}'),
+                _format(result['mb_per_second'], '{:.1f}'),
+                _format(
+                    None if peak_rss is None else peak_rss / (1024 * 1024),
+                    '{:.1f}',
+                ),
+            )
+        )
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Benchmark flowlogs_reader')
+    parser.add_argument(
+        '--records', type=int, default=100000,
+        help='number of synthetic records'
+    )
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='time each fake S3 or CloudWatch Logs call takes, in ms'
+    )
+    parser.add_argument('--accounts', type=int, default=1)
+    parser.add_argument('--interfaces', type=int, default=100)
+    parser.add_argument(
+        '--ips', type=int, default=10000, help='number of distinct addresses'
+    )
+    parser.add_argument('--nodata-ratio', type=float, default=0.01)
+    parser.add_argument('--skipdata-ratio', type=float, default=0.01)
+    parser.add_argument(
+        '--ms-ratio', type=float, default=0.0,
+        help='fraction of records with millisecond timestamps'
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--only', type=str, help='comma-separated benchmarks to run'
+    )
+    parser.add_argument(
+        '--json', type=str, help='also write the results to this file'
+    )
+    args = parser.parse_args(argv)
+
+    selected = None
+    if args.only:
+        selected = set(x.strip() for x in args.only.split(','))
+        unknown = selected.difference(x[0] for x in benchmarks)
+        if unknown:
+            parser.error('unknown benchmarks: {}'.format(', '.join(unknown)))
+
+    synthetic = SyntheticFlowLogs(
+        args.records,
+        accounts=args.accounts,
+        interfaces=args.interfaces,
+        ips=args.ips,
+        nodata_ratio=args.nodata_ratio,
+        skipdata_ratio=args.skipdata_ratio,
+        ms_ratio=args.ms_ratio,
+        seed=args.seed,
+    )
+    data = BenchmarkData(synthetic, latency=args.latency / 1000)
+    all_results = []
+    try:
+        for name, func, requires_numpy in benchmarks:
+            if (selected is not None) and (name not in selected):
+                continue
+            if requires_numpy and (np is None):
+                continue
+            all_results.append((name, run_isolated(name, data)))
+    finally:
+        data.close()
+
+    print_results(all_results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(all_results), f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
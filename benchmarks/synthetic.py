@@ -0,0 +1,202 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division, print_function
+
+import os
+from calendar import timegm
+from collections import defaultdict
+from datetime import datetime, timedelta
+from gzip import GzipFile
+from io import BytesIO
+from random import Random
+
+from flowlogs_reader import FlowRecord
+
+DEFAULT_START_TIME = datetime(2015, 8, 12, 12, 0, 0)
+DEFAULT_REGION = 'pangaea-1'
+HEADER = ' '.join(FlowRecord.__slots__)
+
+# S3 files cover 5 minutes of records each
+FILE_SECONDS = 300
+
+# Protocol numbers and typical destination ports
+_PROTOCOLS = (6, 6, 6, 17, 17, 1)
+_SERVER_PORTS = (22, 53, 80, 123, 443, 443, 443, 3306, 3389, 8080)
+
+
+class SyntheticFlowLogs(object):
+    """
+    Generates realistic-looking VPC Flow Log messages, and lays them out
+    like they'd be stored in S3 and in CloudWatch Logs.
+    * `count` is the number of messages.
+    * `duration` is the timedelta that the messages' end times span,
+    starting at `start_time`.
+    * `accounts` and `interfaces` are the numbers of distinct account IDs
+    and ENIs (split among the accounts).
+    * `ips` is the number of distinct addresses.
+    * `nodata_ratio` and `skipdata_ratio` are the fractions of records that
+    are NODATA and SKIPDATA.
+    * `ms_ratio` is the fraction of records with millisecond timestamps.
+    Messages are sorted by end time. The same `seed` gives the same messages.
+    """
+    def __init__(
+        self,
+        count,
+        start_time=DEFAULT_START_TIME,
+        duration=timedelta(hours=1),
+        accounts=1,
+        interfaces=100,
+        ips=10000,
+        nodata_ratio=0.01,
+        skipdata_ratio=0.01,
+        ms_ratio=0.0,
+        region=DEFAULT_REGION,
+        seed=0,
+    ):
+        self.start_time = start_time
+        self.end_time = start_time + duration
+        self.region = region
+        random = Random(seed)
+
+        start_seconds = timegm(start_time.utctimetuple())
+        duration_seconds = int(duration.total_seconds())
+        all_account_ids = [str(123456789010 + i) for i in range(accounts)]
+        all_interfaces = [
+            (all_account_ids[i % accounts], 'eni-{:08x}'.format(i))
+            for i in range(interfaces)
+        ]
+        all_ips = [
+            '10.{}.{}.{}'.format((i >> 16) & 255, (i >> 8) & 255, i & 255)
+            for i in range(ips)
+        ]
+
+        self.messages = []
+        self.interface_messages = defaultdict(list)
+        for end in sorted(
+            start_seconds + random.randrange(duration_seconds)
+            for i in range(count)
+        ):
+            account_id, interface_id = random.choice(all_interfaces)
+            start = end - random.randrange(60)
+            roll = random.random()
+            if roll < nodata_ratio + skipdata_ratio:
+                log_status = 'NODATA' if roll < nodata_ratio else 'SKIPDATA'
+                fields = (
+                    ['2', account_id, interface_id] + ['-'] * 7 +
+                    [str(start), str(end), '-', log_status]
+                )
+            else:
+                protocol = random.choice(_PROTOCOLS)
+                packets = random.randint(1, 1000)
+                fields = [
+                    '2',
+                    account_id,
+                    interface_id,
+                    random.choice(all_ips),
+                    random.choice(all_ips),
+                    str(random.randint(1024, 65535)),
+                    str(random.choice(_SERVER_PORTS)),
+                    str(protocol),
+                    str(packets),
+                    str(packets * random.randint(40, 1500)),
+                    str(start),
+                    str(end),
+                    'ACCEPT' if random.random() < 0.9 else 'REJECT',
+                    'OK',
+                ]
+            if random.random() < ms_ratio:
+                fields[10] += '000'
+                fields[11] += '000'
+
+            message = ' '.join(fields)
+            self.messages.append(message)
+            self.interface_messages[interface_id].append((end, message))
+
+    @property
+    def size(self):
+        # The number of bytes in the messages, as they'd be decompressed
+        return sum(len(x) + 1 for x in self.messages)
+
+    def get_s3_files(self):
+        """
+        Returns a dictionary of S3 keys and gzipped file contents. Each
+        account has one file per 5 minutes.
+        """
+        all_lines = defaultdict(list)
+        for message in self.messages:
+            fields = message.split(' ', 12)
+            account_id = fields[1]
+            end = int(fields[11])
+            end = end // 1000 if end > 2147483647 else end
+            all_lines[account_id, end - (end % FILE_SECONDS)].append(message)
+
+        ret = {}
+        for (account_id, stamp_seconds), lines in all_lines.items():
+            dt = datetime.utcfromtimestamp(stamp_seconds)
+            key = (
+                'AWSLogs/{account_id}/vpcflowlogs/{region}/{date}/'
+                '{account_id}_vpcflowlogs_{region}_fl-1234abcd_{stamp}_'
+                '{hash:08x}.log.gz'
+            ).format(
+                account_id=account_id,
+                region=self.region,
+                date=dt.strftime('%Y/%m/%d'),
+                stamp=dt.strftime('%Y%m%dT%H%MZ'),
+                hash=stamp_seconds,
+            )
+            ret[key] = _compress('\n'.join([HEADER] + lines) + '\n')
+
+        return ret
+
+    def write_local(self, base_dir):
+        """
+        Writes the S3 files to `base_dir`, in the layout LocalFlowLogsReader
+        reads.
+        """
+        for key, data in self.get_s3_files().items():
+            path = os.path.join(base_dir, *key.split('/'))
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+            with open(path, 'wb') as f:
+                f.write(data)
+
+    def get_log_streams(self):
+        """
+        Returns a dictionary of CloudWatch Logs stream names and events, with
+        one stream per ENI.
+        """
+        ret = {}
+        for interface_id, all_items in self.interface_messages.items():
+            ret['{}-all'.format(interface_id)] = [
+                {
+                    'timestamp': end * 1000,
+                    'ingestionTime': end * 1000,
+                    'message': message,
+                    'eventId': '{}-{}'.format(interface_id, i),
+                }
+                for i, (end, message) in enumerate(all_items)
+            ]
+
+        return ret
+
+
+def _compress(text):
+    with BytesIO() as f:
+        with GzipFile(fileobj=f, mode='wb') as gz_f:
+            gz_f.write(text.encode('utf-8'))
+        return f.getvalue()
@@ -12,9 +12,45 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from .aggregation import aggregated_records
-from .flowlogs_reader import FlowRecord, FlowLogsReader, S3FlowLogsReader
+from .aggregation import (
+    aggregated_batches,
+    aggregated_records,
+    heavy_hitters,
+    merged_aggregates,
+    windowed_aggregated_records,
+)
+from .clients import ClientFactory
+from .columnar import FlowBatch
+from .filters import FilterExpression, IPMatcher
+from .flowlogs_reader import (
+    FlowRecord,
+    FlowLogsReader,
+    LazyFlowRecord,
+    LocalFlowLogsReader,
+    S3FlowLogsReader,
+)
+from .sketches import HyperLogLog, IPCounter, SpaceSaving
+from .stats import ReaderStats
+from .throttling import RateLimiter
 
 __all__ = [
-    'aggregated_records', 'FlowRecord', 'FlowLogsReader', 'S3FlowLogsReader'
+    'aggregated_batches',
+    'aggregated_records',
+    'ClientFactory',
+    'FilterExpression',
+    'FlowBatch',
+    'FlowRecord',
+    'FlowLogsReader',
+    'heavy_hitters',
+    'HyperLogLog',
+    'IPCounter',
+    'IPMatcher',
+    'LazyFlowRecord',
+    'LocalFlowLogsReader',
+    'merged_aggregates',
+    'RateLimiter',
+    'ReaderStats',
+    'S3FlowLogsReader',
+    'SpaceSaving',
+    'windowed_aggregated_records',
 ]
@@ -16,16 +16,64 @@ from __future__ import print_function
 
 import sys
 from argparse import ArgumentParser
-from datetime import datetime
+from datetime import datetime, timedelta
 from itertools import chain
-from uuid import uuid4
+from multiprocessing import Pool
+
+from .aggregation import (
+    aggregated_batches,
+    aggregated_records,
+    HEAVY_HITTER_CAPACITY_FACTOR,
+    _heavy_hitter_summary,
+    _iter_heavy_hitters,
+    merged_aggregates,
+    windowed_aggregated_records,
+)
+from .clients import ClientFactory
+from .columnar import iter_batches
+from .export import DEFAULT_ROW_GROUP_SIZE, export_records
+from .filters import IPMatcher
+from .flowlogs_reader import (
+    BaseReader,
+    FlowLogsReader,
+    FlowRecord,
+    LocalFlowLogsReader,
+    S3FlowLogsReader,
+    SKIPDATA,
+    NODATA,
+)
+from .sketches import (
+    DEFAULT_PRECISION,
+    HyperLogLog,
+    IPCounter,
+    SpaceSaving,
+)
+from .stats import ReaderStats
+from .throttling import RateLimiter
 
-import boto3
+actions = {}
 
-from .aggregation import aggregated_records
-from .flowlogs_reader import FlowLogsReader, S3FlowLogsReader, SKIPDATA, NODATA
+# Makes the readers' boto3 clients
+_client_factory = ClientFactory()
+
+# Actions that can be split among processes. Each has a function that the
+# worker processes run on a sequence of messages to get a partial result,
+# and one that merges the partial results and prints the output.
+parallel_actions = {}
 
-actions = {}
+
+def _get_options(action, args, **defaults):
+    # Parse name=value arguments for an action, e.g. engine=numpy
+    options = defaults.copy()
+    for arg in args:
+        name, sep, value = arg.partition('=')
+        if (not sep) or (name not in defaults):
+            raise RuntimeError(
+                "unknown argument for action '{}': {}".format(action, arg)
+            )
+        options[name] = value
+
+    return options
 
 
 def action_print(reader, *args):
@@ -63,20 +111,191 @@ def action_ipset(reader, *args):
 actions['ipset'] = action_ipset
 
 
+def _ipset_partial(all_messages, *args):
+    ip_set = set()
+    for message in all_messages:
+        record = FlowRecord.from_message(message)
+        if record.log_status in (SKIPDATA, NODATA):
+            continue
+        ip_set.add(record.srcaddr)
+        ip_set.add(record.dstaddr)
+
+    return ip_set
+
+
+def _ipset_merge(all_partials, *args):
+    ip_set = set()
+    for partial in all_partials:
+        ip_set.update(partial)
+
+    for ip in ip_set:
+        print(ip)
+
+
+parallel_actions['ipset'] = (_ipset_partial, _ipset_merge)
+
+
 def action_findip(reader, *args):
-    """Find Flow Log records involving a specific IP or IPs."""
-    target_ips = set(args)
+    """Find Flow Log records involving specific IPs or CIDR blocks."""
+    matcher = IPMatcher(args)
     for record in reader:
-        if (record.srcaddr in target_ips) or (record.dstaddr in target_ips):
+        if matcher.match(record.srcaddr) or matcher.match(record.dstaddr):
             print(record.to_message())
 
 
 actions['findip'] = action_findip
 
 
+def _findip_partial(all_messages, *args):
+    matcher = IPMatcher(args)
+    return [
+        FlowRecord.from_message(x).to_message()
+        for x in all_messages if matcher.match_message(x)
+    ]
+
+
+def _findip_merge(all_partials, *args):
+    for partial in all_partials:
+        for message in partial:
+            print(message)
+
+
+parallel_actions['findip'] = (_findip_partial, _findip_merge)
+
+
+def _get_ipcount_options(args):
+    # Returns the counter class and the grouping field for ipcount
+    options = _get_options(
+        'ipcount', args, method='approximate', precision=None, group_by=None
+    )
+    if options['method'] == 'exact':
+        if options['precision'] is not None:
+            raise RuntimeError('precision may only be used with approximate')
+        counter_class = IPCounter
+    elif options['method'] == 'approximate':
+        precision = int(options['precision'] or DEFAULT_PRECISION)
+
+        def counter_class():
+            return HyperLogLog(precision)
+    else:
+        raise RuntimeError('unknown method: {}'.format(options['method']))
+
+    group_by = options['group_by']
+    if group_by not in (None, 'account_id', 'interface_id'):
+        raise RuntimeError('unknown group_by: {}'.format(group_by))
+
+    return counter_class, group_by
+
+
+def _ipcount_counters(all_records, *args):
+    # Returns a dictionary of counters, one per group
+    counter_class, group_by = _get_ipcount_options(args)
+    counters = {}
+    for record in all_records:
+        if record.log_status in (SKIPDATA, NODATA):
+            continue
+        key = None if (group_by is None) else getattr(record, group_by)
+        try:
+            counter = counters[key]
+        except KeyError:
+            counter = counters[key] = counter_class()
+        counter.add(record.srcaddr)
+        counter.add(record.dstaddr)
+
+    return counters
+
+
+def _print_ip_counts(counters, *args):
+    counter_class, group_by = _get_ipcount_options(args)
+    if group_by is None:
+        counter = counters.get(None) or counter_class()
+        print(counter.count())
+        return
+
+    for key in sorted(counters):
+        print(key, counters[key].count(), sep='\t')
+
+
+def action_ipcount(reader, *args):
+    """Count the distinct IPs seen in Flow Log records."""
+    _print_ip_counts(_ipcount_counters(reader, *args), *args)
+
+
+actions['ipcount'] = action_ipcount
+
+
+def _ipcount_partial(all_messages, *args):
+    return _ipcount_counters(
+        (FlowRecord.from_message(x) for x in all_messages), *args
+    )
+
+
+def _ipcount_merge(all_partials, *args):
+    counters = {}
+    for partial_counters in all_partials:
+        for key, counter in partial_counters.items():
+            if key in counters:
+                counters[key].merge(counter)
+            else:
+                counters[key] = counter
+
+    _print_ip_counts(counters, *args)
+
+
+parallel_actions['ipcount'] = (_ipcount_partial, _ipcount_merge)
+
+
 def action_aggregate(reader, *args):
     """Aggregate flow records by 5-tuple and print a tab-separated stream"""
-    all_aggregated = aggregated_records(reader)
+    options = _get_options(
+        'aggregate',
+        args,
+        engine='python',
+        max_flows=None,
+        window=None,
+        slide=None,
+        lateness=None,
+    )
+    kwargs = {}
+    if options['max_flows'] is not None:
+        kwargs['max_flows'] = int(options['max_flows'])
+
+    # Windows are given in seconds
+    for name in ('slide', 'lateness'):
+        if options[name] is not None:
+            kwargs[name] = timedelta(seconds=float(options[name]))
+
+    if options['window'] is not None:
+        if (options['engine'] != 'python') or ('max_flows' in kwargs):
+            raise RuntimeError(
+                'window may only be used with the python engine and without '
+                'max_flows'
+            )
+        window_size = timedelta(seconds=float(options['window']))
+        all_aggregated = windowed_aggregated_records(
+            reader, window_size, **kwargs
+        )
+    elif ('slide' in kwargs) or ('lateness' in kwargs):
+        raise RuntimeError('slide and lateness may only be used with window')
+    elif options['engine'] == 'python':
+        all_aggregated = aggregated_records(reader, **kwargs)
+    elif options['engine'] == 'numpy':
+        if isinstance(reader, BaseReader):
+            all_batches = reader.iter_batches()
+        else:
+            # Followed records are converted back to messages
+            all_batches = iter_batches(x.to_message() for x in reader)
+        all_aggregated = aggregated_batches(all_batches, **kwargs)
+    else:
+        raise RuntimeError('unknown engine: {}'.format(options['engine']))
+
+    _print_aggregated(all_aggregated)
+
+
+actions['aggregate'] = action_aggregate
+
+
+def _print_aggregated(all_aggregated):
     first_row = next(all_aggregated)
     keys = sorted(first_row.keys())
     print(*keys, sep='\t')
@@ -87,7 +306,124 @@ def action_aggregate(reader, *args):
         print(*[item[k] for k in keys], sep='\t')
 
 
-actions['aggregate'] = action_aggregate
+def _aggregate_partial(all_messages, *args):
+    options = _get_options('aggregate', args, engine='python')
+    if options['engine'] == 'python':
+        all_aggregated = aggregated_records(
+            FlowRecord.from_message(x) for x in all_messages
+        )
+    elif options['engine'] == 'numpy':
+        all_aggregated = aggregated_batches(iter_batches(all_messages))
+    else:
+        raise RuntimeError('unknown engine: {}'.format(options['engine']))
+
+    return list(all_aggregated)
+
+
+def _aggregate_merge(all_partials, *args):
+    # Only the engine may be chosen when using several processes
+    _get_options('aggregate', args, engine='python')
+    _print_aggregated(merged_aggregates(chain.from_iterable(all_partials)))
+
+
+parallel_actions['aggregate'] = (_aggregate_partial, _aggregate_merge)
+
+
+def _get_top_options(args):
+    # Returns the number of keys to print, the summary capacity, the key
+    # fields, and the value field for top
+    options = _get_options(
+        'top', args, k='10', by='srcaddr,dstaddr', value='bytes', capacity=None
+    )
+    k = int(options['k'])
+    capacity = int(options['capacity'] or (k * HEAVY_HITTER_CAPACITY_FACTOR))
+    key_fields = tuple(x.strip() for x in options['by'].split(','))
+    for field in key_fields:
+        if field not in FlowRecord.__slots__:
+            raise RuntimeError('unknown field: {}'.format(field))
+
+    value = options['value']
+    if value not in ('bytes', 'packets'):
+        raise RuntimeError('unknown value: {}'.format(value))
+
+    return k, capacity, key_fields, value
+
+
+def _print_top(summary, k, key_fields, value):
+    columns = key_fields + (value, 'error')
+    print(*columns, sep='\t')
+    for item in _iter_heavy_hitters(summary, k, key_fields, value):
+        print(*[item[x] for x in columns], sep='\t')
+
+
+def action_top(reader, *args):
+    """Print the keys (by default address pairs) with the most traffic"""
+    k, capacity, key_fields, value = _get_top_options(args)
+    summary = _heavy_hitter_summary(reader, capacity, key_fields, value)
+    _print_top(summary, k, key_fields, value)
+
+
+actions['top'] = action_top
+
+
+def _top_partial(all_messages, *args):
+    k, capacity, key_fields, value = _get_top_options(args)
+    return _heavy_hitter_summary(
+        (FlowRecord.from_message(x) for x in all_messages),
+        capacity,
+        key_fields,
+        value,
+    )
+
+
+def _top_merge(all_partials, *args):
+    k, capacity, key_fields, value = _get_top_options(args)
+    summary = SpaceSaving(capacity)
+    for partial_summary in all_partials:
+        summary.merge(partial_summary)
+
+    _print_top(summary, k, key_fields, value)
+
+
+parallel_actions['top'] = (_top_partial, _top_merge)
+
+
+def action_export(reader, *args):
+    """Write Flow Log records to partitioned Parquet or Arrow files"""
+    if not args:
+        raise RuntimeError("an output directory is required for 'export'")
+
+    options = _get_options(
+        'export',
+        args[1:],
+        format='parquet',
+        row_group_size=DEFAULT_ROW_GROUP_SIZE,
+        compression='snappy',
+    )
+    all_paths = export_records(
+        reader,
+        args[0],
+        file_format=options['format'],
+        row_group_size=int(options['row_group_size']),
+        compression=options['compression'],
+    )
+    for path in all_paths:
+        print(path)
+
+
+actions['export'] = action_export
+
+
+def _print_progress(stats):
+    print(
+        '{:.0f} s: {} records, {} skipped, {:.1f} MiB downloaded'.format(
+            stats.elapsed,
+            stats.records_parsed,
+            stats.records_skipped,
+            stats.bytes_downloaded / (1024 * 1024),
+        ),
+        file=sys.stderr
+    )
 
 
 def get_reader(args):
@@ -98,6 +434,8 @@ def get_reader(args):
         cls = FlowLogsReader
     elif args.location_type == 's3':
         cls = S3FlowLogsReader
+    elif args.location_type == 'local':
+        cls = LocalFlowLogsReader
 
     if args.region:
         kwargs['region_name'] = args.region
@@ -114,38 +452,132 @@ def get_reader(args):
     if args.location_type == 'cwl' and args.filter_pattern:
         kwargs['filter_pattern'] = args.filter_pattern
 
-    if args.location_type == 's3' and args.include_accounts:
+    if args.filter_expression:
+        kwargs['filter_expression'] = args.filter_expression
+
+    if args.location_type in ('s3', 'local') and args.include_accounts:
         kwargs['include_accounts'] = [
             x.strip() for x in args.include_accounts.split(',')
         ]
 
-    if args.location_type == 's3' and args.include_regions:
+    if args.location_type in ('s3', 'local') and args.include_regions:
         kwargs['include_regions'] = [
             x.strip() for x in args.include_regions.split(',')
         ]
 
-    # Switch roles for access to another account
+    if args.max_workers:
+        kwargs['max_workers'] = args.max_workers
+
+    if args.location_type == 's3' and args.cache_dir:
+        kwargs['cache_dir'] = args.cache_dir
+
+    if args.location_type == 's3' and args.cache_size:
+        kwargs['cache_size'] = args.cache_size * 1024 * 1024
+
+    if args.location_type == 's3' and args.prefix_cache_ttl:
+        kwargs['prefix_cache_ttl'] = args.prefix_cache_ttl
+
+    if args.location_type == 's3' and args.prefix_cache_file:
+        kwargs['prefix_cache_path'] = args.prefix_cache_file
+
+    if args.location_type == 'cwl' and args.time_shards:
+        kwargs['time_shards'] = args.time_shards
+
+    if args.stats or args.progress_interval:
+        kwargs['stats'] = ReaderStats()
+
+    if args.progress_interval:
+        kwargs['progress_callback'] = _print_progress
+        kwargs['progress_interval'] = args.progress_interval
+
+    # Requests are limited and retried if either of these is given
+    if args.request_rate or (args.max_retries is not None):
+        kwargs['rate_limiter'] = RateLimiter(rate=args.request_rate)
+
+    if args.max_retries is not None:
+        kwargs['max_retries'] = args.max_retries
+
+    # For findip, lines that don't have the addresses are skipped before
+    # they're parsed
+    if args.action[0] == 'findip' and args.action[1:]:
+        kwargs['message_filter'] = IPMatcher(args.action[1:]).match_message
+
+    # The readers in this process share their clients, whose connection
+    # pools are sized for the readers' threads
+    if args.location_type in ('cwl', 's3'):
+        kwargs['client_factory'] = _client_factory
+
+    # Switch roles for access to another account. The role's credentials
+    # are renewed as they expire.
     if args.role_arn:
-        assume_role_kwargs = {}
-        assume_role_kwargs['RoleArn'] = args.role_arn
-        assume_role_kwargs['RoleSessionName'] = str(uuid4())[:32]
+        kwargs['role_arn'] = args.role_arn
         if args.external_id:
-            assume_role_kwargs['ExternalId'] = args.external_id
-
-        sts_client = boto3.client('sts')
-        resp = sts_client.assume_role(**assume_role_kwargs)
-        session_kwargs = {
-            'aws_access_key_id': resp['Credentials']['AccessKeyId'],
-            'aws_secret_access_key': resp['Credentials']['SecretAccessKey'],
-            'aws_session_token': resp['Credentials']['SessionToken'],
-        }
-        session = boto3.session.Session(**session_kwargs)
-        logs_client = session.client('logs')
-        kwargs['boto_client'] = logs_client
+            kwargs['external_id'] = args.external_id
 
     return cls(args.location, **kwargs)
 
 
+# The worker processes' reader and action
+_worker_state = {}
+
+
+def _init_worker(args, action, action_args):
+    # Clients' connections can't be shared with the parent process
+    global _client_factory
+    _client_factory = ClientFactory()
+
+    _worker_state['reader'] = get_reader(args)
+    _worker_state['location_type'] = args.location_type
+    _worker_state['partial_func'] = parallel_actions[action][0]
+    _worker_state['action_args'] = action_args
+
+
+def _get_units(reader, args):
+    # Work is divided by file or by part of the CloudWatch Logs time range
+    if args.location_type != 'cwl':
+        return (
+            (item['Key'], item.get('ETag')) for item in reader._get_all_keys()
+        )
+
+    return reader._get_time_shards(args.time_shards or args.processes)
+
+
+def _read_unit(reader, location_type, unit):
+    if location_type != 'cwl':
+        all_events = ({'message': x} for x in reader._read_file(*unit))
+    else:
+        reader.start_ms, reader.end_ms = unit
+        all_events = reader._read_interleaved()
+
+    # Apply the reader's filters before the messages are parsed
+    return (event['message'] for event in reader._filter_events(all_events))
+
+
+def _run_worker(unit):
+    reader = _worker_state['reader']
+    partial_func = _worker_state['partial_func']
+    all_messages = _read_unit(reader, _worker_state['location_type'], unit)
+    return partial_func(all_messages, *_worker_state['action_args'])
+
+
+def run_parallel(args, action, action_args):
+    # The parent process lists the work to be done and merges the results;
+    # the worker processes read and parse the records.
+    merge_func = parallel_actions[action][1]
+    reader = get_reader(args)
+    pool = Pool(
+        args.processes,
+        initializer=_init_worker,
+        initargs=(args, action, action_args),
+    )
+    try:
+        all_partials = pool.imap(_run_worker, _get_units(reader, args))
+        merge_func(all_partials, *action_args)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 def main(argv=None):
     argv = argv or sys.argv[1:]
     parser = ArgumentParser(description='Read VPC Flow Log Records')
@@ -153,7 +585,7 @@ def main(argv=None):
     parser.add_argument(
         'location',
         type=str,
-        help='CloudWatch Logs group name or S3 bucket/prefix'
+        help='CloudWatch Logs group name, S3 bucket/prefix, or directory'
     )
     parser.add_argument('action', type=str, nargs='*', default=['print'],
                         help='action to take on log records')
@@ -161,8 +593,11 @@ def main(argv=None):
     parser.add_argument(
         '--location-type',
         type=str,
-        help='location type (CloudWatch Logs or S3), default is cwl',
-        choices=['cwl', 's3'],
+        help=(
+            'location type (CloudWatch Logs, S3, or a local copy of an S3 '
+            'location), default is cwl'
+        ),
+        choices=['cwl', 's3', 'local'],
         default='cwl'
     )
     parser.add_argument(
@@ -192,15 +627,100 @@ def main(argv=None):
         type=str,
         help='return records that match this pattern (CWL only)'
     )
+    parser.add_argument(
+        '--filter-expression',
+        type=str,
+        help=(
+            'return records that match this expression, e.g. '
+            '"action == REJECT and dstport in (22, 3389)"'
+        )
+    )
     parser.add_argument(
         '--include-accounts',
         type=str,
-        help='comma-separated list of accounts to consider (S3 only)'
+        help='comma-separated list of accounts to consider (S3 and local only)'
     )
     parser.add_argument(
         '--include-regions',
         type=str,
-        help='comma-separated list of regions to consider (S3 only)'
+        help='comma-separated list of regions to consider (S3 and local only)'
+    )
+    # Performance parameters
+    parser.add_argument(
+        '--max-workers',
+        type=int,
+        help='number of log streams or files to read concurrently'
+    )
+    parser.add_argument(
+        '--processes',
+        type=int,
+        help=(
+            'number of processes with which to read records (aggregate, '
+            'top, ipset, ipcount, and findip only)'
+        )
+    )
+    parser.add_argument(
+        '--time-shards',
+        type=int,
+        help='split the time range into this many parts (CWL only)'
+    )
+    parser.add_argument(
+        '--cache-dir',
+        type=str,
+        help='keep downloaded files in this directory (S3 only)'
+    )
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        help='maximum size of the --cache-dir directory, in MiB (S3 only)'
+    )
+    parser.add_argument(
+        '--prefix-cache-ttl',
+        type=float,
+        help=(
+            'remember the list of accounts and regions for this many '
+            'seconds (S3 only)'
+        )
+    )
+    parser.add_argument(
+        '--prefix-cache-file',
+        type=str,
+        help=(
+            'save the --prefix-cache-ttl list of accounts and regions in '
+            'this file, for later runs (S3 only)'
+        )
+    )
+    # Following parameters
+    parser.add_argument(
+        '--checkpoint-file',
+        type=str,
+        help=(
+            'resume from the position saved in this file, and save the new '
+            'position when finished'
+        )
+    )
+    parser.add_argument(
+        '--follow',
+        action='store_true',
+        help='keep checking for new records'
+    )
+    parser.add_argument(
+        '--poll-interval',
+        type=float,
+        help='with --follow, check for new records this often, in seconds'
+    )
+    # Instrumentation parameters
+    parser.add_argument(
+        '--stats',
+        action='store_true',
+        help=(
+            'print API calls, data sizes, and timings to stderr when finished'
+        )
+    )
+    parser.add_argument(
+        '--progress-interval',
+        type=float,
+        help='print progress to stderr this often, in seconds'
     )
     # AWS paramters
     parser.add_argument(
@@ -213,6 +733,19 @@ def main(argv=None):
                         help='assume role specified by this ARN')
     parser.add_argument('--external-id', type=str,
                         help='use this external ID for cross-account acesss')
+    parser.add_argument(
+        '--request-rate',
+        type=float,
+        help=(
+            'start with this many AWS requests per second, and adapt to '
+            'throttling'
+        )
+    )
+    parser.add_argument(
+        '--max-retries',
+        type=int,
+        help='retry throttled AWS requests up to this many times'
+    )
     args = parser.parse_args(argv)
 
     # Confirm the specified action is valid
@@ -229,9 +762,46 @@ def main(argv=None):
         print('must give a --role-arn if an --external-id is given')
         return
 
+    if args.processes:
+        if action not in parallel_actions:
+            print(
+                'action {} may not be used with --processes'.format(action),
+                file=sys.stderr
+            )
+            return
+        if args.follow or args.checkpoint_file:
+            print(
+                '--processes may not be used with --follow or '
+                '--checkpoint-file',
+                file=sys.stderr
+            )
+            return
+        if args.stats or args.progress_interval:
+            print(
+                '--processes may not be used with --stats or '
+                '--progress-interval',
+                file=sys.stderr
+            )
+            return
+
+        run_parallel(args, action, args.action[1:])
+        return
+
     reader = get_reader(args)
+    stats = reader.stats if args.stats else None
+    if args.follow or args.checkpoint_file:
+        follow_kwargs = {'checkpoint_path': args.checkpoint_file}
+        if args.poll_interval:
+            follow_kwargs['poll_interval'] = args.poll_interval
+        if not args.follow:
+            follow_kwargs['max_polls'] = 1
+        reader = reader.follow(**follow_kwargs)
+
     action_method(reader, *args.action[1:])
 
+    if stats is not None:
+        print(stats, file=sys.stderr)
+
 
 if __name__ == '__main__':
     main()
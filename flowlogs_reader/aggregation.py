@@ -12,12 +12,62 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from __future__ import print_function
+from __future__ import division, print_function
 
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta
+from heapq import heappop, heappush
+from math import floor
+from tempfile import TemporaryFile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from .columnar import ACTIONS, int_to_ip, LOG_STATUS_CODES, LOG_STATUSES, np
+from .flowlogs_reader import FlowRecord
+from .sketches import SpaceSaving
 
 KEY_FIELDS = ('srcaddr', 'dstaddr', 'srcport', 'dstport', 'protocol')
+HEAVY_HITTER_KEY_FIELDS = ('srcaddr', 'dstaddr')
+# By default heavy_hitters keeps this many keys for each one it returns
+HEAVY_HITTER_CAPACITY_FACTOR = 10
+EPOCH = datetime(1970, 1, 1)
+# Flows written to disk are split into this many files by key hash. Each one
+# is read back into memory by itself.
+SPILL_PARTITIONS = 64
+# aggregated_batches combines its partial aggregates once there are at least
+# this many rows of them
+BATCH_REGROUP_ROWS = 1 << 18
+# Files with too many flows to read back into memory are split again (by the
+# next bits of the keys' hashes), up to this many times
+MAX_SPILL_DEPTH = 4
+
+
+def _ms_to_datetime(timestamp):
+    # FlowBatch timestamps are in milliseconds. This gives the same result as
+    # FlowRecord's conversion.
+    return datetime.utcfromtimestamp(timestamp / 1000)
+
+
+# How to turn FlowBatch column values back into FlowRecord attribute values
+_BATCH_CONVERTERS = {
+    'version': int,
+    'account_id': str,
+    'interface_id': str,
+    'srcaddr': int_to_ip,
+    'dstaddr': int_to_ip,
+    'srcport': int,
+    'dstport': int,
+    'protocol': int,
+    'packets': int,
+    'bytes': int,
+    'start': _ms_to_datetime,
+    'end': _ms_to_datetime,
+    'action': ACTIONS.__getitem__,
+    'log_status': LOG_STATUSES.__getitem__,
+}
 
 
 class _FlowStats(object):
@@ -41,27 +91,487 @@ class _FlowStats(object):
         self.packets += flow_record.packets
         self.bytes += flow_record.bytes
 
+    def merge(self, start, end, packets, bytes):
+        if start < self.start:
+            self.start = start
+        if end > self.end:
+            self.end = end
+        self.packets += packets
+        self.bytes += bytes
+
     def to_dict(self):
         return {x: getattr(self, x) for x in self.__slots__}
 
 
-def aggregated_records(all_records, key_fields=KEY_FIELDS):
+class _SpilledFlows(object):
+    """
+    Stores flow table entries in temporary files, partitioned by the hash of
+    their keys. Entries for the same key always land in the same partition,
+    so each partition can be merged in memory separately. If `max_flows` is
+    given, partitions with more keys than that are split again as they're
+    read back.
+    """
+    def __init__(
+        self,
+        spill_dir=None,
+        partition_count=SPILL_PARTITIONS,
+        max_flows=None,
+        depth=0,
+    ):
+        self.spill_dir = spill_dir
+        self.max_flows = max_flows
+        self.depth = depth
+        self.all_files = [
+            TemporaryFile(dir=spill_dir) for __ in range(partition_count)
+        ]
+
+    def spill(self, flow_table):
+        # Write out and then clear the entries in flow_table
+        partitions = [[] for __ in self.all_files]
+        partition_count = len(partitions)
+        # Each level of partitions uses different bits of the hash
+        divisor = partition_count ** self.depth
+        for key, stats in flow_table.items():
+            partitions[(hash(key) // divisor) % partition_count].append(
+                (key, stats.start, stats.end, stats.packets, stats.bytes)
+            )
+        flow_table.clear()
+
+        for f, entries in zip(self.all_files, partitions):
+            if entries:
+                pickle.dump(entries, f, pickle.HIGHEST_PROTOCOL)
+
+    def _is_full(self, flow_table):
+        # A table with one key can't be split
+        return (
+            (self.max_flows is not None) and
+            (self.depth < MAX_SPILL_DEPTH) and
+            (len(flow_table) > max(self.max_flows, 1))
+        )
+
+    def _iter_partition_tables(self, f):
+        # Yield flow tables for the partition in f - just one, unless it
+        # has too many keys
+        flow_table = defaultdict(_FlowStats)
+        spilled = None
+        f.seek(0)
+        while True:
+            try:
+                entries = pickle.load(f)
+            except EOFError:
+                break
+            for key, start, end, packets, bytes_ in entries:
+                flow_table[key].merge(start, end, packets, bytes_)
+
+                if self._is_full(flow_table):
+                    spilled = spilled or _SpilledFlows(
+                        self.spill_dir,
+                        len(self.all_files),
+                        self.max_flows,
+                        self.depth + 1,
+                    )
+                    spilled.spill(flow_table)
+        f.close()
+
+        if spilled is None:
+            yield flow_table
+            return
+
+        spilled.spill(flow_table)
+        for flow_table in spilled.iter_tables():
+            yield flow_table
+
+    def iter_tables(self):
+        # Yield flow tables that together have each partition's entries
+        for f in self.all_files:
+            for flow_table in self._iter_partition_tables(f):
+                yield flow_table
+
+
+def _iter_aggregated(flow_table, spilled, key_fields):
+    # Yield the dicts for the entries in flow_table, merged with any entries
+    # that were written to disk.
+    if spilled is None:
+        all_tables = [flow_table]
+    else:
+        spilled.spill(flow_table)
+        all_tables = spilled.iter_tables()
+
+    for flow_table in all_tables:
+        for key in flow_table:
+            item = {k: v for k, v in zip(key_fields, key)}
+            item.update(flow_table[key].to_dict())
+            yield item
+
+
+def aggregated_records(
+    all_records, key_fields=KEY_FIELDS, max_flows=None, spill_dir=None
+):
     """
     Yield dicts that correspond to aggregates of the flow records given by
     the sequence of FlowRecords in `all_records`. Skips incomplete records.
     This will consume the `all_records` iterator, and requires enough memory to
-    be able to read it entirely.
+    be able to read it entirely, unless `max_flows` is given.
     `key_fields` optionally contains the fields over which to aggregate. By
     default it's the typical flow 5-tuple.
+    `max_flows` optionally limits the number of aggregates kept in memory.
+    When there are more, they're written to temporary files (in `spill_dir`,
+    if given) and merged at the end, a group of keys at a time. Groups with
+    more than `max_flows` keys are split up further, so no more than about
+    `max_flows` aggregates (plus one batch of spilled entries being read)
+    are held at once.
     """
     flow_table = defaultdict(_FlowStats)
+    spilled = None
     for flow_record in all_records:
         key = tuple(getattr(flow_record, attr) for attr in key_fields)
         if any(x is None for x in key):
             continue
         flow_table[key].update(flow_record)
 
-    for key in flow_table:
-        item = {k: v for k, v in zip(key_fields, key)}
-        item.update(flow_table[key].to_dict())
+        if (max_flows is not None) and (len(flow_table) > max_flows):
+            spilled = spilled or _SpilledFlows(
+                spill_dir, max_flows=max_flows
+            )
+            spilled.spill(flow_table)
+
+    for item in _iter_aggregated(flow_table, spilled, key_fields):
+        yield item
+
+
+def merged_aggregates(
+    all_items, key_fields=KEY_FIELDS, max_flows=None, spill_dir=None
+):
+    """
+    Yield dicts that combine the aggregates in `all_items`, which are dicts
+    like the ones `aggregated_records` yields (e.g. for different parts of
+    the same data) with the same `key_fields`. `max_flows` and `spill_dir`
+    are used as in `aggregated_records`.
+    """
+    flow_table = defaultdict(_FlowStats)
+    spilled = None
+    for item in all_items:
+        key = tuple(item[attr] for attr in key_fields)
+        flow_table[key].merge(
+            item['start'], item['end'], item['packets'], item['bytes']
+        )
+
+        if (max_flows is not None) and (len(flow_table) > max_flows):
+            spilled = spilled or _SpilledFlows(
+                spill_dir, max_flows=max_flows
+            )
+            spilled.spill(flow_table)
+
+    for item in _iter_aggregated(flow_table, spilled, key_fields):
+        yield item
+
+
+def _heavy_hitter_summary(
+    all_records, capacity, key_fields=HEAVY_HITTER_KEY_FIELDS, value='bytes'
+):
+    """
+    Returns a SpaceSaving summary of the totals of the `value` field of the
+    FlowRecords in `all_records`, by `key_fields`. Skips incomplete records.
+    Summaries with the same `capacity` for different parts of the records may
+    be combined with their `merge` method.
+    """
+    summary = SpaceSaving(capacity)
+    add = summary.add
+    for flow_record in all_records:
+        key = tuple(getattr(flow_record, attr) for attr in key_fields)
+        weight = getattr(flow_record, value)
+        if (weight is None) or any(x is None for x in key):
+            continue
+        add(key, weight)
+
+    return summary
+
+
+def _iter_heavy_hitters(
+    summary, k, key_fields=HEAVY_HITTER_KEY_FIELDS, value='bytes'
+):
+    """
+    Yield dicts for the `k` keys with the highest totals in `summary`, highest
+    first. Each has the `key_fields`, the `value` total, and an `error` item
+    with the most by which the total may be overstated.
+    """
+    for key, count, error in summary.top(k):
+        item = dict(zip(key_fields, key))
+        item[value] = count
+        item['error'] = error
+        yield item
+
+
+def heavy_hitters(
+    all_records,
+    k=10,
+    key_fields=HEAVY_HITTER_KEY_FIELDS,
+    value='bytes',
+    capacity=None,
+):
+    """
+    Yield dicts for the `k` combinations of `key_fields` (by default source
+    and destination address) with the highest totals of the `value` field
+    (e.g. 'bytes' or 'packets') in the sequence of FlowRecords in
+    `all_records`, highest first. Skips incomplete records.
+    Unlike sorting the output of `aggregated_records`, this uses the
+    Space-Saving algorithm, which keeps only `capacity` keys in memory (by
+    default 10 times `k`). The totals may be overstated by the amount in each
+    dict's `error` item, which is small for the keys with the highest totals.
+    """
+    capacity = capacity or (k * HEAVY_HITTER_CAPACITY_FACTOR)
+    summary = _heavy_hitter_summary(all_records, capacity, key_fields, value)
+    for item in _iter_heavy_hitters(summary, k, key_fields, value):
+        yield item
+
+
+def windowed_aggregated_records(
+    all_records,
+    window_size,
+    key_fields=KEY_FIELDS,
+    slide=None,
+    lateness=timedelta(0),
+):
+    """
+    Yield dicts that correspond to aggregates of the flow records given by
+    the sequence of FlowRecords in `all_records`, grouped into time windows by
+    each record's `end` time. Skips incomplete records.
+    Unlike `aggregated_records`, each window's aggregates are yielded as soon
+    as the window closes, and then forgotten, so this can be used on a
+    continuous stream of records.
+    * `window_size` is a datetime.timedelta with each window's length.
+    * `key_fields` optionally contains the fields over which to aggregate. By
+    default it's the typical flow 5-tuple.
+    * `slide` is a datetime.timedelta with the time between the starts of
+    consecutive windows. By default it's the same as `window_size`, i.e. the
+    windows don't overlap. If it's shorter each record is counted in each of
+    the windows that contain its `end` time.
+    * `lateness` is a datetime.timedelta. A window is closed when a record
+    that ends this long after the window does is seen. Records for windows
+    that have been closed are skipped.
+    The dicts have `window_start` and `window_end` items in addition to the
+    ones from `aggregated_records`.
+    """
+    size_s = window_size.total_seconds()
+    slide_s = (slide or window_size).total_seconds()
+    lateness_s = lateness.total_seconds()
+
+    # Windows are numbered by their start time divided by slide_s
+    all_windows = defaultdict(lambda: defaultdict(_FlowStats))
+    open_windows = []
+    closed_before = None
+
+    def emit(window):
+        window_start = EPOCH + timedelta(seconds=window * slide_s)
+        window_end = window_start + window_size
+        flow_table = all_windows.pop(window)
+        for key in flow_table:
+            item = {k: v for k, v in zip(key_fields, key)}
+            item.update(flow_table[key].to_dict())
+            item['window_start'] = window_start
+            item['window_end'] = window_end
+            yield item
+
+    for flow_record in all_records:
+        key = tuple(getattr(flow_record, attr) for attr in key_fields)
+        if any(x is None for x in key):
+            continue
+
+        # Find the windows that contain the end time
+        end_s = (flow_record.end - EPOCH).total_seconds()
+        last_window = int(floor(end_s / slide_s))
+        first_window = int(floor((end_s - size_s) / slide_s)) + 1
+        if closed_before is not None:
+            first_window = max(first_window, closed_before)
+
+        for window in range(first_window, last_window + 1):
+            if window not in all_windows:
+                heappush(open_windows, window)
+            all_windows[window][key].update(flow_record)
+
+        # Close the windows that end before the watermark
+        watermark_s = end_s - lateness_s
+        while open_windows and (
+            (open_windows[0] * slide_s + size_s) <= watermark_s
+        ):
+            window = heappop(open_windows)
+            closed_before = window + 1
+            for item in emit(window):
+                yield item
+
+    while open_windows:
+        for item in emit(heappop(open_windows)):
+            yield item
+
+
+def _group_columns(all_columns, key_count):
+    """
+    Groups the rows of the arrays in `all_columns` - `key_count` key columns
+    followed by start, end, packets, and bytes columns - by their keys.
+    Returns the same columns, with one row for each distinct key: the
+    earliest start, the latest end, and the totals.
+    """
+    key_columns = all_columns[:key_count]
+    start, end, packets, bytes_ = all_columns[key_count:]
+    if not len(start):
+        return all_columns
+
+    # Rows with the same key are next to each other after sorting
+    order = np.lexsort(key_columns[::-1])
+    key_columns = [x[order] for x in key_columns]
+    is_first = np.zeros(len(order), dtype=bool)
+    is_first[0] = True
+    for column in key_columns:
+        is_first[1:] |= column[1:] != column[:-1]
+    group_starts = np.flatnonzero(is_first)
+
+    return [x[group_starts] for x in key_columns] + [
+        np.minimum.reduceat(start[order], group_starts),
+        np.maximum.reduceat(end[order], group_starts),
+        np.add.reduceat(packets[order], group_starts),
+        np.add.reduceat(bytes_[order], group_starts),
+    ]
+
+
+def _convert_column(values, convert):
+    # Returns a list with the converted values, converting each distinct one
+    # only once
+    distinct, inverse = np.unique(values, return_inverse=True)
+    converted = [convert(x) for x in distinct.tolist()]
+    return list(map(converted.__getitem__, inverse.reshape(-1).tolist()))
+
+
+def _iter_grouped(all_columns, key_fields):
+    # Yield (key, start, end, packets, bytes) tuples with Python values for
+    # the rows of the grouped columns
+    key_count = len(key_fields)
+    all_lists = [
+        _convert_column(column, _BATCH_CONVERTERS[field])
+        for column, field in zip(all_columns[:key_count], key_fields)
+    ]
+    all_lists.append(_convert_column(all_columns[key_count], _ms_to_datetime))
+    all_lists.append(
+        _convert_column(all_columns[key_count + 1], _ms_to_datetime)
+    )
+    all_lists.append(all_columns[key_count + 2].tolist())
+    all_lists.append(all_columns[key_count + 3].tolist())
+
+    for row in zip(*all_lists):
+        yield (row[:key_count],) + row[key_count:]
+
+
+class _BatchAggregator(object):
+    """
+    Aggregates FlowBatch rows into arrays: each batch's aggregates are kept
+    as they are until there are enough of them to be worth combining, and
+    then they're grouped again.
+    """
+    def __init__(self, key_fields):
+        self.key_fields = key_fields
+        self.all_parts = []
+        self.pending_rows = 0
+        self.grouped_rows = 0
+
+    @property
+    def row_count(self):
+        # At least as many as the number of distinct keys
+        return self.grouped_rows + self.pending_rows
+
+    def add(self, batch):
+        # Like aggregated_records, skip NODATA and SKIPDATA records
+        is_ok = batch['log_status'] == LOG_STATUS_CODES['OK']
+        if not is_ok.any():
+            return
+
+        all_columns = [
+            batch[field][is_ok]
+            for field in self.key_fields + ('start', 'end', 'packets', 'bytes')
+        ]
+        part = _group_columns(all_columns, len(self.key_fields))
+        self.all_parts.append(part)
+        self.pending_rows += len(part[0])
+
+        # Combining whenever the pending rows outnumber the combined ones
+        # keeps the total work proportional to the number of rows
+        if self.pending_rows >= max(BATCH_REGROUP_ROWS, self.grouped_rows):
+            self.regroup()
+
+    def regroup(self):
+        # Combine all the aggregates, and return the number of distinct keys
+        if len(self.all_parts) > 1:
+            all_columns = [np.concatenate(x) for x in zip(*self.all_parts)]
+            self.all_parts = [
+                _group_columns(all_columns, len(self.key_fields))
+            ]
+        self.pending_rows = 0
+        self.grouped_rows = len(self.all_parts[0][0]) if self.all_parts else 0
+        return self.grouped_rows
+
+    def pop_all(self):
+        # Yield (key, start, end, packets, bytes) tuples for the aggregates,
+        # and then forget them
+        self.regroup()
+        all_parts = self.all_parts
+        self.all_parts = []
+        self.grouped_rows = 0
+        for all_columns in all_parts:
+            for row in _iter_grouped(all_columns, self.key_fields):
+                yield row
+
+
+def aggregated_batches(
+    all_batches, key_fields=KEY_FIELDS, max_flows=None, spill_dir=None
+):
+    """
+    Like `aggregated_records`, but aggregates the FlowBatch objects in
+    `all_batches` (e.g. from a reader's `iter_batches` method) with NumPy.
+    Aggregates are kept in arrays, grouped by sorting, and only turned into
+    Python objects for the dicts that are yielded, which makes this much
+    faster. The dicts it yields are the same as aggregated_records's.
+    """
+    key_fields = tuple(key_fields)
+    aggregator = _BatchAggregator(key_fields)
+    # Messages that don't fit into columns are handled one at a time
+    flow_table = defaultdict(_FlowStats)
+    spilled = None
+    for batch in all_batches:
+        aggregator.add(batch)
+        for message in batch.unsupported:
+            flow_record = FlowRecord.from_message(message)
+            key = tuple(getattr(flow_record, attr) for attr in key_fields)
+            if any(x is None for x in key):
+                continue
+            flow_table[key].update(flow_record)
+
+        # Only combine the aggregates early if they might be too many
+        if (
+            (max_flows is not None) and
+            (aggregator.row_count + len(flow_table) > max_flows) and
+            (aggregator.regroup() + len(flow_table) > max_flows)
+        ):
+            spilled = spilled or _SpilledFlows(
+                spill_dir, max_flows=max_flows
+            )
+            for key, start, end, packets, bytes_ in aggregator.pop_all():
+                flow_table[key].merge(start, end, packets, bytes_)
+            spilled.spill(flow_table)
+
+    if spilled is not None:
+        for key, start, end, packets, bytes_ in aggregator.pop_all():
+            flow_table[key].merge(start, end, packets, bytes_)
+        for item in _iter_aggregated(flow_table, spilled, key_fields):
+            yield item
+        return
+
+    for key, start, end, packets, bytes_ in aggregator.pop_all():
+        item = dict(zip(key_fields, key))
+        stats = flow_table.pop(key, None)
+        if stats is not None:
+            stats.merge(start, end, packets, bytes_)
+            item.update(stats.to_dict())
+        else:
+            item.update(start=start, end=end, packets=packets, bytes=bytes_)
+        yield item
+
+    for item in _iter_aggregated(flow_table, None, key_fields):
         yield item
@@ -0,0 +1,460 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# asyncio versions of the readers. This module requires Python 3.6+ and
+# aiobotocore, so it's not imported by the package.
+
+import asyncio
+from calendar import timegm
+from collections import deque
+from datetime import datetime, timedelta
+
+try:
+    from aiobotocore.session import get_session
+except ImportError:
+    get_session = None
+
+from .flowlogs_reader import (
+    DEFAULT_FILTER_PATTERN,
+    DEFAULT_REGION_NAME,
+    FlowRecord,
+    LazyFlowRecord,
+    READ_CHUNK_SIZE,
+    _filter_key_page,
+    _get_date_prefixes,
+    _get_key_stamp,
+    _GzipLineDecoder,
+    _is_stream_in_range,
+)
+from .throttling import (
+    DEFAULT_MAX_RETRIES,
+    THROTTLED_OPERATIONS,
+    _get_backoff,
+    _is_throttling_error,
+)
+
+
+class AsyncThrottledClient(object):
+    """
+    Like ThrottledClient, but for aiobotocore clients. Requests are made
+    through `rate_limiter` (which may be shared with the other readers),
+    waiting for it in the event loop's default executor so that the loop
+    isn't blocked. Throttled requests are retried up to `max_retries` times.
+    """
+    def __init__(self, client, rate_limiter, max_retries=DEFAULT_MAX_RETRIES):
+        self.client = client
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+
+    async def _call(self, func, kwargs):
+        loop = asyncio.get_event_loop()
+        attempt = 0
+        while True:
+            start = await loop.run_in_executor(
+                None, self.rate_limiter.acquire
+            )
+            throttled = False
+            succeeded = False
+            try:
+                response = await func(**kwargs)
+                succeeded = True
+                return response
+            except Exception as e:
+                throttled = _is_throttling_error(e)
+                if (not throttled) or (attempt >= self.max_retries):
+                    raise
+            finally:
+                self.rate_limiter.release(
+                    start, throttled=throttled, succeeded=succeeded
+                )
+
+            await asyncio.sleep(_get_backoff(attempt))
+            attempt += 1
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name not in THROTTLED_OPERATIONS:
+            return attr
+
+        def call(**kwargs):
+            return self._call(attr, kwargs)
+
+        return call
+
+
+class AsyncBaseReader(object):
+    def __init__(
+        self,
+        client_type,
+        region_name=None,
+        profile_name=None,
+        start_time=None,
+        end_time=None,
+        boto_client_kwargs=None,
+        boto_client=None,
+        lazy=False,
+        max_concurrency=None,
+        rate_limiter=None,
+        max_retries=DEFAULT_MAX_RETRIES,
+    ):
+        # The aiobotocore client is created when the reader is entered with
+        # `async with`, unless one is given here
+        self.client_type = client_type
+        self.region_name = region_name
+        self.profile_name = profile_name
+        self.boto_client_kwargs = boto_client_kwargs or {}
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.boto_client = (
+            None if boto_client is None else self._throttled(boto_client)
+        )
+        self.client_context = None
+
+        # If no time filters are given use the last hour
+        now = datetime.utcnow()
+        self.start_time = start_time or now - timedelta(hours=1)
+        self.end_time = end_time or now
+
+        # Parse records up front, or when their attributes are accessed
+        self.record_class = LazyFlowRecord if lazy else FlowRecord
+
+        self.max_concurrency = max_concurrency
+
+    async def __aenter__(self):
+        if self.boto_client is not None:
+            return self
+
+        if get_session is None:
+            raise RuntimeError('aiobotocore is required for this reader')
+
+        session = get_session()
+        if self.profile_name is not None:
+            session.set_config_variable('profile', self.profile_name)
+
+        region_name = (
+            self.region_name or
+            session.get_config_variable('region') or
+            DEFAULT_REGION_NAME
+        )
+        self.client_context = session.create_client(
+            self.client_type,
+            region_name=region_name,
+            **self.boto_client_kwargs
+        )
+        self.boto_client = self._throttled(
+            await self.client_context.__aenter__()
+        )
+        return self
+
+    def _throttled(self, client):
+        if self.rate_limiter is None:
+            return client
+
+        return AsyncThrottledClient(
+            client, self.rate_limiter, self.max_retries
+        )
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self.client_context is None:
+            return
+
+        await self.client_context.__aexit__(exc_type, exc_value, traceback)
+        self.client_context = None
+        self.boto_client = None
+
+    def __aiter__(self):
+        return self._reader()
+
+    async def _reader(self):
+        # Loops through each log stream and its events, yielding a parsed
+        # version of each event.
+        record_class = self.record_class
+        async for event in self._read_streams():
+            yield record_class(event)
+
+
+class AsyncFlowLogsReader(AsyncBaseReader):
+    """
+    Like FlowLogsReader, but for use with `async for`. An aiobotocore client
+    is created when the reader is used with `async with`, unless
+    `boto_client` is given.
+    * `max_concurrency` - if given, the group's log streams are read
+    separately, with this many of them being read at once. Their events are
+    yielded as they arrive.
+    * `rate_limiter` - a RateLimiter (which may be shared with other readers)
+    through which to make requests. Throttled requests are retried up to
+    `max_retries` times.
+    """
+
+    def __init__(
+        self,
+        log_group_name,
+        filter_pattern=DEFAULT_FILTER_PATTERN,
+        **kwargs
+    ):
+        super(AsyncFlowLogsReader, self).__init__('logs', **kwargs)
+        self.log_group_name = log_group_name
+
+        self.paginator_kwargs = {}
+        if filter_pattern is not None:
+            self.paginator_kwargs['filterPattern'] = filter_pattern
+
+        self.start_ms = timegm(self.start_time.utctimetuple()) * 1000
+        self.end_ms = timegm(self.end_time.utctimetuple()) * 1000
+
+    async def _get_log_stream_names(self):
+        # Return the names of the log streams that have events in our
+        # time range
+        ret = []
+        kwargs = {'logGroupName': self.log_group_name}
+        while True:
+            response = await self.boto_client.describe_log_streams(**kwargs)
+            for stream in response['logStreams']:
+                if _is_stream_in_range(stream, self.start_ms, self.end_ms):
+                    ret.append(stream['logStreamName'])
+
+            next_token = response.get('nextToken')
+            if next_token is None:
+                break
+            kwargs['nextToken'] = next_token
+
+        return ret
+
+    async def _iter_pages(self, kwargs):
+        # Yield the events from each page of a filter_log_events query. The
+        # query is finished when there's no next token, or when the same one
+        # is given twice.
+        kwargs = kwargs.copy()
+        while True:
+            response = await self.boto_client.filter_log_events(**kwargs)
+            yield response.get('events', [])
+
+            next_token = response.get('nextToken')
+            if (next_token is None) or (next_token == kwargs.get('nextToken')):
+                break
+            kwargs['nextToken'] = next_token
+
+    async def _fill_queue(self, kwargs, semaphore, queue):
+        # Put each page of events from a query in the queue, followed by None
+        # when the query is done (or the exception that stopped it).
+        try:
+            async with semaphore:
+                async for events in self._iter_pages(kwargs):
+                    await queue.put(events)
+        except Exception as e:
+            await queue.put(e)
+            return
+
+        await queue.put(None)
+
+    async def _read_log_streams(self):
+        # Each log stream gets its own filter_log_events query. The queue is
+        # bounded so that the queries wait for the events to be consumed.
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        queue = asyncio.Queue(maxsize=self.max_concurrency)
+        all_tasks = [
+            asyncio.ensure_future(
+                self._fill_queue(
+                    dict(
+                        logGroupName=self.log_group_name,
+                        logStreamNames=[stream_name],
+                        startTime=self.start_ms,
+                        endTime=self.end_ms,
+                        **self.paginator_kwargs
+                    ),
+                    semaphore,
+                    queue,
+                )
+            )
+            for stream_name in await self._get_log_stream_names()
+        ]
+
+        remaining = len(all_tasks)
+        try:
+            while remaining:
+                events = await queue.get()
+                if events is None:
+                    remaining -= 1
+                    continue
+                if isinstance(events, Exception):
+                    raise events
+
+                for event in events:
+                    yield event
+        finally:
+            for task in all_tasks:
+                task.cancel()
+
+    async def _read_interleaved(self):
+        kwargs = dict(
+            logGroupName=self.log_group_name,
+            startTime=self.start_ms,
+            endTime=self.end_ms,
+            interleaved=True,
+            **self.paginator_kwargs
+        )
+        async for events in self._iter_pages(kwargs):
+            for event in events:
+                yield event
+
+    def _read_streams(self):
+        if self.max_concurrency:
+            return self._read_log_streams()
+
+        return self._read_interleaved()
+
+
+class AsyncS3FlowLogsReader(AsyncBaseReader):
+    """
+    Like S3FlowLogsReader, but for use with `async for`. An aiobotocore
+    client is created when the reader is used with `async with`, unless
+    `boto_client` is given.
+    * `max_concurrency` - the number of files to download and decompress at
+    once. Records are still yielded in key order. By default files are read
+    one at a time.
+    * `rate_limiter` - a RateLimiter (which may be shared with other readers)
+    through which to make requests. Throttled requests are retried up to
+    `max_retries` times.
+    """
+
+    def __init__(
+        self,
+        location,
+        include_accounts=None,
+        include_regions=None,
+        **kwargs
+    ):
+        super(AsyncS3FlowLogsReader, self).__init__('s3', **kwargs)
+
+        location_parts = (location.rstrip('/') + '/').split('/', 1)
+        self.bucket, self.prefix = location_parts
+
+        self.include_accounts = (
+            None if include_accounts is None else set(include_accounts)
+        )
+        self.include_regions = (
+            None if include_regions is None else set(include_regions)
+        )
+
+    async def _list_prefixes(self, prefix):
+        # Return the "directories" directly below prefix
+        ret = []
+        kwargs = {'Bucket': self.bucket, 'Delimiter': '/', 'Prefix': prefix}
+        while True:
+            response = await self.boto_client.list_objects_v2(**kwargs)
+            for item in response.get('CommonPrefixes', []):
+                ret.append(item['Prefix'])
+
+            if not response.get('IsTruncated'):
+                break
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+        return ret
+
+    async def _get_day_prefixes(self):
+        # Return each of the account/region/year/month/day/ prefixes
+        ret = []
+        prefix = (self.prefix.strip('/') + '/AWSLogs/').lstrip('/')
+        for account_prefix in await self._list_prefixes(prefix):
+            account_id = account_prefix.rsplit('/', 2)[1]
+            if self.include_accounts is not None:
+                if account_id not in self.include_accounts:
+                    continue
+
+            region_prefixes = await self._list_prefixes(
+                account_prefix + 'vpcflowlogs/'
+            )
+            for region_prefix in region_prefixes:
+                region_name = region_prefix.rsplit('/', 2)[1]
+                if self.include_regions is not None:
+                    if region_name not in self.include_regions:
+                        continue
+
+                for day_prefix in _get_date_prefixes(
+                    self.start_time, self.end_time
+                ):
+                    ret.append(region_prefix + day_prefix)
+
+        return ret
+
+    async def _get_keys(self, prefix):
+        # Yield the listing entries for files relevant to our time range
+        start_stamp = _get_key_stamp(self.start_time)
+        end_stamp = _get_key_stamp(self.end_time)
+        kwargs = {'Bucket': self.bucket, 'Prefix': prefix}
+        while True:
+            response = await self.boto_client.list_objects_v2(**kwargs)
+            all_items, start_after = _filter_key_page(
+                response.get('Contents', []), start_stamp, end_stamp
+            )
+            for item in all_items:
+                yield item
+
+            if not response.get('IsTruncated'):
+                break
+
+            kwargs = {'Bucket': self.bucket, 'Prefix': prefix}
+            if start_after is None:
+                kwargs['ContinuationToken'] = response['NextContinuationToken']
+            else:
+                kwargs['StartAfter'] = start_after
+
+    async def _get_all_keys(self):
+        for prefix in await self._get_day_prefixes():
+            async for item in self._get_keys(prefix):
+                yield item
+
+    async def _read_file(self, key):
+        # Download and decompress a file, returning its lines (without the
+        # header).
+        response = await self.boto_client.get_object(
+            Bucket=self.bucket, Key=key
+        )
+        body = response['Body']
+        decoder = _GzipLineDecoder()
+        all_lines = []
+        try:
+            while True:
+                data = await body.read(READ_CHUNK_SIZE)
+                if not data:
+                    break
+                all_lines.extend(decoder.feed(data))
+        finally:
+            body.close()
+        all_lines.extend(decoder.flush())
+
+        return [line.decode('utf-8') for line in all_lines[1:]]
+
+    async def _read_streams(self):
+        # Several files are downloaded at once, but only a limited number
+        # of them are kept in memory.
+        max_concurrency = self.max_concurrency or 1
+        pending = deque()
+        try:
+            async for item in self._get_all_keys():
+                pending.append(
+                    asyncio.ensure_future(self._read_file(item['Key']))
+                )
+                if len(pending) < max_concurrency:
+                    continue
+
+                for message in await pending.popleft():
+                    yield {'message': message}
+
+            while pending:
+                for message in await pending.popleft():
+                    yield {'message': message}
+        finally:
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,244 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division, print_function
+
+import json
+import os
+from errno import EEXIST, ENOENT
+from hashlib import sha256
+from tempfile import mkstemp
+from threading import Lock
+from time import time
+
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+CACHE_SUFFIX = '.cache'
+TEMP_PREFIX = '.tmp-'
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != EEXIST:
+            raise
+
+
+class FileCache(object):
+    """
+    Stores files in the local directory `cache_dir`, using up to `max_size`
+    bytes. Entries are identified by a sequence of strings, e.g. an S3
+    bucket, key, and ETag. When the cache is full the least recently used
+    files are removed. Instances may be shared between threads.
+    """
+    def __init__(self, cache_dir, max_size=DEFAULT_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.lock = Lock()
+
+        _makedirs(cache_dir)
+        self.total_size = sum(x[2] for x in self._get_entries())
+
+    def _get_path(self, parts):
+        digest = sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest + CACHE_SUFFIX)
+
+    def _get_entries(self):
+        # Returns (last use time, path, size) for each cached file
+        ret = []
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith(CACHE_SUFFIX):
+                continue
+            path = os.path.join(self.cache_dir, file_name)
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                continue
+            ret.append((stat_result.st_mtime, path, stat_result.st_size))
+
+        return ret
+
+    def open(self, *parts):
+        """
+        Returns an open binary file object for the entry identified by
+        `parts`, or None if it's not in the cache.
+        """
+        path = self._get_path(parts)
+        try:
+            f = open(path, 'rb')
+        except IOError as e:
+            if e.errno == ENOENT:
+                return None
+            raise
+
+        # Mark the file as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return f
+
+    def writer(self, *parts):
+        """
+        Returns a CacheWriter that will store data for the entry identified
+        by `parts`.
+        """
+        return CacheWriter(self, self._get_path(parts))
+
+    def _add(self, temp_path, path):
+        size = os.path.getsize(temp_path)
+        if size > self.max_size:
+            os.remove(temp_path)
+            return
+
+        with self.lock:
+            if os.path.exists(path):
+                self.total_size -= os.path.getsize(path)
+            os.rename(temp_path, path)
+            self.total_size += size
+
+            if self.total_size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # Remove the least recently used files until there's enough room
+        for __, path, size in sorted(self._get_entries()):
+            if self.total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.total_size -= size
+
+
+class CacheWriter(object):
+    """
+    Collects data for a FileCache entry in a temporary file. The entry is
+    only added to the cache when `commit` is called.
+    """
+    def __init__(self, cache, path):
+        self.cache = cache
+        self.path = path
+        fd, self.temp_path = mkstemp(prefix=TEMP_PREFIX, dir=cache.cache_dir)
+        self.f = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.f.write(data)
+
+    def commit(self):
+        if self.f is None:
+            return
+        self.f.close()
+        self.f = None
+        self.cache._add(self.temp_path, self.path)
+
+    def abort(self):
+        if self.f is None:
+            return
+        self.f.close()
+        self.f = None
+        os.remove(self.temp_path)
+
+    def tee(self, stream):
+        """
+        Returns a file-like object that reads from `stream` and writes what
+        it reads to this entry.
+        """
+        return _TeeStream(stream, self)
+
+
+class _TeeStream(object):
+    __slots__ = ['stream', 'writer']
+
+    def __init__(self, stream, writer):
+        self.stream = stream
+        self.writer = writer
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self.writer.write(data)
+        return data
+
+
+class PrefixCache(object):
+    """
+    Remembers the lists of "directories" below S3 prefixes for `ttl`
+    seconds. Lists are kept in memory, and also saved to the JSON file at
+    `path` (if it's given) so that later runs can use them. Instances may be
+    shared between threads.
+    """
+    def __init__(self, ttl, path=None):
+        self.ttl = ttl
+        self.path = path
+        self.lock = Lock()
+        self.entries = self._load()
+
+    def _load(self):
+        if self.path is None:
+            return {}
+
+        try:
+            with open(self.path, 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+        except IOError as e:
+            if e.errno == ENOENT:
+                return {}
+            raise
+        except ValueError:
+            return {}
+
+        return {tuple(x['key']): x for x in data}
+
+    def _save(self):
+        # Write to a temporary file first so that an interrupted save doesn't
+        # clobber the previous one. Expired entries are left out.
+        now = time()
+        data = [
+            x for x in self.entries.values() if (now - x['time']) < self.ttl
+        ]
+        cache_dir = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = mkstemp(prefix=TEMP_PREFIX, dir=cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps(data, sort_keys=True).encode('utf-8'))
+        os.rename(temp_path, self.path)
+
+    def get(self, bucket, prefix):
+        """
+        Returns the list of prefixes below `prefix` in `bucket`, or None if
+        there isn't a fresh one.
+        """
+        with self.lock:
+            entry = self.entries.get((bucket, prefix))
+
+        if (entry is None) or ((time() - entry['time']) >= self.ttl):
+            return None
+
+        return list(entry['prefixes'])
+
+    def set(self, bucket, prefix, all_prefixes):
+        """
+        Stores `all_prefixes`, the list of prefixes below `prefix` in
+        `bucket`.
+        """
+        entry = {
+            'key': [bucket, prefix],
+            'time': time(),
+            'prefixes': list(all_prefixes),
+        }
+        with self.lock:
+            self.entries[bucket, prefix] = entry
+            if self.path is not None:
+                self._save()
@@ -0,0 +1,190 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division, print_function
+
+from threading import RLock
+from uuid import uuid4
+
+import boto3
+import botocore.session
+from botocore.config import Config
+from botocore.credentials import (
+    CredentialProvider,
+    CredentialResolver,
+    RefreshableCredentials,
+)
+from botocore.exceptions import NoRegionError
+from dateutil.tz import tzutc
+
+DEFAULT_REGION_NAME = 'us-east-1'
+
+# botocore's default connection pool size
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+
+class _AssumeRoleProvider(CredentialProvider):
+    # Gives a botocore session credentials for a role, which botocore renews
+    # (by calling `fetch`) shortly before they expire
+    METHOD = 'flowlogs-reader-assume-role'
+
+    def __init__(self, fetch):
+        super(_AssumeRoleProvider, self).__init__()
+        self.fetch = fetch
+
+    def load(self):
+        return RefreshableCredentials.create_from_metadata(
+            metadata=self.fetch(),
+            refresh_using=self.fetch,
+            method=self.METHOD,
+        )
+
+
+class ClientFactory(object):
+    """
+    Makes boto3 clients, re-using them (and their connection pools) for
+    readers with the same settings. Pass one to several readers - e.g. one
+    for each account - with the `client_factory` keyword.
+    * Sessions are kept for each profile and role.
+    * Clients are kept for each client type, region, profile, and role. A
+    client's connection pool has room for the reader's threads, or
+    `max_pool_connections`, whichever is more.
+    * Roles are assumed once. Their credentials are renewed shortly before
+    they expire, so clients (and readers) that use them keep working.
+    Clients made with extra `boto_client_kwargs` aren't kept, but share the
+    sessions.
+    """
+    def __init__(self, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS):
+        self.max_pool_connections = max_pool_connections
+        # Sessions aren't thread-safe, so they're only used with the lock
+        self.lock = RLock()
+        self.sessions = {}
+        self.clients = {}
+
+    def _assume_role(self, profile_name, role_arn, external_id):
+        # Returns credentials for the role in the form botocore's
+        # RefreshableCredentials takes
+        assume_role_kwargs = {
+            'RoleArn': role_arn,
+            'RoleSessionName': str(uuid4())[:32],
+        }
+        if external_id is not None:
+            assume_role_kwargs['ExternalId'] = external_id
+
+        sts_client = self.get_client('sts', profile_name=profile_name)
+        credentials = sts_client.assume_role(**assume_role_kwargs)[
+            'Credentials'
+        ]
+        expiration = credentials['Expiration']
+        if expiration.tzinfo is None:
+            expiration = expiration.replace(tzinfo=tzutc())
+
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': expiration.isoformat(),
+        }
+
+    def get_session(self, profile_name=None, role_arn=None, external_id=None):
+        """
+        Returns a boto3 Session for the given profile. If `role_arn` is
+        given, the session uses credentials for that role (and the optional
+        `external_id`).
+        """
+        key = (profile_name, role_arn, external_id)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is not None:
+                return session
+
+            if role_arn is None:
+                session_kwargs = {}
+                if profile_name is not None:
+                    session_kwargs['profile_name'] = profile_name
+                session = boto3.session.Session(**session_kwargs)
+            else:
+                provider = _AssumeRoleProvider(
+                    lambda: self._assume_role(
+                        profile_name, role_arn, external_id
+                    )
+                )
+                botocore_session = botocore.session.Session()
+                botocore_session.register_component(
+                    'credential_provider', CredentialResolver([provider])
+                )
+                session = boto3.session.Session(
+                    botocore_session=botocore_session
+                )
+
+            self.sessions[key] = session
+            return session
+
+    def _make_client(self, session, client_type, region_name, client_kwargs):
+        if region_name is not None:
+            client_kwargs = dict(client_kwargs, region_name=region_name)
+
+        try:
+            return session.client(client_type, **client_kwargs)
+        except NoRegionError:
+            return session.client(
+                client_type, region_name=DEFAULT_REGION_NAME, **client_kwargs
+            )
+
+    def get_client(
+        self,
+        client_type,
+        region_name=None,
+        profile_name=None,
+        role_arn=None,
+        external_id=None,
+        max_pool_connections=None,
+        client_kwargs=None,
+    ):
+        """
+        Returns a boto3 client of `client_type` (e.g. 'logs' or 's3') for the
+        given region, profile, and role. `max_pool_connections` is the
+        number of threads that will use it at once.
+        """
+        max_pool_connections = max(
+            self.max_pool_connections, max_pool_connections or 0
+        )
+        # Settings from a given config take precedence
+        config = Config(max_pool_connections=max_pool_connections)
+        is_custom = bool(client_kwargs)
+        client_kwargs = dict(client_kwargs or {})
+        if client_kwargs.get('config') is not None:
+            config = config.merge(client_kwargs['config'])
+        client_kwargs['config'] = config
+
+        with self.lock:
+            session = self.get_session(profile_name, role_arn, external_id)
+            if is_custom:
+                return self._make_client(
+                    session, client_type, region_name, client_kwargs
+                )
+
+            # Clients with too small a pool are replaced
+            key = (
+                client_type, region_name, profile_name, role_arn, external_id
+            )
+            cached = self.clients.get(key)
+            if (cached is not None) and (cached[1] >= max_pool_connections):
+                return cached[0]
+
+            client = self._make_client(
+                session, client_type, region_name, client_kwargs
+            )
+            self.clients[key] = client, max_pool_connections
+            return client
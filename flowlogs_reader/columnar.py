@@ -0,0 +1,342 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division, print_function
+
+from operator import methodcaller
+from socket import inet_aton, inet_ntoa
+from struct import pack, unpack
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+BATCH_SIZE = 65536
+EPOCH_32_MAX = 2147483647
+FIELD_COUNT = 14
+
+# The categorical columns are stored as indexes into these tuples
+ACTIONS = ('-', 'ACCEPT', 'REJECT')
+LOG_STATUSES = ('OK', 'NODATA', 'SKIPDATA')
+
+ACTION_CODES = {x: i for i, x in enumerate(ACTIONS)}
+LOG_STATUS_CODES = {x: i for i, x in enumerate(LOG_STATUSES)}
+
+# The fields of a message, in order
+FIELDS = (
+    'version',
+    'account_id',
+    'interface_id',
+    'srcaddr',
+    'dstaddr',
+    'srcport',
+    'dstport',
+    'protocol',
+    'packets',
+    'bytes',
+    'start',
+    'end',
+    'action',
+    'log_status',
+)
+STRING_FIELDS = frozenset(['account_id', 'interface_id'])
+IP_FIELDS = frozenset(['srcaddr', 'dstaddr'])
+CODES = {'action': ACTIONS, 'log_status': LOG_STATUSES}
+# Integer fields that are stored in less than int64
+INT_DTYPES = {
+    'version': 'uint8',
+    'srcport': 'uint16',
+    'dstport': 'uint16',
+    'protocol': 'uint8',
+}
+
+# Code for categorical values that aren't known
+NO_CODE = 255
+# Longer numbers may not fit into int64
+MAX_DIGITS = 18
+MAX_IP_LENGTH = len('255.255.255.255')
+# Characters that are looked for in the messages' bytes
+SPACE, DASH, DOT, ZERO, COLON = bytearray(b' -.0:')
+
+
+def ip_to_int(ip):
+    # Missing addresses (from NODATA and SKIPDATA records) are stored as 0
+    if ip == '-':
+        return 0
+
+    return unpack('!I', inet_aton(ip))[0]
+
+
+def int_to_ip(value):
+    return inet_ntoa(pack('!I', value))
+
+
+class FlowBatch(object):
+    """
+    Holds a sequence of VPC Flow Log records as NumPy arrays, one per field:
+    * `version`, `protocol`: uint8
+    * `account_id`, `interface_id`: strings
+    * `srcaddr`, `dstaddr`: uint32 IPv4 addresses (see `int_to_ip`)
+    * `srcport`, `dstport`: uint16
+    * `packets`, `bytes`: int64
+    * `start`, `end`: int64 milliseconds since the epoch
+    * `action`: uint8 indexes into `ACTIONS`
+    * `log_status`: uint8 indexes into `LOG_STATUSES`
+    Numeric fields of NODATA and SKIPDATA records are 0.
+    Messages that can't be represented this way (e.g. because they have IPv6
+    addresses) are kept as strings in the `unsupported` list.
+    """
+    __slots__ = ['columns', 'unsupported']
+
+    def __init__(self, columns, unsupported):
+        self.columns = columns
+        self.unsupported = unsupported
+
+    def __len__(self):
+        return len(self.columns['version'])
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    @classmethod
+    def from_messages(cls, messages):
+        if np is None:
+            raise RuntimeError('NumPy is required for columnar decoding')
+
+        # The messages are decoded together, from their bytes, rather than
+        # one at a time
+        messages = list(messages)
+        data, all_indexes, unsupported_indexes = _join_messages(messages)
+        buf = np.frombuffer(data, dtype=np.uint8)
+        all_starts, all_ends = _get_bounds(buf)
+
+        # Rows with empty fields, IPv6 addresses, or unknown actions or
+        # statuses can't be represented
+        is_supported = (all_ends > all_starts).all(axis=1)
+        columns = {}
+        all_bad = []
+        for i, field in enumerate(FIELDS):
+            starts = all_starts[:, i]
+            ends = all_ends[:, i]
+            if field in STRING_FIELDS:
+                columns[field] = _parse_strings(buf, starts, ends)
+            elif field in CODES:
+                codes = _parse_codes(buf, starts, ends, CODES[field])
+                is_supported &= codes != NO_CODE
+                columns[field] = codes
+            elif field in IP_FIELDS:
+                values, is_bad, is_ipv6 = _parse_ips(buf, starts, ends)
+                is_supported &= ~is_ipv6
+                columns[field] = values
+                all_bad.append((field, is_bad))
+            else:
+                values, is_bad = _parse_ints(buf, starts, ends)
+                columns[field] = values
+                all_bad.append((field, is_bad))
+
+        if not is_supported.all():
+            is_unsupported = ~is_supported
+            unsupported_indexes.extend(
+                (
+                    np.flatnonzero(is_unsupported) if all_indexes is None
+                    else all_indexes[is_unsupported]
+                ).tolist()
+            )
+            unsupported_indexes.sort()
+            columns = {k: v[is_supported] for k, v in columns.items()}
+            all_bad = [(k, v[is_supported]) for k, v in all_bad]
+
+        # Like FlowRecord, fail on numbers that can't be parsed
+        for field, is_bad in all_bad:
+            if is_bad.any():
+                raise ValueError('Invalid value for {}'.format(field))
+
+        for field, dtype in INT_DTYPES.items():
+            columns[field] = columns[field].astype(dtype)
+        columns['start'] = _to_milliseconds(columns['start'])
+        columns['end'] = _to_milliseconds(columns['end'])
+
+        unsupported = [messages[i] for i in unsupported_indexes]
+        return cls(columns, unsupported)
+
+
+def _join_messages(messages):
+    """
+    Returns the ASCII bytes of the messages that can be decoded in bulk,
+    separated by single spaces, along with an array of their indexes in
+    `messages` (or None if that's all of them) and a list of the indexes of
+    the others.
+    """
+    if set(map(_count_spaces, messages)) <= {FIELD_COUNT - 1}:
+        try:
+            return ' '.join(messages).encode('ascii'), None, []
+        except UnicodeError:
+            pass
+
+    all_parts = []
+    all_indexes = []
+    unsupported_indexes = []
+    for i, message in enumerate(messages):
+        # Fields may also be separated by other whitespace
+        if message.count(' ') != FIELD_COUNT - 1:
+            message = ' '.join(message.split())
+        try:
+            part = message.encode('ascii')
+        except UnicodeError:
+            part = None
+        if (part is None) or (part.count(b' ') != FIELD_COUNT - 1):
+            unsupported_indexes.append(i)
+            continue
+
+        all_parts.append(part)
+        all_indexes.append(i)
+
+    return (
+        b' '.join(all_parts),
+        np.array(all_indexes, dtype=np.intp),
+        unsupported_indexes,
+    )
+
+
+def _get_bounds(buf):
+    # Returns arrays with the start and end positions of each row's fields.
+    # Positions in batches of less than 2 GiB fit into int32.
+    dtype = np.int32 if len(buf) <= np.iinfo(np.int32).max else np.intp
+    all_ends = np.flatnonzero(buf == SPACE).astype(dtype)
+    all_ends = np.append(all_ends, np.array([len(buf)], dtype=dtype))
+    all_starts = np.empty_like(all_ends)
+    all_starts[0] = 0
+    all_starts[1:] = all_ends[:-1] + 1
+    if not len(buf):
+        all_starts = all_ends = all_ends[:0]
+    return (
+        all_starts.reshape(-1, FIELD_COUNT),
+        all_ends.reshape(-1, FIELD_COUNT),
+    )
+
+
+def _get_chars(buf, starts, ends, width, pad=0, right_aligned=False):
+    # Returns a (width, rows) array with the characters of each field,
+    # padded with `pad` after them (or before them if right_aligned). Fields
+    # longer than width are cut off.
+    lengths = ends - starts
+    offsets = np.arange(width, dtype=lengths.dtype)[:, None]
+    if right_aligned:
+        chars = np.take(buf, ends - width + offsets, mode='clip')
+        chars[offsets < width - lengths] = pad
+    else:
+        chars = np.take(buf, starts + offsets, mode='clip')
+        chars[offsets >= lengths] = pad
+    return chars
+
+
+def _get_width(starts, ends, max_width=None):
+    width = int((ends - starts).max()) if len(starts) else 0
+    if max_width is not None:
+        width = min(width, max_width)
+    return max(width, 1)
+
+
+def _parse_ints(buf, starts, ends):
+    # Returns int64 values and whether each one was invalid. Missing values
+    # ('-', in NODATA and SKIPDATA records) are 0.
+    width = _get_width(starts, ends, MAX_DIGITS)
+    chars = _get_chars(buf, starts, ends, width, ZERO, right_aligned=True)
+    # Characters before '0' wrap around to large values
+    digits = chars - ZERO
+    values = np.zeros(len(starts), dtype=np.int64)
+    for row in digits:
+        values = values * 10 + row
+
+    is_bad = ((ends - starts) > MAX_DIGITS) | (digits > 9).any(axis=0)
+    is_missing = ((ends - starts) == 1) & (chars[-1] == DASH)
+    values[is_missing] = 0
+    is_bad &= ~is_missing
+    return values, is_bad
+
+
+def _parse_ips(buf, starts, ends):
+    # Returns uint32 IPv4 addresses (see ip_to_int), whether each one was
+    # invalid, and whether each one had a colon (i.e. was IPv6). Missing
+    # addresses are 0.
+    width = _get_width(starts, ends, MAX_IP_LENGTH)
+    chars = _get_chars(buf, starts, ends, width, ZERO, right_aligned=True)
+    digits = chars - ZERO
+    is_dot = chars == DOT
+    values = np.zeros(len(starts), dtype=np.int64)
+    octets = np.zeros(len(starts), dtype=np.int64)
+    is_bad = (
+        ((ends - starts) > MAX_IP_LENGTH) |
+        ((digits > 9) & ~is_dot).any(axis=0) |
+        (is_dot.sum(axis=0) != 3)
+    )
+    for row, row_is_dot in zip(digits, is_dot):
+        values = np.where(row_is_dot, values * 256 + octets, values)
+        octets = np.where(row_is_dot, 0, octets * 10 + row)
+        is_bad |= octets > 255
+    values = values * 256 + octets
+
+    # IPv6 addresses have a colon at least every five characters
+    is_ipv6 = (chars == COLON).any(axis=0)
+    is_missing = ((ends - starts) == 1) & (chars[-1] == DASH)
+    values[is_missing] = 0
+    is_bad &= ~is_missing
+    return values.astype(np.uint32), is_bad, is_ipv6
+
+
+def _get_bytes(buf, starts, ends):
+    # Returns a bytes array of the fields. The zero padding is dropped.
+    width = _get_width(starts, ends)
+    chars = _get_chars(buf, starts, ends, width)
+    strings = np.ascontiguousarray(chars.T).view('S{}'.format(width))
+    return strings.reshape(-1)
+
+
+def _parse_strings(buf, starts, ends):
+    return _get_bytes(buf, starts, ends).astype(str)
+
+
+def _parse_codes(buf, starts, ends, all_names):
+    # Returns uint8 indexes into all_names, or NO_CODE for other values
+    strings = _get_bytes(buf, starts, ends)
+    codes = np.full(len(strings), NO_CODE, dtype=np.uint8)
+    for i, name in enumerate(all_names):
+        codes[strings == name.encode('ascii')] = i
+    return codes
+
+
+_count_spaces = methodcaller('count', ' ')
+
+
+def _to_milliseconds(values):
+    # Like FlowRecord, handle millisecond-based timestamps. Second-based ones
+    # are scaled up so that no precision is lost.
+    values[values <= EPOCH_32_MAX] *= 1000
+    return values
+
+
+def iter_batches(all_messages, size=BATCH_SIZE):
+    """
+    Yields a FlowBatch for each `size` messages from `all_messages`.
+    """
+    messages = []
+    for message in all_messages:
+        messages.append(message)
+        if len(messages) >= size:
+            yield FlowBatch.from_messages(messages)
+            messages = []
+
+    if messages:
+        yield FlowBatch.from_messages(messages)
@@ -0,0 +1,265 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division, print_function
+
+import os
+from errno import EEXIST
+from uuid import uuid4
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+from .columnar import BATCH_SIZE
+from .flowlogs_reader import BaseReader, S3FlowLogsReader
+
+EXPORT_FORMATS = ('parquet', 'arrow')
+DEFAULT_ROW_GROUP_SIZE = BATCH_SIZE
+# When this many records are held in memory in total, the biggest
+# partition's are written out
+DEFAULT_MAX_BUFFERED_ROWS = 4 * DEFAULT_ROW_GROUP_SIZE
+UNKNOWN_PARTITION = 'unknown'
+
+# The Arrow type of each FlowRecord field. Missing values are null, and
+# timestamps keep their milliseconds.
+_FIELD_TYPES = (
+    ('version', 'int8'),
+    ('account_id', 'string'),
+    ('interface_id', 'string'),
+    ('srcaddr', 'string'),
+    ('dstaddr', 'string'),
+    ('srcport', 'int32'),
+    ('dstport', 'int32'),
+    ('protocol', 'int16'),
+    ('packets', 'int64'),
+    ('bytes', 'int64'),
+    ('start', 'timestamp'),
+    ('end', 'timestamp'),
+    ('action', 'string'),
+    ('log_status', 'string'),
+)
+
+
+def get_schema():
+    """
+    Returns the pyarrow schema for exported records.
+    """
+    if pa is None:
+        raise RuntimeError('pyarrow is required for exporting records')
+
+    all_fields = []
+    for name, type_name in _FIELD_TYPES:
+        if type_name == 'timestamp':
+            arrow_type = pa.timestamp('ms')
+        else:
+            arrow_type = getattr(pa, type_name)()
+        all_fields.append(pa.field(name, arrow_type))
+
+    return pa.schema(all_fields)
+
+
+def _get_region(key):
+    # base_location/AWSLogs/account_number/vpcflowlogs/region_name/
+    # year/month/day/file_name
+    return key.rsplit('/', 5)[1]
+
+
+class PartitionedWriter(object):
+    """
+    Writes FlowRecords to Parquet (or Arrow IPC) files under `output_dir`,
+    in Hive-style account_id=.../region=.../date=.../ directories. The date
+    is that of each record's `start` time.
+    * `file_format` is 'parquet' or 'arrow'.
+    * `row_group_size` is the number of records that are held in memory
+    for each partition before they're written out as a row group (or record
+    batch).
+    * `max_buffered_rows` is the most records that are held in memory for
+    all of the partitions together. When it's reached, the partition with
+    the most is written out early.
+    * `compression` is the Parquet compression codec.
+    Each partition gets one new file, with a unique name, so writing more
+    records to the same directory later adds files rather than replacing
+    them. Use `close` (or a `with` block) to finish the files.
+    """
+    def __init__(
+        self,
+        output_dir,
+        file_format='parquet',
+        row_group_size=DEFAULT_ROW_GROUP_SIZE,
+        compression='snappy',
+        max_buffered_rows=DEFAULT_MAX_BUFFERED_ROWS,
+    ):
+        if pa is None:
+            raise RuntimeError('pyarrow is required for exporting records')
+        if file_format not in EXPORT_FORMATS:
+            raise ValueError('unknown format: {}'.format(file_format))
+
+        self.output_dir = output_dir
+        self.file_format = file_format
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.max_buffered_rows = max_buffered_rows
+        self.schema = get_schema()
+        self.file_name = 'part-{}.{}'.format(uuid4().hex, file_format)
+
+        # Each partition's buffered rows (one list per field) and open writer
+        self.buffers = {}
+        self.buffered_rows = 0
+        self.writers = {}
+        self.paths = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _get_writer(self, partition):
+        writer = self.writers.get(partition)
+        if writer is not None:
+            return writer
+
+        account_id, region, date = partition
+        dir_path = os.path.join(
+            self.output_dir,
+            'account_id={}'.format(account_id),
+            'region={}'.format(region),
+            'date={}'.format(date),
+        )
+        try:
+            os.makedirs(dir_path)
+        except OSError as e:
+            if e.errno != EEXIST:
+                raise
+
+        path = os.path.join(dir_path, self.file_name)
+        if self.file_format == 'parquet':
+            writer = pq.ParquetWriter(
+                path, self.schema, compression=self.compression
+            )
+        else:
+            writer = pa.ipc.new_file(path, self.schema)
+
+        self.writers[partition] = writer
+        self.paths.append(path)
+        return writer
+
+    def _flush(self, partition):
+        columns = self.buffers.pop(partition)
+        self.buffered_rows -= len(columns[0])
+        batch = pa.RecordBatch.from_arrays(
+            [
+                pa.array(values, type=field.type)
+                for values, field in zip(columns, self.schema)
+            ],
+            schema=self.schema,
+        )
+        writer = self._get_writer(partition)
+        if self.file_format == 'parquet':
+            writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            writer.write_batch(batch)
+
+    def write(self, flow_record, region=None):
+        """
+        Adds `flow_record`, which came from `region` (if known), to its
+        partition.
+        """
+        partition = (
+            flow_record.account_id or UNKNOWN_PARTITION,
+            region or UNKNOWN_PARTITION,
+            flow_record.start.strftime('%Y-%m-%d'),
+        )
+        columns = self.buffers.get(partition)
+        if columns is None:
+            columns = self.buffers[partition] = [[] for x in _FIELD_TYPES]
+
+        for values, (name, __) in zip(columns, _FIELD_TYPES):
+            values.append(getattr(flow_record, name))
+
+        self.buffered_rows += 1
+
+        if len(columns[0]) >= self.row_group_size:
+            self._flush(partition)
+        elif self.buffered_rows >= self.max_buffered_rows:
+            self._flush(
+                max(self.buffers, key=lambda x: len(self.buffers[x][0]))
+            )
+
+    def close(self):
+        """
+        Writes out any buffered records and finishes the files. Returns the
+        paths of the files that were written.
+        """
+        for partition in list(self.buffers):
+            self._flush(partition)
+
+        while self.writers:
+            partition, writer = self.writers.popitem()
+            writer.close()
+
+        return self.paths
+
+
+def _iter_region_records(reader, region=None):
+    # Yields (region, FlowRecord) for each of the reader's records. For S3
+    # the region comes from each file's key, and each file's lines are
+    # filtered and parsed like the reader's own. Other readers' records are
+    # from their client's region, unless one is given.
+    if isinstance(reader, S3FlowLogsReader):
+        all_files = reader._read_files(reader._get_all_keys())
+        for item, all_lines in all_files:
+            region = _get_region(item['Key'])
+            all_events = reader._filter_events(
+                {'message': x} for x in all_lines
+            )
+            for flow_record in reader._parse_events(all_events):
+                yield region, flow_record
+        return
+
+    if region is None:
+        region = getattr(
+            getattr(reader.boto_client, 'meta', None), 'region_name', None
+        )
+
+    for flow_record in reader:
+        yield region, flow_record
+
+
+def export_records(reader, output_dir, region=None, **kwargs):
+    """
+    Writes the records from `reader` to partitioned Parquet or Arrow IPC files
+    under `output_dir` (see PartitionedWriter, which takes the keyword
+    arguments), and returns the paths of the files that were written.
+    `reader` may be a FlowLogsReader or S3FlowLogsReader, in which case the
+    records' regions are found automatically, or any sequence of FlowRecords
+    from `region`.
+    """
+    if isinstance(reader, BaseReader):
+        all_items = _iter_region_records(reader, region)
+    else:
+        all_items = ((region, x) for x in reader)
+
+    writer = PartitionedWriter(output_dir, **kwargs)
+    try:
+        for record_region, flow_record in all_items:
+            writer.write(flow_record, record_region)
+    finally:
+        paths = writer.close()
+
+    return paths
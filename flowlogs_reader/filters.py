@@ -0,0 +1,390 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division, print_function
+
+import ast
+from bisect import bisect_right
+from operator import eq, ge, gt, le, lt, ne
+from socket import (
+    AF_INET,
+    AF_INET6,
+    error as socket_error,
+    inet_ntop,
+    inet_pton,
+)
+from struct import unpack
+
+from .columnar import EPOCH_32_MAX
+
+# The fields of a record, in order
+FIELD_NAMES = (
+    'version',
+    'account_id',
+    'interface_id',
+    'srcaddr',
+    'dstaddr',
+    'srcport',
+    'dstport',
+    'protocol',
+    'packets',
+    'bytes',
+    'start',
+    'end',
+    'action',
+    'log_status',
+)
+FIELD_INDEXES = {x: i for i, x in enumerate(FIELD_NAMES)}
+NUMERIC_FIELDS = frozenset(
+    [
+        'version',
+        'srcport',
+        'dstport',
+        'protocol',
+        'packets',
+        'bytes',
+        'start',
+        'end',
+    ]
+)
+
+# Timestamp fields may be in milliseconds, which are converted to seconds
+# locally but compared as-is by CloudWatch Logs. Since the raw value is never
+# smaller, only lower bounds on them can be added to filter patterns.
+TIMESTAMP_FIELDS = frozenset(['start', 'end'])
+TIMESTAMP_PATTERN_OPERATORS = frozenset([ast.Gt, ast.GtE])
+
+# The srcaddr and dstaddr fields' positions in a record
+SRCADDR_INDEX = FIELD_INDEXES['srcaddr']
+DSTADDR_INDEX = FIELD_INDEXES['dstaddr']
+
+# Comparison operators, along with how to write them in CloudWatch Logs
+# filter patterns
+_OPERATORS = {
+    ast.Eq: (eq, '='),
+    ast.NotEq: (ne, '!='),
+    ast.Lt: (lt, '<'),
+    ast.LtE: (le, '<='),
+    ast.Gt: (gt, '>'),
+    ast.GtE: (ge, '>='),
+}
+
+
+def _parse_ip(ip):
+    # Returns (address bits, integer value) for an IP address string, or
+    # None if it's not one
+    try:
+        if ':' in ip:
+            high, low = unpack('!QQ', inet_pton(AF_INET6, ip))
+            return 128, (high << 64) | low
+        return 32, unpack('!I', inet_pton(AF_INET, ip))[0]
+    except (socket_error, ValueError):
+        return None
+
+
+def _merge_ranges(all_ranges):
+    # Returns the sorted (first, last) ranges that cover all_ranges
+    ret = []
+    for first, last in sorted(all_ranges):
+        if ret and (first <= ret[-1][1] + 1):
+            ret[-1] = (ret[-1][0], max(last, ret[-1][1]))
+        else:
+            ret.append((first, last))
+
+    return ret
+
+
+class IPMatcher(object):
+    """
+    Checks whether IP addresses are in any of the addresses or CIDR blocks
+    (like '192.0.2.1', '198.51.100.0/24', or '2001:db8::/32') given by
+    `networks`. Raises ValueError for invalid networks.
+    Blocks are stored as sorted ranges of integers, so checking an address
+    takes one binary search.
+    """
+    def __init__(self, networks):
+        # Single addresses are also kept as normalized strings, which are
+        # quicker to check
+        self.addresses = set()
+        all_ranges = {32: [], 128: []}
+        for network in networks:
+            ip, sep, prefix_length = network.partition('/')
+            parsed = _parse_ip(ip)
+            if parsed is None:
+                raise ValueError('invalid address: {}'.format(network))
+            bits, value = parsed
+            prefix_length = int(prefix_length) if sep else bits
+            if not (0 <= prefix_length <= bits):
+                raise ValueError('invalid prefix length: {}'.format(network))
+
+            host_bits = bits - prefix_length
+            first = (value >> host_bits) << host_bits
+            all_ranges[bits].append((first, first + (1 << host_bits) - 1))
+            if not host_bits:
+                family = AF_INET if bits == 32 else AF_INET6
+                self.addresses.add(inet_ntop(family, inet_pton(family, ip)))
+
+        # For each address size, the starts and ends of the ranges
+        self.ranges = {}
+        for bits, ranges in all_ranges.items():
+            ranges = _merge_ranges(ranges)
+            self.ranges[bits] = (
+                [first for first, last in ranges],
+                [last for first, last in ranges],
+            )
+
+        # IPv4 addresses in records have only one string form, so they only
+        # need to be converted if there are blocks to check
+        self.check_ipv4_ranges = any(
+            first != last for first, last in all_ranges[32]
+        )
+
+    def match(self, ip):
+        """
+        Returns whether the address string `ip` is in the set. Strings that
+        aren't addresses (like '-') and None don't match.
+        """
+        if ip in self.addresses:
+            return True
+
+        if ip is None:
+            return False
+
+        if (not self.check_ipv4_ranges) and (':' not in ip):
+            return False
+
+        parsed = _parse_ip(ip)
+        if parsed is None:
+            return False
+
+        bits, value = parsed
+        starts, ends = self.ranges[bits]
+        i = bisect_right(starts, value) - 1
+        return (i >= 0) and (value <= ends[i])
+
+    def match_message(self, message):
+        """
+        Returns whether the srcaddr or dstaddr of the Flow Log record
+        `message` is in the set. Only those fields are looked at, so this is
+        much quicker than making a FlowRecord.
+        """
+        fields = message.split(' ', DSTADDR_INDEX + 1)
+        if len(fields) <= DSTADDR_INDEX:
+            return False
+
+        return (
+            self.match(fields[SRCADDR_INDEX]) or
+            self.match(fields[DSTADDR_INDEX])
+        )
+
+
+def _to_number(value):
+    # Like FlowRecord, handle millisecond-based timestamps. Missing values
+    # (i.e. '-') are None.
+    if value == '-':
+        return None
+    value = int(value)
+    return value / 1000.0 if value > EPOCH_32_MAX else value
+
+
+def _to_string(value):
+    return None if value == '-' else value
+
+
+def _get_literal(node):
+    # Constants may be numbers or strings. Names that aren't fields are
+    # strings too, so REJECT means 'REJECT'.
+    if isinstance(node, ast.Name) and (node.id not in FIELD_INDEXES):
+        return node.id
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        raise ValueError('expected a value: {}'.format(ast.dump(node)))
+
+
+def _get_literals(node):
+    if isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+        return [_get_literal(x) for x in node.elts]
+    value = _get_literal(node)
+    return list(value) if isinstance(value, (tuple, list, set)) else [value]
+
+
+def _convert_literal(field, value):
+    if field in NUMERIC_FIELDS:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            raise ValueError(
+                'expected a number for {}: {!r}'.format(field, value)
+            )
+
+    return str(value)
+
+
+def _format_literal(value):
+    # Formats a value for a CloudWatch Logs filter pattern
+    if isinstance(value, float):
+        return str(int(value)) if value.is_integer() else repr(value)
+    return '"{}"'.format(value)
+
+
+class FilterExpression(object):
+    """
+    A filter for Flow Log records, given as an expression string like
+    "action == REJECT and dstport in (22, 3389) and bytes > 1e6".
+    * Comparisons have a field name on the left, one of the operators
+    ==, !=, <, <=, >, >=, in, or not in, and a value on the right.
+    * `in` and `not in` take a tuple of values. For `srcaddr` and `dstaddr`
+    the values may be CIDR blocks.
+    * Comparisons may be combined with `and`, `or`, `not`, and parentheses.
+    * Bare words that aren't field names are treated as strings.
+    * Comparisons with missing values (i.e. '-') are false.
+    The expression is compiled once. `match_message` checks raw log lines,
+    so non-matching lines don't need to be parsed.
+    """
+    def __init__(self, expression):
+        self.expression = expression
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError as e:
+            raise ValueError('invalid expression: {}'.format(e))
+
+        self.max_index = 0
+        self.predicate = self._compile(tree.body)
+
+        # Top-level conditions are used for CloudWatch Logs filter patterns
+        if isinstance(tree.body, ast.BoolOp) and isinstance(
+            tree.body.op, ast.And
+        ):
+            self.conjuncts = tree.body.values
+        else:
+            self.conjuncts = [tree.body]
+
+    def _compile(self, node):
+        # Returns a function that evaluates node for a list of fields
+        if isinstance(node, ast.BoolOp):
+            all_funcs = [self._compile(x) for x in node.values]
+            if isinstance(node.op, ast.And):
+                return lambda fields: all(f(fields) for f in all_funcs)
+            return lambda fields: any(f(fields) for f in all_funcs)
+
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            func = self._compile(node.operand)
+            return lambda fields: not func(fields)
+
+        if isinstance(node, ast.Compare) and (len(node.ops) == 1):
+            return self._compile_compare(node)
+
+        raise ValueError('unsupported expression: {}'.format(ast.dump(node)))
+
+    def _compile_compare(self, node):
+        left = node.left
+        if not (isinstance(left, ast.Name) and (left.id in FIELD_INDEXES)):
+            raise ValueError(
+                'expected a field name: {}'.format(ast.dump(left))
+            )
+        field = left.id
+        index = FIELD_INDEXES[field]
+        self.max_index = max(self.max_index, index)
+        convert = _to_number if (field in NUMERIC_FIELDS) else _to_string
+
+        op = node.ops[0]
+        comparator = node.comparators[0]
+        if isinstance(op, (ast.In, ast.NotIn)):
+            values = _get_literals(comparator)
+            if (index in (SRCADDR_INDEX, DSTADDR_INDEX)) and any(
+                '/' in str(x) for x in values
+            ):
+                contains = IPMatcher([str(x) for x in values]).match
+            else:
+                contains = frozenset(
+                    _convert_literal(field, x) for x in values
+                ).__contains__
+            negate = isinstance(op, ast.NotIn)
+
+            def compare(fields):
+                value = convert(fields[index])
+                if value is None:
+                    return False
+                return contains(value) != negate
+
+            return compare
+
+        if type(op) not in _OPERATORS:
+            raise ValueError('unsupported operator: {}'.format(ast.dump(op)))
+        func = _OPERATORS[type(op)][0]
+        other = _convert_literal(field, _get_literal(comparator))
+
+        def compare(fields):
+            value = convert(fields[index])
+            if value is None:
+                return False
+            return func(value, other)
+
+        return compare
+
+    def match_message(self, message):
+        """
+        Returns whether the Flow Log record `message` matches. Lines that
+        are too short don't.
+        """
+        fields = message.split(' ', self.max_index + 1)
+        try:
+            return self.predicate(fields)
+        except IndexError:
+            return False
+
+    def to_filter_pattern(self, base_pattern):
+        """
+        Returns a CloudWatch Logs filter pattern for space-delimited events
+        that is at least as broad as this expression, by adding the simple
+        top-level comparisons to the fields in `base_pattern` (a pattern
+        like `[version="2", account_id, ...]` with a term for each field).
+        Conditions that are already in `base_pattern` are kept.
+        Returns None if nothing can be added.
+        """
+        all_terms = [x.strip() for x in base_pattern.strip('[]').split(',')]
+        if len(all_terms) != len(FIELD_NAMES):
+            return None
+
+        changed = False
+        for node in self.conjuncts:
+            if not (
+                isinstance(node, ast.Compare) and
+                (type(node.ops[0]) in _OPERATORS)
+            ):
+                continue
+            field = node.left.id
+            if (field in TIMESTAMP_FIELDS) and (
+                type(node.ops[0]) not in TIMESTAMP_PATTERN_OPERATORS
+            ):
+                continue
+            value = _convert_literal(field, _get_literal(node.comparators[0]))
+            symbol = _OPERATORS[type(node.ops[0])][1]
+            condition = '{}{}{}'.format(field, symbol, _format_literal(value))
+
+            # A term with no condition is just the field's name
+            index = FIELD_INDEXES[field]
+            if all_terms[index] == field:
+                all_terms[index] = condition
+            else:
+                all_terms[index] = '{} && {}'.format(
+                    all_terms[index], condition
+                )
+            changed = True
+
+        if not changed:
+            return None
+
+        return '[{}]'.format(', '.join(all_terms))
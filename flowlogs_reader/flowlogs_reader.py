@@ -14,22 +14,38 @@
 
 from __future__ import division, print_function
 
+import json
+import mmap
+import os
+import re
+import zlib
 from calendar import timegm
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
-from gzip import GzipFile
-from io import BytesIO
-from os.path import basename
+from errno import ENOENT
+from heapq import heappop, heappush
+from itertools import chain
+from tempfile import mkstemp
+from time import sleep, time
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import NoRegionError, PaginationError
 from dateutil.rrule import rrule, DAILY
 
+from .cache import DEFAULT_CACHE_SIZE, FileCache, PrefixCache
+from .clients import ClientFactory, DEFAULT_REGION_NAME
+from .columnar import BATCH_SIZE, iter_batches
+from .filters import FilterExpression
+from .stats import InstrumentedClient, ReaderStats, STATS_FLUSH_RECORDS
+from .throttling import DEFAULT_MAX_RETRIES, ThrottledClient
+
 DEFAULT_FILTER_PATTERN = (
     '[version="2", account_id, interface_id, srcaddr, dstaddr, '
     'srcport, dstport, protocol, packets, bytes, '
     'start, end, action, log_status]'
 )
-DEFAULT_REGION_NAME = 'us-east-1'
 DUPLICATE_NEXT_TOKEN_MESSAGE = 'The same next token was received twice'
 
 ACCEPT = 'ACCEPT'
@@ -37,6 +53,455 @@ REJECT = 'REJECT'
 SKIPDATA = 'SKIPDATA'
 NODATA = 'NODATA'
 
+# S3 objects are decompressed in chunks of this many bytes
+READ_CHUNK_SIZE = 64 * 1024
+# Tells zlib to expect a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+KEY_STAMP_FORMAT = '%Y%m%dT%H%MZ'
+KEY_STAMP_RE = re.compile(r'^\d{8}T\d{4}Z$')
+KEY_STAMP_MAX = '~'
+
+DEFAULT_POLL_INTERVAL = 60
+DEFAULT_PROGRESS_INTERVAL = 10
+DEFAULT_FOLLOW_OVERLAP = timedelta(hours=1)
+# How the end of the last check is saved in follow's checkpoints
+CHECKPOINT_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+# filter_log_events takes at most this many log stream names
+MAX_LOG_STREAM_NAMES = 100
+
+
+def _bounded_map(func, iterable, max_workers, max_pending=None):
+    """
+    Yields `func(x)` for each item `x` of `iterable`, in order, using a pool of
+    `max_workers` threads. At most `max_pending` calls (by default, twice the
+    number of workers) are submitted but not yet consumed at any time, which
+    caps the memory used to hold their results.
+    """
+    max_pending = max_pending or (2 * max_workers)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for item in iterable:
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(func, item))
+
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Don't start work whose results will never be consumed
+            for future in pending:
+                future.cancel()
+
+
+class _PageChain(object):
+    """
+    Follows the page tokens of a paginated API call in the background. `fetch`
+    is called in `executor` with a copy of `kwargs` for each page. The next
+    page is requested as soon as the previous one is taken, so at most two
+    pages are held in memory.
+    """
+    __slots__ = ['executor', 'fetch', 'kwargs', 'future']
+
+    def __init__(self, executor, fetch, kwargs):
+        self.executor = executor
+        self.fetch = fetch
+        self.kwargs = kwargs
+        self.future = executor.submit(fetch, kwargs)
+
+    def next_page(self):
+        # Returns the next page's events, or None if there are no more
+        if self.future is None:
+            return None
+
+        page = self.future.result()
+        next_token = page.get('nextToken')
+        # CloudWatch Logs sometimes repeats the last token - that also means
+        # there's nothing left to retrieve.
+        if next_token and (next_token != self.kwargs.get('nextToken')):
+            self.kwargs = dict(self.kwargs, nextToken=next_token)
+            self.future = self.executor.submit(self.fetch, self.kwargs)
+        else:
+            self.future = None
+
+        return page['events']
+
+    def cancel(self):
+        if self.future is not None:
+            self.future.cancel()
+
+    def __iter__(self):
+        while True:
+            events = self.next_page()
+            if events is None:
+                break
+            for event in events:
+                yield event
+
+
+def _iter_chains_unordered(executor, fetch, all_kwargs, max_active):
+    """
+    Yields the events from the pages of each of the queries in `all_kwargs`,
+    following at most `max_active` of them at once. Events are yielded in the
+    order their pages arrive.
+    """
+    all_kwargs = iter(all_kwargs)
+    active = {}
+
+    def start_next():
+        for kwargs in all_kwargs:
+            page_chain = _PageChain(executor, fetch, kwargs)
+            active[page_chain.future] = page_chain
+            break
+
+    try:
+        for __ in range(max_active):
+            start_next()
+
+        while active:
+            done, __ = wait(list(active), return_when=FIRST_COMPLETED)
+            for future in done:
+                page_chain = active.pop(future)
+                events = page_chain.next_page()
+                if page_chain.future is None:
+                    start_next()
+                else:
+                    active[page_chain.future] = page_chain
+
+                for event in events:
+                    yield event
+    finally:
+        for page_chain in active.values():
+            page_chain.cancel()
+
+
+def _iter_chains_in_order(executor, fetch, all_kwargs, max_active):
+    """
+    Yields the events from the pages of each of the queries in `all_kwargs`,
+    one query after the other. The first pages of up to `max_active` of the
+    upcoming queries are retrieved while the current one is being read.
+    """
+    all_kwargs = iter(all_kwargs)
+    active = deque()
+
+    def start_next():
+        for kwargs in all_kwargs:
+            active.append(_PageChain(executor, fetch, kwargs))
+            break
+
+    try:
+        for __ in range(max_active):
+            start_next()
+
+        while active:
+            for event in active[0]:
+                yield event
+            active.popleft()
+            start_next()
+    finally:
+        for page_chain in active:
+            page_chain.cancel()
+
+
+def _iter_chains_merged(executor, fetch, all_kwargs, key, max_active):
+    """
+    Yields the events from the pages of each of the queries in `all_kwargs`,
+    merged in `key` order. `all_kwargs` has (lower bound, kwargs) pairs,
+    sorted by lower bound, and each query must return events sorted by `key`
+    that are at or above its lower bound. Up to `max_active` of the queries
+    are followed at once, and the next ones are started as those finish.
+    Queries whose lower bound is reached sooner are started early, since
+    their events may need to be merged with the ones in progress.
+    """
+    all_kwargs = iter(all_kwargs)
+    upcoming = next(all_kwargs, None)
+    active = {}
+    # The heap has the next event from each active query. Decorate each
+    # event so that ties never fall through to comparing the events (or the
+    # iterators) themselves.
+    heap = []
+
+    def decorated(i, page_chain):
+        for j, event in enumerate(page_chain):
+            yield key(event), i, j, event
+
+    def push_next(i, all_items):
+        for item in all_items:
+            heappush(heap, (item, all_items))
+            break
+        else:
+            del active[i]
+
+    try:
+        i = 0
+        while True:
+            # Every active query has an event in the heap at this point, so
+            # the first one is the next to be yielded unless an upcoming
+            # query could have an earlier one
+            new_chains = []
+            while (upcoming is not None) and (
+                (len(active) < max_active) or
+                ((not new_chains) and (upcoming[0] <= heap[0][0][0]))
+            ):
+                page_chain = _PageChain(executor, fetch, upcoming[1])
+                active[i] = page_chain
+                new_chains.append((i, page_chain))
+                i += 1
+                upcoming = next(all_kwargs, None)
+
+            # The new queries' first pages are retrieved concurrently
+            if new_chains:
+                for j, page_chain in new_chains:
+                    push_next(j, decorated(j, page_chain))
+                continue
+
+            if not heap:
+                break
+
+            item, all_items = heappop(heap)
+            yield item[3]
+            push_next(item[1], all_items)
+    finally:
+        for page_chain in active.values():
+            page_chain.cancel()
+
+
+class _GzipLineDecoder(object):
+    """
+    Incrementally decompresses gzip data, which may be split at arbitrary
+    points, into lines of bytes. Files made of several gzip members (i.e.
+    concatenated .gz files) are handled.
+    """
+    __slots__ = ['decompressor', 'remainder', 'started']
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(GZIP_WBITS)
+        self.remainder = b''
+        self.started = False
+
+    def feed(self, data):
+        # Returns the lines completed by `data`. The incomplete last line is
+        # kept until more data comes in.
+        decompressed = []
+        self.started = self.started or bool(data)
+        while data:
+            decompressed.append(self.decompressor.decompress(data))
+            data = self.decompressor.unused_data.lstrip(b'\x00')
+            if data:
+                self.decompressor = zlib.decompressobj(GZIP_WBITS)
+
+        lines = b''.join([self.remainder] + decompressed).split(b'\n')
+        self.remainder = lines.pop()
+        return lines
+
+    def flush(self):
+        # Returns whatever is left after the last newline. Data that stops
+        # before the end of a gzip member is an error, like it is for
+        # GzipFile. (Python 2's decompressor can't tell, so it's not checked
+        # there.)
+        if self.started and not getattr(self.decompressor, 'eof', True):
+            raise EOFError(
+                'Compressed file ended before the end-of-stream marker was '
+                'reached'
+            )
+
+        last_line = self.remainder + self.decompressor.flush()
+        self.remainder = b''
+        return [last_line] if last_line else []
+
+
+def _iter_gzip_lines(stream, chunk_size=READ_CHUNK_SIZE, stats=None):
+    """
+    Yields the lines of the gzip-compressed file object `stream`, reading
+    `chunk_size` bytes at a time so that only a small part of the file is
+    held in memory. If `stats` (a ReaderStats) is given, the decompression
+    is measured.
+    """
+    decoder = _GzipLineDecoder()
+    while True:
+        data = stream.read(chunk_size)
+        if not data:
+            break
+        for line in _timed_lines(decoder.feed, (data,), stats):
+            yield line
+
+    for line in _timed_lines(decoder.flush, (), stats):
+        yield line
+
+
+def _timed_lines(func, args, stats):
+    # Returns the lines from `func`, adding its time and their size to
+    # `stats` if it's given
+    if stats is None:
+        return func(*args)
+
+    start = time()
+    lines = func(*args)
+    stats.add(
+        decompress_time=time() - start,
+        bytes_decompressed=sum(len(x) + 1 for x in lines),
+    )
+    return lines
+
+
+def _to_datetime(timestamp, EPOCH_32_MAX=2147483647):
+    # Contra the docs, the start and end fields can contain
+    # millisecond-based timestamps.
+    # http://docs.aws.amazon.com/AmazonVPC/latest/UserGuide/flow-logs.html
+    timestamp = int(timestamp)
+    if timestamp > EPOCH_32_MAX:
+        timestamp /= 1000
+
+    return datetime.utcfromtimestamp(timestamp)
+
+
+def _get_key_stamp(dt):
+    # S3 file names have timestamps truncated to the minute, so round up to
+    # get the smallest stamp that's not before `dt`.
+    if dt.second or dt.microsecond:
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    return dt.strftime(KEY_STAMP_FORMAT)
+
+
+def _split_key(key):
+    # Returns (key up to the timestamp, timestamp) for S3 flow log keys, or
+    # None for keys that don't look like flow log files.
+    head, sep, tail = key.rpartition('_')
+    if not sep:
+        return None
+    head, sep, stamp = head.rpartition('_')
+    if not (sep and KEY_STAMP_RE.match(stamp)):
+        return None
+    return head, stamp
+
+
+def _is_stream_in_range(stream, start_ms, end_ms):
+    # Streams without any events don't have timestamps
+    first_ms = stream.get('firstEventTimestamp')
+    if first_ms is None:
+        return False
+
+    # lastEventTimestamp is only updated eventually, so consider the
+    # ingestion time also
+    last_ms = max(
+        stream.get('lastEventTimestamp', 0),
+        stream.get('lastIngestionTime', 0),
+    )
+    return (first_ms < end_ms) and (last_ms >= start_ms)
+
+
+def _get_date_prefixes(start_time, end_time):
+    # Each base_location/AWSLogs/account_number/vpcflowlogs/region_name/
+    # prefix has files organized in year/month/day directories.
+    # Yield the year/month/day/ fragments that are relevant to the
+    # time range
+    dtstart = start_time.replace(hour=0, minute=0, second=0, microsecond=0)
+    until = end_time.replace(hour=0, minute=0, second=0, microsecond=0)
+    for dt in rrule(freq=DAILY, dtstart=dtstart, until=until):
+        yield dt.strftime('%Y/%m/%d/')
+
+
+def _filter_key_page(all_items, start_stamp, end_stamp):
+    """
+    Returns the S3 listing entries from `all_items` whose timestamps are in
+    [`start_stamp`, `end_stamp`). Also returns the key to continue listing
+    after, or None if the listing should just go on to the next page.
+    """
+    # S3 keys have a file name like:
+    # account_vpcflowlogs_region_flow-logs-id_datetime_hash.log.gz
+    # Keys for each flow log sort by their timestamp, so rather than
+    # paging through everything under a prefix we skip ahead past files
+    # that are too old and past files that are too new.
+    ret = []
+    last_parts = None
+    for item in all_items:
+        parts = _split_key(item['Key'])
+        if parts is None:
+            continue
+        last_parts = parts
+        if start_stamp <= parts[1] < end_stamp:
+            ret.append(item)
+
+    start_after = None
+    if last_parts is not None:
+        head, stamp = last_parts
+        if stamp < start_stamp:
+            start_after = '{}_{}'.format(head, start_stamp)
+        elif stamp >= end_stamp:
+            start_after = '{}_{}'.format(head, KEY_STAMP_MAX)
+
+    return ret, start_after
+
+
+def _load_checkpoint(checkpoint_path):
+    # Returns the saved checkpoint, or an empty one if there isn't one yet
+    if checkpoint_path is None:
+        return {}
+
+    try:
+        with open(checkpoint_path, 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+    except IOError as e:
+        if e.errno == ENOENT:
+            return {}
+        raise
+
+
+def _save_checkpoint(checkpoint_path, checkpoint):
+    # Write to a temporary file first so that an interrupted save doesn't
+    # clobber the previous checkpoint
+    if checkpoint_path is None:
+        return
+
+    checkpoint_dir = os.path.dirname(os.path.abspath(checkpoint_path))
+    fd, temp_path = mkstemp(prefix='.tmp-', dir=checkpoint_dir)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(json.dumps(checkpoint, sort_keys=True).encode('utf-8'))
+    os.rename(temp_path, checkpoint_path)
+
+
+def _iter_unread_events(all_events, all_marks):
+    """
+    Yields the CloudWatch Logs events from `all_events` that come after
+    their log streams' high-water marks in `all_marks`, and moves the marks
+    past each event once the next one is requested. Each mark has the
+    timestamp and ingestion time of the last event that was read, and the
+    IDs of the events that were read at that timestamp.
+    """
+    # Events are skipped based on the marks from before this check
+    previous = {
+        stream_name: (mark['timestamp'], frozenset(mark['event_ids']))
+        for stream_name, mark in all_marks.items()
+    }
+    for event in all_events:
+        stream_name = event['logStreamName']
+        timestamp = event['timestamp']
+        event_id = event['eventId']
+        if stream_name in previous:
+            mark_timestamp, mark_ids = previous[stream_name]
+            if (timestamp < mark_timestamp) or (
+                (timestamp == mark_timestamp) and (event_id in mark_ids)
+            ):
+                continue
+
+        yield event
+
+        ingestion_time = event.get('ingestionTime', 0)
+        mark = all_marks.get(stream_name)
+        if mark is None:
+            mark = all_marks[stream_name] = {
+                'timestamp': timestamp,
+                'ingestion_time': ingestion_time,
+                'event_ids': [event_id],
+            }
+        elif timestamp > mark['timestamp']:
+            mark['timestamp'] = timestamp
+            mark['event_ids'] = [event_id]
+        elif timestamp == mark['timestamp']:
+            mark['event_ids'].append(event_id)
+        mark['ingestion_time'] = max(mark['ingestion_time'], ingestion_time)
+
 
 class FlowRecord(object):
     """
@@ -67,19 +532,8 @@ class FlowRecord(object):
         self.account_id = fields[1]
         self.interface_id = fields[2]
 
-        # Contra the docs, the start and end fields can contain
-        # millisecond-based timestamps.
-        # http://docs.aws.amazon.com/AmazonVPC/latest/UserGuide/flow-logs.html
-        start = int(fields[10])
-        if start > EPOCH_32_MAX:
-            start /= 1000
-
-        end = int(fields[11])
-        if end > EPOCH_32_MAX:
-            end /= 1000
-
-        self.start = datetime.utcfromtimestamp(start)
-        self.end = datetime.utcfromtimestamp(end)
+        self.start = _to_datetime(fields[10], EPOCH_32_MAX)
+        self.end = _to_datetime(fields[11], EPOCH_32_MAX)
 
         self.log_status = fields[13]
         if self.log_status in (NODATA, SKIPDATA):
@@ -104,20 +558,23 @@ class FlowRecord(object):
     def __eq__(self, other):
         try:
             return all(
-                getattr(self, x) == getattr(other, x) for x in self.__slots__
+                getattr(self, x) == getattr(other, x)
+                for x in FlowRecord.__slots__
             )
         except AttributeError:
             return False
 
     def __hash__(self):
-        return hash(tuple(getattr(self, x) for x in self.__slots__))
+        return hash(tuple(getattr(self, x) for x in FlowRecord.__slots__))
 
     def __str__(self):
-        ret = ['{}: {}'.format(x, getattr(self, x)) for x in self.__slots__]
+        ret = [
+            '{}: {}'.format(x, getattr(self, x)) for x in FlowRecord.__slots__
+        ]
         return ', '.join(ret)
 
     def to_dict(self):
-        return {x: getattr(self, x) for x in self.__slots__}
+        return {x: getattr(self, x) for x in FlowRecord.__slots__}
 
     def to_message(self):
         D_transform = {
@@ -126,7 +583,7 @@ class FlowRecord(object):
         }
 
         ret = []
-        for attr in self.__slots__:
+        for attr in FlowRecord.__slots__:
             transform = D_transform.get(attr, lambda x: str(x) if x else '-')
             ret.append(transform(getattr(self, attr)))
 
@@ -137,6 +594,49 @@ class FlowRecord(object):
         return cls({'message': message})
 
 
+def _lazy_field(index, convert=None, optional=False):
+    # Returns a property that converts the field at `index` of the record's
+    # message with `convert`. Optional fields are None for NODATA and
+    # SKIPDATA records.
+    def getter(self):
+        fields = self._fields
+        if optional and (fields[13] in (NODATA, SKIPDATA)):
+            return None
+
+        value = fields[index]
+        return value if convert is None else convert(value)
+
+    return property(getter)
+
+
+class LazyFlowRecord(FlowRecord):
+    """
+    A FlowRecord that keeps the fields of the event's message as strings and
+    only converts them when they're accessed. Its attributes are the same as
+    FlowRecord's, but parsing is much cheaper when only a few of them are
+    used. Values are converted again each time they're accessed.
+    """
+    __slots__ = ['_fields']
+
+    def __init__(self, event):
+        self._fields = event['message'].split()
+
+    version = _lazy_field(0, int)
+    account_id = _lazy_field(1)
+    interface_id = _lazy_field(2)
+    srcaddr = _lazy_field(3, optional=True)
+    dstaddr = _lazy_field(4, optional=True)
+    srcport = _lazy_field(5, int, optional=True)
+    dstport = _lazy_field(6, int, optional=True)
+    protocol = _lazy_field(7, int, optional=True)
+    packets = _lazy_field(8, int, optional=True)
+    bytes = _lazy_field(9, int, optional=True)
+    start = _lazy_field(10, _to_datetime)
+    end = _lazy_field(11, _to_datetime)
+    action = _lazy_field(12, optional=True)
+    log_status = _lazy_field(13)
+
+
 class BaseReader(object):
     def __init__(
         self,
@@ -147,26 +647,100 @@ class BaseReader(object):
         end_time=None,
         boto_client_kwargs=None,
         boto_client=None,
+        lazy=False,
+        message_filter=None,
+        filter_expression=None,
+        stats=None,
+        progress_callback=None,
+        progress_interval=DEFAULT_PROGRESS_INTERVAL,
+        rate_limiter=None,
+        max_retries=DEFAULT_MAX_RETRIES,
+        client_factory=None,
+        role_arn=None,
+        external_id=None,
+        max_pool_connections=None,
     ):
         # Get a boto3 client with which to perform queries
         if boto_client is not None:
             self.boto_client = boto_client
         else:
             self.boto_client = self._get_client(
-                client_type, region_name, profile_name, boto_client_kwargs
+                client_type,
+                region_name,
+                profile_name,
+                boto_client_kwargs,
+                client_factory,
+                role_arn,
+                external_id,
+                max_pool_connections,
             )
 
-        # If no time filters are given use the last hour
+        # Requests, data sizes, and timings are recorded if a ReaderStats
+        # object is given (or if progress is to be reported)
+        if (stats is None) and (progress_callback is not None):
+            stats = ReaderStats()
+        self.stats = stats
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+        if (stats is not None) and (self.boto_client is not None):
+            self.boto_client = InstrumentedClient(self.boto_client, stats)
+
+        # Requests go through the rate limiter, which may be shared with
+        # other readers, and throttled ones are retried. Each attempt is
+        # recorded in the stats.
+        self.rate_limiter = rate_limiter
+        if (rate_limiter is not None) and (self.boto_client is not None):
+            self.boto_client = ThrottledClient(
+                self.boto_client, rate_limiter, max_retries, stats
+            )
+
+        # If no time filters are given use the last hour. (When following,
+        # a checkpoint's position is used instead.)
         now = datetime.utcnow()
+        self.start_time_given = start_time is not None
         self.start_time = start_time or now - timedelta(hours=1)
         self.end_time = end_time or now
 
+        # Parse records up front, or when their attributes are accessed
+        self.record_class = LazyFlowRecord if lazy else FlowRecord
+
+        # Events whose messages don't pass these are skipped before parsing
+        self.message_filter = message_filter
+        self.filter_expression = (
+            None if filter_expression is None
+            else FilterExpression(filter_expression)
+        )
+
         # Initialize the iterator
         self.iterator = self._reader()
 
     def _get_client(
-        self, client_type, region_name, profile_name, boto_client_kwargs
+        self,
+        client_type,
+        region_name,
+        profile_name,
+        boto_client_kwargs,
+        client_factory=None,
+        role_arn=None,
+        external_id=None,
+        max_pool_connections=None,
     ):
+        # Roles are assumed by a ClientFactory, which keeps their
+        # credentials fresh
+        if (client_factory is None) and (role_arn is not None):
+            client_factory = ClientFactory()
+
+        if client_factory is not None:
+            return client_factory.get_client(
+                client_type,
+                region_name=region_name,
+                profile_name=profile_name,
+                role_arn=role_arn,
+                external_id=external_id,
+                max_pool_connections=max_pool_connections,
+                client_kwargs=boto_client_kwargs,
+            )
+
         session_kwargs = {}
         if region_name is not None:
             session_kwargs['region_name'] = region_name
@@ -176,6 +750,13 @@ class BaseReader(object):
 
         client_kwargs = boto_client_kwargs or {}
 
+        # Make room in the connection pool for each of the reader's threads
+        if max_pool_connections is not None:
+            config = Config(max_pool_connections=max_pool_connections)
+            if client_kwargs.get('config') is not None:
+                config = config.merge(client_kwargs['config'])
+            client_kwargs = dict(client_kwargs, config=config)
+
         session = boto3.session.Session(**session_kwargs)
         try:
             boto_client = session.client(client_type, **client_kwargs)
@@ -196,11 +777,125 @@ class BaseReader(object):
         # For Python 2 compatibility
         return self.__next__()
 
+    def iter_batches(self, size=BATCH_SIZE):
+        """
+        Yields FlowBatch objects, which hold up to `size` records as NumPy
+        arrays. This reads the location separately from iterating over the
+        reader, and requires NumPy.
+        """
+        all_events = self._filter_events(self._read_streams())
+        all_messages = (event['message'] for event in all_events)
+        return iter_batches(all_messages, size)
+
+    def _filter_events(self, all_events):
+        if self.stats is not None:
+            all_events = self.stats.count_events(all_events)
+
+        if self.message_filter is not None:
+            message_filter = self.message_filter
+            all_events = (
+                x for x in all_events if message_filter(x['message'])
+            )
+
+        if self.filter_expression is not None:
+            match_message = self.filter_expression.match_message
+            all_events = (
+                x for x in all_events if match_message(x['message'])
+            )
+
+        return all_events
+
+    def _parse_events(self, all_events):
+        record_class = self.record_class
+        stats = self.stats
+        if stats is None:
+            for event in all_events:
+                yield record_class(event)
+            return
+
+        # Parsing times are added up locally and added to the stats every so
+        # often, which is also when progress is reported
+        progress_callback = self.progress_callback
+        last_progress = time()
+        count = 0
+        parse_time = 0.0
+        try:
+            for event in all_events:
+                start = time()
+                flow_record = record_class(event)
+                parse_time += time() - start
+                count += 1
+                if count == STATS_FLUSH_RECORDS:
+                    stats.add(records_parsed=count, parse_time=parse_time)
+                    count = 0
+                    parse_time = 0.0
+                    if (progress_callback is not None) and (
+                        time() - last_progress >= self.progress_interval
+                    ):
+                        progress_callback(stats)
+                        last_progress = time()
+
+                yield flow_record
+        finally:
+            stats.add(records_parsed=count, parse_time=parse_time)
+
     def _reader(self):
         # Loops through each log stream and its events, yielding a parsed
         # version of each event.
-        for event in self._read_streams():
-            yield FlowRecord(event)
+        all_events = self._filter_events(self._read_streams())
+        for flow_record in self._parse_events(all_events):
+            yield flow_record
+
+    def follow(
+        self,
+        checkpoint_path=None,
+        poll_interval=DEFAULT_POLL_INTERVAL,
+        overlap=DEFAULT_FOLLOW_OVERLAP,
+        max_polls=None,
+    ):
+        """
+        Yields records as they arrive, checking for new ones every
+        `poll_interval` seconds. The first check starts at `start_time`;
+        later ones look back `overlap` before the previous check's end, so
+        data that arrives late (but within the overlap) isn't missed.
+        Records are never yielded twice.
+        If `checkpoint_path` is given, the position is saved there after each
+        check and when iteration stops, and is resumed from the next time.
+        Unless a `start_time` was given, the first check then starts at the
+        `overlap` before the end of the last saved check, however long ago.
+        If `max_polls` is given, stop after that many checks.
+        """
+        checkpoint = _load_checkpoint(checkpoint_path)
+        if ('end_time' in checkpoint) and (not self.start_time_given):
+            last_end_time = datetime.strptime(
+                checkpoint['end_time'], CHECKPOINT_TIME_FORMAT
+            )
+            self.start_time = last_end_time - overlap
+
+        poll_count = 0
+        try:
+            while True:
+                self.end_time = datetime.utcnow()
+                all_events = self._filter_events(
+                    self._read_new_events(checkpoint)
+                )
+                for flow_record in self._parse_events(all_events):
+                    yield flow_record
+                checkpoint['end_time'] = self.end_time.strftime(
+                    CHECKPOINT_TIME_FORMAT
+                )
+                _save_checkpoint(checkpoint_path, checkpoint)
+
+                poll_count += 1
+                if poll_count == max_polls:
+                    break
+
+                self.start_time = max(
+                    self.start_time, self.end_time - overlap
+                )
+                sleep(poll_interval)
+        finally:
+            _save_checkpoint(checkpoint_path, checkpoint)
 
 
 class FlowLogsReader(BaseReader):
@@ -215,34 +910,186 @@ class FlowLogsReader(BaseReader):
     * `end_time` is a Python datetime.datetime object; only the log events
     before this time will be considered.
     * `filter_pattern` is a string passed to CloudWatch as a filter pattern
+    * `max_workers` - if given, the group's log streams are read separately,
+    with this many of them being read concurrently.
+    * `time_shards` - if given, the time range is split into this many equal
+    parts, which are read concurrently (by `max_workers` threads, or one per
+    part).
+    * `ordered` - if True, events from concurrently-read log streams are
+    merged in timestamp order, and time range parts are yielded one after
+    the other. Otherwise events are yielded as they arrive. Streams are
+    started in order of their first events, and more than `max_workers` are
+    only read at once when their time ranges overlap.
+    * `lazy` - if True, yield LazyFlowRecord objects, which only convert
+    the fields that are accessed.
+    * `message_filter` - a function that takes each raw log message and
+    returns whether to keep it. Messages are checked before being parsed.
+    * `filter_expression` - a string like "action == REJECT and bytes > 1e6"
+    that records must match (see FilterExpression). Messages are checked
+    before being parsed. If `filter_pattern` isn't changed, the parts of the
+    expression that CloudWatch Logs supports are also added to it.
+    * `stats` - a ReaderStats object in which to record requests, data sizes,
+    and timings. `progress_callback` is called with it about every
+    `progress_interval` seconds.
+    * `rate_limiter` - a RateLimiter (which may be shared with other readers)
+    through which to make requests. Throttled requests are retried up to
+    `max_retries` times.
+    * `client_factory` - a ClientFactory (which may be shared with other
+    readers) with which to make the boto3 client, re-using an existing one
+    when possible.
+    * `role_arn` and `external_id` - a role to assume for the client. Its
+    credentials are kept by the `client_factory` until they're about to
+    expire.
     * `boto_client_kwargs` - keyword arguments to pass to the boto3 client
     * `boto_client` - your own boto3 client object. If given then region_name,
     profile_name, and boto_client_kwargs will be ignored.
     """
 
     def __init__(
-        self, log_group_name, filter_pattern=DEFAULT_FILTER_PATTERN, **kwargs
+        self,
+        log_group_name,
+        filter_pattern=DEFAULT_FILTER_PATTERN,
+        max_workers=None,
+        time_shards=None,
+        ordered=False,
+        **kwargs
     ):
+        # The client's connection pool has room for each of the threads
+        kwargs.setdefault('max_pool_connections', max_workers or time_shards)
         super(FlowLogsReader, self).__init__('logs', **kwargs)
         self.log_group_name = log_group_name
+        self.max_workers = max_workers
+        self.time_shards = time_shards
+        self.ordered = ordered
 
         self.paginator_kwargs = {}
 
+        # Have CloudWatch Logs do as much of the filter expression's work as
+        # it can
+        if (
+            (self.filter_expression is not None) and
+            (filter_pattern == DEFAULT_FILTER_PATTERN)
+        ):
+            filter_pattern = (
+                self.filter_expression.to_filter_pattern(filter_pattern) or
+                filter_pattern
+            )
+
         if filter_pattern is not None:
             self.paginator_kwargs['filterPattern'] = filter_pattern
 
         self.start_ms = timegm(self.start_time.utctimetuple()) * 1000
         self.end_ms = timegm(self.end_time.utctimetuple()) * 1000
 
-    def _read_streams(self):
-        paginator = self.boto_client.get_paginator('filter_log_events')
-        response_iterator = paginator.paginate(
+    def _get_log_streams(self):
+        # Yield the log streams that have events in our time range
+        paginator = self.boto_client.get_paginator('describe_log_streams')
+        for page in paginator.paginate(logGroupName=self.log_group_name):
+            for stream in page['logStreams']:
+                if _is_stream_in_range(stream, self.start_ms, self.end_ms):
+                    yield stream
+
+    def _get_log_stream_names(self):
+        for stream in self._get_log_streams():
+            yield stream['logStreamName']
+
+    def _filter_log_events(self, kwargs):
+        return self.boto_client.filter_log_events(**kwargs)
+
+    def _read_log_streams(self):
+        # Each log stream gets its own filter_log_events query
+        def get_kwargs(stream):
+            return dict(
+                logGroupName=self.log_group_name,
+                logStreamNames=[stream['logStreamName']],
+                startTime=self.start_ms,
+                endTime=self.end_ms,
+                **self.paginator_kwargs
+            )
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            if self.ordered:
+                # Streams are started in the order of their first events,
+                # so that later ones can wait for earlier ones to finish
+                all_streams = sorted(
+                    self._get_log_streams(),
+                    key=lambda x: x['firstEventTimestamp'],
+                )
+                all_events = _iter_chains_merged(
+                    executor,
+                    self._filter_log_events,
+                    [(x['firstEventTimestamp'], get_kwargs(x))
+                     for x in all_streams],
+                    lambda event: event['timestamp'],
+                    self.max_workers,
+                )
+            else:
+                all_events = _iter_chains_unordered(
+                    executor,
+                    self._filter_log_events,
+                    (get_kwargs(x) for x in self._get_log_streams()),
+                    self.max_workers,
+                )
+
+            for event in all_events:
+                yield event
+
+    def _get_time_shards(self, shard_count):
+        # Split [start_ms, end_ms) into shard_count adjacent windows
+        duration_ms = self.end_ms - self.start_ms
+        boundaries = [
+            self.start_ms + (duration_ms * i) // shard_count
+            for i in range(shard_count + 1)
+        ]
+        return [
+            (shard_start, shard_end)
+            for shard_start, shard_end in zip(boundaries, boundaries[1:])
+            if shard_start < shard_end
+        ]
+
+    def _read_time_shards(self):
+        # Each part of the time range gets its own filter_log_events query
+        all_kwargs = [
+            dict(
+                logGroupName=self.log_group_name,
+                startTime=shard_start,
+                endTime=shard_end,
+                interleaved=True,
+                **self.paginator_kwargs
+            )
+            for shard_start, shard_end in self._get_time_shards(
+                self.time_shards
+            )
+        ]
+
+        max_workers = self.max_workers or len(all_kwargs) or 1
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            if self.ordered:
+                iter_chains = _iter_chains_in_order
+            else:
+                iter_chains = _iter_chains_unordered
+
+            all_events = iter_chains(
+                executor, self._filter_log_events, all_kwargs, max_workers
+            )
+            for event in all_events:
+                yield event
+
+    def _read_interleaved(self, start_ms=None, stream_names=None):
+        # One query for the whole group (or the given streams), from
+        # start_ms if it's given
+        kwargs = dict(
             logGroupName=self.log_group_name,
-            startTime=self.start_ms,
+            startTime=self.start_ms if start_ms is None else start_ms,
             endTime=self.end_ms,
             interleaved=True,
             **self.paginator_kwargs
         )
+        if stream_names is not None:
+            kwargs['logStreamNames'] = stream_names
+
+        paginator = self.boto_client.get_paginator('filter_log_events')
+        response_iterator = paginator.paginate(**kwargs)
 
         try:
             for page in response_iterator:
@@ -254,6 +1101,84 @@ class FlowLogsReader(BaseReader):
             else:
                 raise
 
+    def _get_new_streams(self, all_marks):
+        # Returns (start_ms, stream_name) for the log streams that may have
+        # new events: the ones without marks, and the ones that have had
+        # events since their marks. Marks for streams that haven't had any
+        # events since start_time are forgotten.
+        ret = []
+        all_names = set()
+        for stream in self._get_log_streams():
+            stream_name = stream['logStreamName']
+            all_names.add(stream_name)
+            mark = all_marks.get(stream_name)
+            if mark is None:
+                ret.append((self.start_ms, stream_name))
+            elif (
+                stream.get('lastIngestionTime', 0) > mark['ingestion_time']
+            ) or (stream.get('lastEventTimestamp', 0) > mark['timestamp']):
+                ret.append((mark['timestamp'], stream_name))
+
+        for stream_name in list(all_marks):
+            if stream_name not in all_names:
+                del all_marks[stream_name]
+
+        return ret
+
+    def _read_new_events(self, checkpoint):
+        # The checkpoint has a high-water mark for each log stream: the
+        # timestamp and ingestion time of the last event that was read, and
+        # the IDs of the events read at that timestamp. Each check only
+        # queries the streams that have new events, starting from their
+        # marks (or from start_time for streams without one).
+        self.start_ms = timegm(self.start_time.utctimetuple()) * 1000
+        self.end_ms = timegm(self.end_time.utctimetuple()) * 1000
+        all_marks = checkpoint.setdefault('streams', {})
+        all_streams = self._get_new_streams(all_marks)
+        if not all_streams:
+            return
+
+        if self.max_workers:
+            # Each stream gets its own query
+            all_kwargs = [
+                dict(
+                    logGroupName=self.log_group_name,
+                    logStreamNames=[stream_name],
+                    startTime=start_ms,
+                    endTime=self.end_ms,
+                    **self.paginator_kwargs
+                )
+                for start_ms, stream_name in all_streams
+            ]
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                all_events = _iter_chains_in_order(
+                    executor,
+                    self._filter_log_events,
+                    all_kwargs,
+                    self.max_workers,
+                )
+                for event in _iter_unread_events(all_events, all_marks):
+                    yield event
+            return
+
+        # Otherwise there's one query from the earliest mark, for just the
+        # streams with new events if there aren't too many to name
+        stream_names = [x[1] for x in all_streams]
+        if len(stream_names) > MAX_LOG_STREAM_NAMES:
+            stream_names = None
+        all_events = self._read_interleaved(min(all_streams)[0], stream_names)
+        for event in _iter_unread_events(all_events, all_marks):
+            yield event
+
+    def _read_streams(self):
+        if self.time_shards:
+            return self._read_time_shards()
+
+        if self.max_workers:
+            return self._read_log_streams()
+
+        return self._read_interleaved()
+
 
 class S3FlowLogsReader(BaseReader):
     def __init__(
@@ -261,8 +1186,14 @@ class S3FlowLogsReader(BaseReader):
         location,
         include_accounts=None,
         include_regions=None,
+        max_workers=None,
+        cache_dir=None,
+        cache_size=DEFAULT_CACHE_SIZE,
+        prefix_cache_ttl=None,
+        prefix_cache_path=None,
         **kwargs
     ):
+        kwargs.setdefault('max_pool_connections', max_workers)
         super(S3FlowLogsReader, self).__init__('s3', **kwargs)
 
         location_parts = (location.rstrip('/') + '/').split('/', 1)
@@ -274,62 +1205,131 @@ class S3FlowLogsReader(BaseReader):
         self.include_regions = (
             None if include_regions is None else set(include_regions)
         )
+        self.max_workers = max_workers
+
+        # Downloaded files are kept locally if a cache directory is given
+        self.cache = (
+            None if cache_dir is None else FileCache(cache_dir, cache_size)
+        )
+        # The account and region prefixes are remembered for this many
+        # seconds, if it's given - in memory, and also in a file if a path is
+        # given.
+        self.prefix_cache = (
+            None if prefix_cache_ttl is None
+            else PrefixCache(prefix_cache_ttl, prefix_cache_path)
+        )
+
+    def _read_lines(self, stream):
+        all_lines = _iter_gzip_lines(stream, stats=self.stats)
+
+        # Skip the header
+        next(all_lines, None)
+
+        # Yield the rest of the lines
+        for line in all_lines:
+            yield line.decode('utf-8')
+
+    def _read_file(self, key, etag=None):
+        # Files are cached by their ETag, so changed files are downloaded
+        # again.
+        use_cache = (self.cache is not None) and (etag is not None)
+        if use_cache:
+            cached_file = self.cache.open(self.bucket, key, etag)
+            if cached_file is not None:
+                with cached_file:
+                    for line in self._read_lines(cached_file):
+                        yield line
+                return
 
-    def _read_file(self, key):
         resp = self.boto_client.get_object(Bucket=self.bucket, Key=key)
-        with BytesIO(resp['Body'].read()) as f:
-            with GzipFile(fileobj=f, mode='rb') as gz_f:
-                # Skip the header
-                next(gz_f)
+        body = resp['Body']
+        writer = None
+        if use_cache:
+            writer = self.cache.writer(self.bucket, key, etag)
+        try:
+            stream = body if (writer is None) else writer.tee(body)
+            for line in self._read_lines(stream):
+                yield line
 
-                # Yield the rest of the lines
-                for line in gz_f:
-                    yield line.decode('utf-8')
+            # Only complete files are added to the cache
+            if writer is not None:
+                writer.commit()
+        finally:
+            if writer is not None:
+                writer.abort()
+            body.close()
+
+    def _read_file_lines(self, item):
+        # Used by the worker threads - the whole file is downloaded and
+        # decompressed before it's handed back.
+        return item, list(self._read_file(item['Key'], item.get('ETag')))
+
+    def _read_files(self, all_items):
+        # Yield (listing entry, lines) for each of the files
+        if self.max_workers:
+            # Download and decompress several files at once, but only keep a
+            # limited number of them in memory.
+            return _bounded_map(
+                self._read_file_lines, all_items, self.max_workers
+            )
+
+        return (
+            (item, self._read_file(item['Key'], item.get('ETag')))
+            for item in all_items
+        )
 
     def _get_keys(self, prefix):
-        # S3 keys have a file name like:
-        # account_vpcflowlogs_region_flow-logs-id_datetime_hash.log.gz
-        # Yield the keys for files relevant to our time range
-        paginator = self.boto_client.get_paginator('list_objects_v2')
-        all_pages = paginator.paginate(Bucket=self.bucket, Prefix=prefix)
-        for page in all_pages:
-            for item in page.get('Contents', []):
-                key = item['Key']
-                file_name = basename(key)
-                try:
-                    dt = datetime.strptime(
-                        file_name.rsplit('_', 2)[1], '%Y%m%dT%H%MZ'
-                    )
-                except (IndexError, ValueError):
-                    continue
+        # Yield the listing entries (which have the Key and ETag) for files
+        # relevant to our time range
+        start_stamp = _get_key_stamp(self.start_time)
+        end_stamp = _get_key_stamp(self.end_time)
+        kwargs = {'Bucket': self.bucket, 'Prefix': prefix}
+        while True:
+            response = self.boto_client.list_objects_v2(**kwargs)
+            all_items, start_after = _filter_key_page(
+                response.get('Contents', []),
+                start_stamp,
+                end_stamp,
+            )
+            for item in all_items:
+                yield item
+
+            if not response.get('IsTruncated'):
+                break
 
-                if self.start_time <= dt < self.end_time:
-                    yield key
+            kwargs = {'Bucket': self.bucket, 'Prefix': prefix}
+            if start_after is None:
+                kwargs['ContinuationToken'] = response['NextContinuationToken']
+            else:
+                kwargs['StartAfter'] = start_after
 
     def _get_date_prefixes(self):
-        # Each base_location/AWSLogs/account_number/vpcflowlogs/region_name/
-        # prefix has files organized in year/month/day directories.
-        # Yield the year/month/day/ fragments that are relevant to our
-        # time range
-        dtstart = self.start_time.replace(
-            hour=0, minute=0, second=0, microsecond=0
-        )
-        until = self.end_time.replace(
-            hour=0, minute=0, second=0, microsecond=0
+        return _get_date_prefixes(self.start_time, self.end_time)
+
+    def _list_prefixes(self, prefix):
+        # Return the "directories" directly below prefix
+        if self.prefix_cache is not None:
+            all_prefixes = self.prefix_cache.get(self.bucket, prefix)
+            if all_prefixes is not None:
+                return all_prefixes
+
+        all_prefixes = []
+        paginator = self.boto_client.get_paginator('list_objects_v2')
+        all_pages = paginator.paginate(
+            Bucket=self.bucket, Delimiter='/', Prefix=prefix
         )
-        for dt in rrule(freq=DAILY, dtstart=dtstart, until=until):
-            yield dt.strftime('%Y/%m/%d/')
+        for page in all_pages:
+            for item in page.get('CommonPrefixes', []):
+                all_prefixes.append(item['Prefix'])
+
+        if self.prefix_cache is not None:
+            self.prefix_cache.set(self.bucket, prefix, all_prefixes)
+        return all_prefixes
 
     def _get_region_prefixes(self, account_prefix):
         # Yield each prefix of the type:
         # base_location/AWSLogs/account_number/vpcflowlogs/region_name/
-        resp = self.boto_client.list_objects_v2(
-            Bucket=self.bucket,
-            Delimiter='/',
-            Prefix=account_prefix + 'vpcflowlogs/'
-        )
-        for item in resp.get('CommonPrefixes', []):
-            prefix = item['Prefix']
+        for prefix in self._list_prefixes(account_prefix + 'vpcflowlogs/'):
             if self.include_regions is not None:
                 region_name = prefix.rsplit('/', 2)[1]
                 if region_name not in self.include_regions:
@@ -342,11 +1342,7 @@ class S3FlowLogsReader(BaseReader):
         # base_location/AWSLogs/account_number/
         prefix = self.prefix.strip('/') + '/AWSLogs/'
         prefix = prefix.lstrip('/')
-        resp = self.boto_client.list_objects_v2(
-            Bucket=self.bucket, Delimiter='/', Prefix=prefix
-        )
-        for item in resp.get('CommonPrefixes', []):
-            prefix = item['Prefix']
+        for prefix in self._list_prefixes(prefix):
             if self.include_accounts is not None:
                 account_id = prefix.rsplit('/', 2)[1]
                 if account_id not in self.include_accounts:
@@ -354,11 +1350,151 @@ class S3FlowLogsReader(BaseReader):
 
             yield prefix
 
+    def _get_day_prefixes(self, account_prefix):
+        # Return each of the region/year/month/day/ prefixes for an account
+        return [
+            region_prefix + day_prefix
+            for region_prefix in self._get_region_prefixes(account_prefix)
+            for day_prefix in self._get_date_prefixes()
+        ]
+
+    def _get_keys_list(self, prefix):
+        # Used by the worker threads
+        return list(self._get_keys(prefix))
+
+    def _get_all_keys(self):
+        account_prefixes = self._get_account_prefixes()
+        if self.max_workers:
+            # List several accounts and then several days at once
+            all_prefixes = chain.from_iterable(
+                _bounded_map(
+                    self._get_day_prefixes, account_prefixes, self.max_workers
+                )
+            )
+            all_lists = _bounded_map(
+                self._get_keys_list, all_prefixes, self.max_workers
+            )
+        else:
+            all_prefixes = chain.from_iterable(
+                self._get_day_prefixes(x) for x in account_prefixes
+            )
+            all_lists = (self._get_keys(x) for x in all_prefixes)
+
+        for item in chain.from_iterable(all_lists):
+            yield item
+
+    def _read_new_events(self, checkpoint):
+        # The checkpoint has the keys of the files read in the time range,
+        # along with their timestamps. Each check lists the whole range, so
+        # that files which were delivered late are found, and skips the ones
+        # that were already read. Files from before the range are
+        # forgotten.
+        start_stamp = _get_key_stamp(self.start_time)
+        all_read = checkpoint.setdefault('keys', {})
+        for key, stamp in list(all_read.items()):
+            if stamp < start_stamp:
+                del all_read[key]
+
+        all_items = (
+            item for item in self._get_all_keys()
+            if item['Key'] not in all_read
+        )
+        for item, all_lines in self._read_files(all_items):
+            for message in all_lines:
+                yield {'message': message}
+
+            # The file only counts as read once all of its lines have been
+            # requested
+            all_read[item['Key']] = _split_key(item['Key'])[1]
+
     def _read_streams(self):
-        for account_prefix in self._get_account_prefixes():
-            for region_prefix in self._get_region_prefixes(account_prefix):
-                for day_prefix in self._get_date_prefixes():
-                    prefix = region_prefix + day_prefix
-                    for key in self._get_keys(prefix):
-                        for message in self._read_file(key):
-                            yield {'message': message}
+        all_files = self._read_files(self._get_all_keys())
+        for __, all_lines in all_files:
+            for message in all_lines:
+                yield {'message': message}
+
+
+class LocalFlowLogsReader(S3FlowLogsReader):
+    """
+    Like S3FlowLogsReader, but reads files from a local directory with the
+    same layout as an S3 location (e.g. one made with `aws s3 sync`):
+    `location`/AWSLogs/account_number/vpcflowlogs/region_name/YYYY/MM/DD/.
+    The same accounts, regions, and time range are considered.
+    * `max_workers` - if given, this many files are decompressed at once.
+    Uncompressed (i.e. .log) files are memory-mapped rather than read.
+    """
+    def __init__(self, location, **kwargs):
+        super(LocalFlowLogsReader, self).__init__(location, **kwargs)
+        # Keys are paths relative to the base directory
+        self.base_dir = location
+        self.bucket = None
+        self.prefix = ''
+
+    def _get_client(self, *args):
+        return None
+
+    def _get_path(self, key):
+        return os.path.join(self.base_dir, *key.split('/'))
+
+    def _list_dir(self, prefix):
+        # Returns the sorted names in the directory for prefix, or nothing
+        # if it doesn't exist
+        try:
+            return sorted(os.listdir(self._get_path(prefix)))
+        except OSError as e:
+            if e.errno == ENOENT:
+                return []
+            raise
+
+    def _list_prefixes(self, prefix):
+        # Return the directories directly below prefix
+        return [
+            prefix + name + '/'
+            for name in self._list_dir(prefix)
+            if os.path.isdir(self._get_path(prefix + name))
+        ]
+
+    def _get_keys(self, prefix):
+        # Yield entries (like S3's listing entries) for the files relevant to
+        # our time range
+        all_items = [
+            {'Key': prefix + name}
+            for name in self._list_dir(prefix)
+            if os.path.isfile(self._get_path(prefix + name))
+        ]
+        all_items, __ = _filter_key_page(
+            all_items,
+            _get_key_stamp(self.start_time),
+            _get_key_stamp(self.end_time),
+        )
+        for item in all_items:
+            yield item
+
+    def _read_mapped_lines(self, f):
+        # Empty files can't be mapped
+        if not os.fstat(f.fileno()).st_size:
+            return
+
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # Skip the header
+            mapped.readline()
+            while True:
+                line = mapped.readline()
+                if not line:
+                    break
+                line = line.rstrip(b'\n')
+                if line:
+                    yield line.decode('utf-8')
+        finally:
+            mapped.close()
+
+    def _read_file(self, key, etag=None):
+        with open(self._get_path(key), 'rb') as f:
+            if key.endswith('.gz'):
+                all_lines = self._read_lines(f)
+            else:
+                all_lines = self._read_mapped_lines(f)
+
+            for line in all_lines:
+                yield line
@@ -0,0 +1,213 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division, print_function
+
+from hashlib import sha1
+from heapq import heapify, heappop, heappush, nlargest
+from math import log
+from struct import unpack
+
+from .filters import _parse_ip
+
+DEFAULT_PRECISION = 14
+MIN_PRECISION = 4
+MAX_PRECISION = 18
+
+
+class HyperLogLog(object):
+    """
+    Estimates the number of distinct strings added to it, using 2 **
+    `precision` bytes of memory no matter how many there are. The standard
+    error is about 1.04 / sqrt(2 ** `precision`), so the default precision
+    of 14 gives estimates within about 1%.
+    Sketches with the same precision can be merged, e.g. to combine the
+    results of several processes.
+    """
+    def __init__(self, precision=DEFAULT_PRECISION):
+        if not (MIN_PRECISION <= precision <= MAX_PRECISION):
+            raise ValueError(
+                'precision must be between {} and {}'.format(
+                    MIN_PRECISION, MAX_PRECISION
+                )
+            )
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        # The first bits of a 64-bit hash pick the register, and the rest
+        # give the position of the first 1 bit
+        digest = sha1(value.encode('utf-8')).digest()
+        hashed = unpack('!Q', digest[:8])[0]
+        width = 64 - self.precision
+        index = hashed >> width
+        rank = width - (hashed & ((1 << width) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, all_values):
+        for value in all_values:
+            self.add(value)
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('only sketches of equal precision may be merged')
+
+        registers = self.registers
+        for i, rank in enumerate(other.registers):
+            if rank > registers[i]:
+                registers[i] = rank
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -x for x in self.registers)
+
+        # Linear counting is more accurate for small sets
+        # (bytearray.count doesn't take integers on Python 2)
+        zeros = sum(1 for x in self.registers if not x)
+        if zeros and (estimate <= 2.5 * m):
+            estimate = m * log(m / zeros)
+
+        return int(round(estimate))
+
+
+class IPCounter(object):
+    """
+    Counts distinct IP addresses exactly. Addresses are kept as integers
+    rather than strings, which takes less memory and treats different
+    spellings of the same IPv6 address as one. Strings that aren't
+    addresses (like '-') and None are ignored.
+    Has the same interface as HyperLogLog.
+    """
+    def __init__(self):
+        self.addresses = {32: set(), 128: set()}
+
+    def add(self, value):
+        parsed = None if (value is None) else _parse_ip(value)
+        if parsed is None:
+            return
+
+        bits, value = parsed
+        self.addresses[bits].add(value)
+
+    def update(self, all_values):
+        for value in all_values:
+            self.add(value)
+
+    def merge(self, other):
+        for bits, addresses in other.addresses.items():
+            self.addresses[bits].update(addresses)
+
+    def count(self):
+        return sum(len(x) for x in self.addresses.values())
+
+
+class SpaceSaving(object):
+    """
+    Finds the keys with the largest total weights in a stream (e.g. the
+    address pairs that sent the most bytes), keeping at most `capacity` keys
+    in memory. Each kept key's count is an overestimate by no more than its
+    error, which is at most (total weight) / `capacity`. Any key whose true
+    total is above that is guaranteed to be kept.
+    Summaries with the same capacity can be merged.
+    """
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        self.capacity = capacity
+        # Each key's [count, error]
+        self.counts = {}
+        # The (count, key) pairs for every key, by count. Counts here may be
+        # out of date; they're fixed when they come up as the minimum.
+        self.heap = []
+
+    def _pop_min(self):
+        counts = self.counts
+        heap = self.heap
+        while True:
+            count, key = heappop(heap)
+            current = counts[key][0]
+            if current == count:
+                return count, key
+            heappush(heap, (current, key))
+
+    def _min_count(self):
+        # Keys that aren't kept have counts no higher than this
+        if len(self.counts) < self.capacity:
+            return 0
+        count, key = self._pop_min()
+        heappush(self.heap, (count, key))
+        return count
+
+    def add(self, key, weight=1):
+        counts = self.counts
+        entry = counts.get(key)
+        if entry is not None:
+            entry[0] += weight
+            return
+
+        # When full, the key with the lowest count is replaced, and its count
+        # becomes the new key's error
+        if len(counts) < self.capacity:
+            error = 0
+        else:
+            error, min_key = self._pop_min()
+            del counts[min_key]
+        counts[key] = [error + weight, error]
+        heappush(self.heap, (error + weight, key))
+
+    def update(self, all_items):
+        # Add each of the (key, weight) pairs in all_items
+        for key, weight in all_items:
+            self.add(key, weight)
+
+    def merge(self, other):
+        if other.capacity != self.capacity:
+            raise ValueError(
+                'only summaries of equal capacity may be merged'
+            )
+
+        self_min = self._min_count()
+        other_min = other._min_count()
+        combined = {}
+        for key in set(self.counts).union(other.counts):
+            self_count, self_error = self.counts.get(key, (self_min, self_min))
+            other_count, other_error = other.counts.get(
+                key, (other_min, other_min)
+            )
+            combined[key] = [
+                self_count + other_count, self_error + other_error
+            ]
+
+        self.counts = dict(
+            nlargest(
+                self.capacity, combined.items(), key=lambda x: x[1][0]
+            )
+        )
+        self.heap = [(entry[0], key) for key, entry in self.counts.items()]
+        heapify(self.heap)
+
+    def top(self, k=None):
+        """
+        Returns (key, count, error) tuples for the `k` keys with the highest
+        counts (or all kept keys, if `k` is None), highest first.
+        """
+        all_items = sorted(
+            self.counts.items(), key=lambda x: x[1][0], reverse=True
+        )
+        if k is not None:
+            all_items = all_items[:k]
+
+        return [(key, count, error) for key, (count, error) in all_items]
@@ -0,0 +1,247 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division, print_function
+
+from threading import Lock
+from time import time
+
+# Counts and timings for each record are gathered locally and added to the
+# shared stats after this many records
+STATS_FLUSH_RECORDS = 1000
+
+# The client operations that are counted and timed
+INSTRUMENTED_OPERATIONS = frozenset(
+    [
+        'describe_log_streams',
+        'filter_log_events',
+        'get_object',
+        'list_objects_v2',
+    ]
+)
+
+MIB = 1024 * 1024
+
+
+class ReaderStats(object):
+    """
+    Counters and timings for a reader, which may be updated from several
+    threads:
+    * `api_calls` - the number of AWS API requests, and `operations`, a
+    dict with the number for each operation
+    * `pages` - the number of listing or event pages received
+    * `throttles` - the number of requests that were throttled and retried
+    * `bytes_downloaded` - the size of the S3 objects (or CloudWatch Logs
+    messages) received
+    * `bytes_decompressed` - the size of the decompressed S3 objects
+    * `events_read` - the number of log lines read, before filtering
+    * `records_parsed` - the number of records yielded; the difference is
+    `records_skipped`
+    * `network_time`, `decompress_time`, `parse_time` - the seconds spent
+    waiting for AWS, decompressing, and making records. These are totals
+    across threads, so they may add up to more than `elapsed`.
+    """
+    COUNTERS = (
+        'api_calls',
+        'pages',
+        'throttles',
+        'bytes_downloaded',
+        'bytes_decompressed',
+        'events_read',
+        'records_parsed',
+    )
+    TIMERS = ('network_time', 'decompress_time', 'parse_time')
+
+    def __init__(self):
+        self.lock = Lock()
+        self.start_time = time()
+        self.operations = {}
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        for name in self.TIMERS:
+            setattr(self, name, 0.0)
+
+    @property
+    def elapsed(self):
+        return time() - self.start_time
+
+    @property
+    def records_skipped(self):
+        return max(self.events_read - self.records_parsed, 0)
+
+    def add(self, **kwargs):
+        """
+        Adds the given amounts to the counters and timers, e.g.
+        `stats.add(pages=1, network_time=0.5)`.
+        """
+        with self.lock:
+            for name, value in kwargs.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def add_call(self, operation, seconds, pages=1, size=0):
+        # Records an API request (or the retrieval of one page of a
+        # paginated request)
+        with self.lock:
+            self.operations[operation] = self.operations.get(operation, 0) + 1
+            self.api_calls += 1
+            self.pages += pages
+            self.network_time += seconds
+            self.bytes_downloaded += size
+
+    def count_events(self, all_events):
+        """
+        Yields the items of `all_events`, adding to `events_read` as they
+        pass.
+        """
+        count = 0
+        try:
+            for event in all_events:
+                count += 1
+                if count == STATS_FLUSH_RECORDS:
+                    self.add(events_read=count)
+                    count = 0
+                yield event
+        finally:
+            self.add(events_read=count)
+
+    def to_dict(self):
+        with self.lock:
+            ret = {name: getattr(self, name) for name in self.COUNTERS}
+            ret.update((name, getattr(self, name)) for name in self.TIMERS)
+            ret['operations'] = self.operations.copy()
+        ret['records_skipped'] = max(
+            ret['events_read'] - ret['records_parsed'], 0
+        )
+        ret['elapsed'] = self.elapsed
+        return ret
+
+    def __str__(self):
+        data = self.to_dict()
+        elapsed = data['elapsed']
+        rate = (data['records_parsed'] / elapsed) if elapsed else 0
+        operations = ', '.join(
+            '{}: {}'.format(name, count)
+            for name, count in sorted(data['operations'].items())
+        )
+        lines = [
+            'elapsed: {:.1f} s'.format(elapsed),
+            'api calls: {}{}'.format(
+                data['api_calls'],
+                ' ({})'.format(operations) if operations else '',
+            ),
+            'pages: {}'.format(data['pages']),
+            'throttled: {}'.format(data['throttles']),
+            'downloaded: {:.1f} MiB'.format(data['bytes_downloaded'] / MIB),
+            'decompressed: {:.1f} MiB'.format(
+                data['bytes_decompressed'] / MIB
+            ),
+            'records: {} parsed ({:.0f}/s), {} skipped'.format(
+                data['records_parsed'], rate, data['records_skipped']
+            ),
+            'time: {:.1f} s network, {:.1f} s decompressing, '
+            '{:.1f} s parsing'.format(
+                data['network_time'],
+                data['decompress_time'],
+                data['parse_time'],
+            ),
+        ]
+        return '\n'.join(lines)
+
+
+class _InstrumentedBody(object):
+    # Wraps an S3 object's body, timing and counting the reads
+    def __init__(self, body, stats):
+        self.body = body
+        self.stats = stats
+
+    def read(self, *args):
+        start = time()
+        data = self.body.read(*args)
+        self.stats.add(
+            network_time=time() - start, bytes_downloaded=len(data)
+        )
+        return data
+
+    def close(self):
+        self.body.close()
+
+
+def _get_response_size(response):
+    # CloudWatch Logs responses are measured by their messages
+    return sum(len(x.get('message', '')) for x in response.get('events', []))
+
+
+class _InstrumentedPaginator(object):
+    def __init__(self, paginator, operation, stats):
+        self.paginator = paginator
+        self.operation = operation
+        self.stats = stats
+
+    def paginate(self, **kwargs):
+        all_pages = iter(self.paginator.paginate(**kwargs))
+        while True:
+            start = time()
+            try:
+                page = next(all_pages)
+            except StopIteration:
+                break
+            self.stats.add_call(
+                self.operation, time() - start, size=_get_response_size(page)
+            )
+            yield page
+
+
+class InstrumentedClient(object):
+    """
+    Wraps a boto3 client, recording the requests that the readers make in
+    `stats`. Other attributes are passed through.
+    """
+    def __init__(self, client, stats):
+        self.client = client
+        self.stats = stats
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name not in INSTRUMENTED_OPERATIONS:
+            return attr
+
+        stats = self.stats
+
+        def call(**kwargs):
+            start = time()
+            try:
+                response = attr(**kwargs)
+            except Exception:
+                # Failed requests count, but don't return anything
+                stats.add_call(name, time() - start, pages=0)
+                raise
+            seconds = time() - start
+            if name != 'get_object':
+                stats.add_call(
+                    name, seconds, size=_get_response_size(response)
+                )
+                return response
+
+            # S3 objects aren't pages, and their bodies are timed as they're
+            # read
+            stats.add_call(name, seconds, pages=0)
+            return dict(
+                response, Body=_InstrumentedBody(response['Body'], stats)
+            )
+
+        return call
+
+    def get_paginator(self, operation_name):
+        paginator = self.client.get_paginator(operation_name)
+        return _InstrumentedPaginator(paginator, operation_name, self.stats)
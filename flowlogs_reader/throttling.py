@@ -0,0 +1,292 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division, print_function
+
+from collections import deque
+from random import random
+from threading import Condition
+from time import sleep, time
+
+from botocore.exceptions import ClientError
+
+# Error codes that mean a request was refused because too many are being
+# made, and may be retried after a while
+THROTTLING_ERROR_CODES = frozenset(
+    [
+        'LimitExceededException',
+        'RequestLimitExceeded',
+        'RequestThrottled',
+        'RequestThrottledException',
+        'ServiceUnavailable',
+        'SlowDown',
+        'Throttling',
+        'ThrottlingException',
+        'TooManyRequestsException',
+    ]
+)
+
+# The parameter and response key with the next page's token for the
+# paginated operations that the readers use
+PAGE_TOKENS = {
+    'describe_log_streams': ('nextToken', 'nextToken'),
+    'filter_log_events': ('nextToken', 'nextToken'),
+    'list_objects_v2': ('ContinuationToken', 'NextContinuationToken'),
+}
+THROTTLED_OPERATIONS = frozenset(['get_object']).union(PAGE_TOKENS)
+
+DEFAULT_MAX_RETRIES = 8
+# Retries wait for a random time up to BACKOFF_BASE * 2 ** attempt seconds,
+# but not more than BACKOFF_MAX seconds
+BACKOFF_BASE = 0.1
+BACKOFF_MAX = 20.0
+
+DEFAULT_MIN_RATE = 0.5
+# Each second of successful requests raises the rate by this much
+DEFAULT_RATE_STEP = 1.0
+# Throttling multiplies the rate and concurrency by this much
+DEFAULT_DECREASE_FACTOR = 0.5
+# Recent requests are counted over this many seconds to estimate the rate
+# when none was set
+RATE_WINDOW = 1.0
+
+
+def _is_throttling_error(e):
+    if not isinstance(e, ClientError):
+        return False
+
+    return e.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+def _get_backoff(attempt):
+    # "Full jitter" - concurrent retries are spread out over the interval
+    return random() * min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt))
+
+
+class RateLimiter(object):
+    """
+    Limits the rate and concurrency of AWS requests, adapting both to
+    throttling: they're cut by `decrease_factor` when a request is
+    throttled, and raised a little after each successful one. A RateLimiter
+    may be shared by several readers (and their threads), so that together
+    they stay near the account's actual limits.
+    * `rate` is the number of requests per second to start with. If it's
+    None, requests aren't limited until one is throttled, and then the
+    rate is based on the recent number of requests.
+    * `max_rate` and `min_rate` bound the rate.
+    * `max_concurrency` is the most requests that may be in progress at
+    once. If it's None, they aren't limited until one is throttled.
+    * `rate_step` is how much each second of successful requests raises the
+    rate.
+    """
+    def __init__(
+        self,
+        rate=None,
+        max_rate=None,
+        min_rate=DEFAULT_MIN_RATE,
+        max_concurrency=None,
+        rate_step=DEFAULT_RATE_STEP,
+        decrease_factor=DEFAULT_DECREASE_FACTOR,
+    ):
+        self.condition = Condition()
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.concurrency = max_concurrency
+        self.max_concurrency = max_concurrency
+        self.rate_step = rate_step
+        self.decrease_factor = decrease_factor
+
+        # The token bucket holds up to one second's worth of requests
+        self.tokens = 1.0
+        self.last_refill = time()
+        self.active = 0
+        self.recent = deque()
+        self.last_decrease = 0.0
+
+    def _refill(self, now):
+        capacity = max(self.rate, 1.0)
+        self.tokens = min(
+            capacity, self.tokens + (now - self.last_refill) * self.rate
+        )
+        self.last_refill = now
+
+    def _prune(self, now):
+        while self.recent and (self.recent[0] < now - RATE_WINDOW):
+            self.recent.popleft()
+
+    def acquire(self):
+        """
+        Waits until a request may be made, and returns its start time, which
+        should be passed to `release` when it's done.
+        """
+        with self.condition:
+            while True:
+                now = time()
+                if (self.concurrency is not None) and (
+                    self.active >= int(self.concurrency)
+                ):
+                    self.condition.wait()
+                    continue
+
+                if self.rate is None:
+                    break
+
+                self._refill(now)
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    break
+
+                self.condition.wait((1.0 - self.tokens) / self.rate)
+
+            self.active += 1
+            self.recent.append(now)
+            self._prune(now)
+            return now
+
+    def release(self, start, throttled=False, succeeded=True):
+        """
+        Records that the request that started at `start` is done, and
+        whether it was throttled. Only requests that `succeeded` raise the
+        rate.
+        """
+        with self.condition:
+            self.active -= 1
+            if throttled:
+                # Requests that were already in progress at the last
+                # decrease don't count again
+                if start >= self.last_decrease:
+                    self._decrease()
+            elif succeeded:
+                self._increase()
+
+            self.condition.notify_all()
+
+    def _increase(self):
+        # Additive increase: the rate goes up by about rate_step each second,
+        # and the concurrency by about one for each round of requests
+        if self.rate is not None:
+            self.rate += self.rate_step / self.rate
+            if self.max_rate is not None:
+                self.rate = min(self.rate, self.max_rate)
+
+        if self.concurrency is not None:
+            self.concurrency += 1.0 / self.concurrency
+            if self.max_concurrency is not None:
+                self.concurrency = min(self.concurrency, self.max_concurrency)
+
+    def _decrease(self):
+        # Multiplicative decrease
+        now = time()
+        self.last_decrease = now
+        if self.rate is None:
+            self._prune(now)
+            self.rate = len(self.recent) / RATE_WINDOW
+            self.last_refill = now
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        if self.max_rate is not None:
+            self.rate = min(self.rate, self.max_rate)
+        self.tokens = min(self.tokens, 0.0)
+
+        # The request that was throttled has already been removed
+        concurrency = (
+            (self.active + 1) if self.concurrency is None
+            else self.concurrency
+        )
+        self.concurrency = max(1.0, concurrency * self.decrease_factor)
+
+
+class _ResumablePaginator(object):
+    # Follows the page tokens of `operation` itself, so that a throttled
+    # page is retried on its own rather than restarting from the first page
+    def __init__(self, operation, input_token, output_token):
+        self.operation = operation
+        self.input_token = input_token
+        self.output_token = output_token
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self.operation(**kwargs)
+            yield page
+
+            # CloudWatch Logs sometimes repeats the last token - that also
+            # means there's nothing left to retrieve.
+            next_token = page.get(self.output_token)
+            if (not next_token) or (
+                next_token == kwargs.get(self.input_token)
+            ):
+                break
+
+            kwargs = dict(kwargs)
+            kwargs[self.input_token] = next_token
+
+
+class ThrottledClient(object):
+    """
+    Wraps a boto3 client, making the readers' requests through
+    `rate_limiter` and retrying throttled ones (up to `max_retries` times,
+    with exponential backoff). Paginated requests are resumed from the page
+    that was throttled. If `stats` (a ReaderStats) is given, throttled
+    requests are counted. Other attributes are passed through.
+    """
+    def __init__(
+        self, client, rate_limiter, max_retries=DEFAULT_MAX_RETRIES, stats=None
+    ):
+        self.client = client
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.stats = stats
+
+    def _call(self, func, kwargs):
+        attempt = 0
+        while True:
+            start = self.rate_limiter.acquire()
+            throttled = False
+            succeeded = False
+            try:
+                response = func(**kwargs)
+                succeeded = True
+                return response
+            except ClientError as e:
+                throttled = _is_throttling_error(e)
+                if (not throttled) or (attempt >= self.max_retries):
+                    raise
+            finally:
+                self.rate_limiter.release(
+                    start, throttled=throttled, succeeded=succeeded
+                )
+
+            if self.stats is not None:
+                self.stats.add(throttles=1)
+            sleep(_get_backoff(attempt))
+            attempt += 1
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name not in THROTTLED_OPERATIONS:
+            return attr
+
+        def call(**kwargs):
+            return self._call(attr, kwargs)
+
+        return call
+
+    def get_paginator(self, operation_name):
+        if operation_name not in PAGE_TOKENS:
+            return self.client.get_paginator(operation_name)
+
+        input_token, output_token = PAGE_TOKENS[operation_name]
+        return _ResumablePaginator(
+            getattr(self, operation_name), input_token, output_token
+        )
@@ -49,13 +49,18 @@ setup(
         ],
     },
 
-    packages=find_packages(exclude=[]),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     test_suite='tests',
 
     install_requires=[
         'boto3>=1.7.75',
         'botocore>=1.10.75',
         'python-dateutil>=2.7.0'
-    ],
+    ] + (['futures>=3.2.0'] if PY2 else []),
+    extras_require={
+        'numpy': ['numpy>=1.9.0'],
+        'arrow': ['pyarrow>=0.17.0'],
+        'aio': ['aiobotocore>=0.10.0; python_version >= "3.6"'],
+    },
     tests_require=['mock'] if PY2 else [],
 )
@@ -0,0 +1,305 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division, print_function
+
+from datetime import datetime
+from io import BytesIO
+from unittest import skipIf, TestCase
+
+from botocore.exceptions import ClientError
+
+try:
+    from unittest.mock import MagicMock, patch
+except ImportError:
+    from mock import MagicMock, patch
+
+# The asyncio readers need Python 3.6+
+try:
+    import asyncio
+    from flowlogs_reader.aio import AsyncFlowLogsReader, AsyncS3FlowLogsReader
+except (ImportError, SyntaxError):
+    asyncio = None
+
+from flowlogs_reader import FlowRecord, RateLimiter
+
+from .test_flowlogs_reader import compress, SAMPLE_RECORDS
+
+
+def _resolved(value):
+    # Stands in for the coroutines that aiobotocore clients return
+    future = asyncio.Future()
+    future.set_result(value)
+    return future
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def _read_all(reader):
+    # Equivalent to [x async for x in reader]
+    async_iter = reader.__aiter__()
+    ret = []
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                ret.append(loop.run_until_complete(async_iter.__anext__()))
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.close()
+
+    return ret
+
+
+class _Body(object):
+    def __init__(self, data):
+        self.stream = BytesIO(data)
+        self.closed = False
+
+    def read(self, size):
+        # Give back small pieces to exercise the decoder
+        return _resolved(self.stream.read(min(size, 16)))
+
+    def close(self):
+        self.closed = True
+
+
+@skipIf(asyncio is None, 'asyncio readers are not supported')
+class AsyncFlowLogsReaderTestCase(TestCase):
+    def setUp(self):
+        self.mock_client = MagicMock()
+        self.start_time = datetime(2015, 8, 12, 12, 0, 0)
+        self.end_time = datetime(2015, 8, 12, 13, 0, 0)
+
+    def test_iteration(self):
+        # The duplicated next token ends the query
+        all_responses = [
+            {'events': [{'message': SAMPLE_RECORDS[0]}], 'nextToken': 'a'},
+            {'events': [{'message': SAMPLE_RECORDS[1]}], 'nextToken': 'b'},
+            {'events': [{'message': SAMPLE_RECORDS[2]}], 'nextToken': 'b'},
+        ]
+        self.mock_client.filter_log_events.side_effect = [
+            _resolved(x) for x in all_responses
+        ]
+        reader = AsyncFlowLogsReader(
+            'group_name',
+            start_time=self.start_time,
+            end_time=self.end_time,
+            filter_pattern='REJECT',
+            boto_client=self.mock_client,
+        )
+        actual = _read_all(reader)
+        expected = [FlowRecord.from_message(x) for x in SAMPLE_RECORDS[:3]]
+        self.assertEqual(actual, expected)
+
+        self.assertEqual(
+            [x[2].get('nextToken') for x in self.mock_client.mock_calls],
+            [None, 'a', 'b'],
+        )
+        self.assertEqual(
+            self.mock_client.mock_calls[0][2],
+            {
+                'logGroupName': 'group_name',
+                'startTime': 1439380800000,
+                'endTime': 1439384400000,
+                'interleaved': True,
+                'filterPattern': 'REJECT',
+            },
+        )
+
+    def test_iteration_concurrent(self):
+        # Three log streams (plus an empty one) with a page or two each
+        stream_pages = {
+            'stream_1': [[SAMPLE_RECORDS[0]], [SAMPLE_RECORDS[1]]],
+            'stream_2': [[SAMPLE_RECORDS[2], SAMPLE_RECORDS[3]]],
+            'stream_3': [[SAMPLE_RECORDS[4]]],
+        }
+
+        def describe_log_streams(**kwargs):
+            all_streams = [
+                {
+                    'logStreamName': stream_name,
+                    'firstEventTimestamp': 1439380800000,
+                    'lastEventTimestamp': 1439384400000,
+                }
+                for stream_name in sorted(stream_pages)
+            ]
+            all_streams.append({'logStreamName': 'stream_4'})
+            return _resolved({'logStreams': all_streams})
+
+        def filter_log_events(**kwargs):
+            stream_name = kwargs['logStreamNames'][0]
+            page_number = kwargs.get('nextToken', 0)
+            pages = stream_pages[stream_name]
+            response = {
+                'events': [{'message': x} for x in pages[page_number]]
+            }
+            if page_number + 1 < len(pages):
+                response['nextToken'] = page_number + 1
+            return _resolved(response)
+
+        self.mock_client.describe_log_streams.side_effect = (
+            describe_log_streams
+        )
+        self.mock_client.filter_log_events.side_effect = filter_log_events
+        reader = AsyncFlowLogsReader(
+            'group_name',
+            start_time=self.start_time,
+            end_time=self.end_time,
+            max_concurrency=2,
+            boto_client=self.mock_client,
+        )
+        actual = sorted(x.to_message() for x in _read_all(reader))
+        expected = sorted(
+            FlowRecord.from_message(x).to_message() for x in SAMPLE_RECORDS
+        )
+        self.assertEqual(actual, expected)
+        self.assertEqual(self.mock_client.filter_log_events.call_count, 4)
+
+    def test_iteration_error(self):
+        self.mock_client.describe_log_streams.return_value = _resolved(
+            {
+                'logStreams': [
+                    {
+                        'logStreamName': 'stream_1',
+                        'firstEventTimestamp': 1439380800000,
+                        'lastEventTimestamp': 1439384400000,
+                    }
+                ]
+            }
+        )
+        self.mock_client.filter_log_events.side_effect = ValueError
+        reader = AsyncFlowLogsReader(
+            'group_name',
+            start_time=self.start_time,
+            end_time=self.end_time,
+            max_concurrency=2,
+            boto_client=self.mock_client,
+        )
+        with self.assertRaises(ValueError):
+            _read_all(reader)
+
+    @patch('flowlogs_reader.aio.asyncio.sleep', autospec=True)
+    def test_rate_limiter(self, mock_sleep):
+        mock_sleep.side_effect = lambda seconds: _resolved(None)
+        throttled = ClientError(
+            {'Error': {'Code': 'ThrottlingException', 'Message': 'Error'}},
+            'FilterLogEvents',
+        )
+        all_responses = [
+            {'events': [{'message': SAMPLE_RECORDS[0]}], 'nextToken': 'a'},
+            {'events': [{'message': SAMPLE_RECORDS[1]}]},
+        ]
+        self.mock_client.filter_log_events.side_effect = [
+            _resolved(all_responses[0]),
+            throttled,
+            _resolved(all_responses[1]),
+        ]
+        rate_limiter = RateLimiter(min_rate=1000)
+        reader = AsyncFlowLogsReader(
+            'group_name',
+            start_time=self.start_time,
+            end_time=self.end_time,
+            boto_client=self.mock_client,
+            rate_limiter=rate_limiter,
+        )
+
+        # The throttled page is retried, and the limiter slows down
+        actual = _read_all(reader)
+        expected = [FlowRecord.from_message(x) for x in SAMPLE_RECORDS[:2]]
+        self.assertEqual(actual, expected)
+        self.assertEqual(
+            [x[2].get('nextToken') for x in self.mock_client.mock_calls],
+            [None, 'a', 'a'],
+        )
+        self.assertEqual(mock_sleep.call_count, 1)
+        self.assertEqual(rate_limiter.active, 0)
+        self.assertGreaterEqual(rate_limiter.rate, 1000)
+
+        # Other attributes are passed through
+        self.assertIs(reader.boto_client.meta, self.mock_client.meta)
+
+    @patch('flowlogs_reader.aio.get_session', None)
+    def test_no_aiobotocore(self):
+        reader = AsyncFlowLogsReader('group_name')
+        with self.assertRaises(RuntimeError):
+            _run(reader.__aenter__())
+
+
+@skipIf(asyncio is None, 'asyncio readers are not supported')
+class AsyncS3FlowLogsReaderTestCase(TestCase):
+    def test_iteration(self):
+        # Two accounts, one of which is excluded, and one region. Each file
+        # has a header and one record.
+        header = ' '.join(FlowRecord.__slots__)
+        region_prefix = 'AWSLogs/123456789010/vpcflowlogs/pangaea-1/'
+        day_prefix = region_prefix + '2015/08/12/'
+        all_files = {}
+        for i, message in enumerate(SAMPLE_RECORDS):
+            key = (
+                '{}123456789010_vpcflowlogs_pangaea-1_fl-102010_'
+                '20150812T12{:02}Z_h45h.log.gz'
+            ).format(day_prefix, i * 5)
+            all_files[key] = compress('\n'.join([header, message]))
+
+        def list_objects_v2(**kwargs):
+            self.assertEqual(kwargs['Bucket'], 'example-bucket')
+            prefix = kwargs['Prefix']
+            if prefix == 'AWSLogs/':
+                response = {
+                    'CommonPrefixes': [
+                        {'Prefix': 'AWSLogs/123456789010/'},
+                        {'Prefix': 'AWSLogs/123456789011/'},
+                    ]
+                }
+            elif prefix == 'AWSLogs/123456789010/vpcflowlogs/':
+                response = {'CommonPrefixes': [{'Prefix': region_prefix}]}
+            elif prefix == day_prefix:
+                response = {'Contents': [{'Key': x} for x in all_files]}
+            else:
+                raise AssertionError(prefix)
+            return _resolved(response)
+
+        all_bodies = []
+
+        def get_object(**kwargs):
+            body = _Body(all_files[kwargs['Key']])
+            all_bodies.append(body)
+            return _resolved({'Body': body})
+
+        mock_client = MagicMock()
+        mock_client.list_objects_v2.side_effect = list_objects_v2
+        mock_client.get_object.side_effect = get_object
+        reader = AsyncS3FlowLogsReader(
+            'example-bucket',
+            start_time=datetime(2015, 8, 12, 12, 0, 0),
+            end_time=datetime(2015, 8, 12, 13, 0, 0),
+            include_accounts=['123456789010'],
+            max_concurrency=2,
+            boto_client=mock_client,
+        )
+
+        # Records come back in key order
+        actual = _read_all(reader)
+        expected = [FlowRecord.from_message(x) for x in SAMPLE_RECORDS]
+        self.assertEqual(actual, expected)
+        self.assertEqual(len(all_bodies), len(SAMPLE_RECORDS))
+        self.assertTrue(all(x.closed for x in all_bodies))
@@ -0,0 +1,112 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division, print_function
+
+from unittest import skipIf, TestCase
+
+from benchmarks.fakes import FakeS3Client
+from benchmarks.run import (
+    benchmarks,
+    BenchmarkData,
+    get_benchmark,
+    run_benchmark,
+)
+from benchmarks.synthetic import SyntheticFlowLogs
+from flowlogs_reader import FlowRecord
+from flowlogs_reader.columnar import np
+
+
+class BenchmarksTestCase(TestCase):
+    # Keeps the benchmarks working; it doesn't measure anything
+    def setUp(self):
+        self.synthetic = SyntheticFlowLogs(
+            500, accounts=2, interfaces=10, ips=50, ms_ratio=0.1
+        )
+        self.data = BenchmarkData(self.synthetic)
+
+    def tearDown(self):
+        self.data.close()
+
+    def test_synthetic(self):
+        all_records = [
+            FlowRecord.from_message(x) for x in self.synthetic.messages
+        ]
+        self.assertEqual(len(all_records), 500)
+        self.assertEqual(len(set(x.account_id for x in all_records)), 2)
+        self.assertLessEqual(len(set(x.interface_id for x in all_records)), 10)
+        self.assertEqual(
+            all_records, sorted(all_records, key=lambda x: x.end)
+        )
+
+        # The same seed gives the same records
+        other = SyntheticFlowLogs(
+            500, accounts=2, interfaces=10, ips=50, ms_ratio=0.1
+        )
+        self.assertEqual(other.messages, self.synthetic.messages)
+
+    def test_fake_s3_client(self):
+        client = FakeS3Client({'a/1': b'', 'a/2': b'', 'b/1/x': b''})
+        response = client.list_objects_v2(
+            Bucket='bucket', Delimiter='/', MaxKeys=1
+        )
+        self.assertEqual(response['CommonPrefixes'], [{'Prefix': 'a/'}])
+        response = client.list_objects_v2(
+            Bucket='bucket',
+            Delimiter='/',
+            ContinuationToken=response['NextContinuationToken'],
+        )
+        self.assertEqual(response['CommonPrefixes'], [{'Prefix': 'b/'}])
+        self.assertFalse(response['IsTruncated'])
+
+        response = client.list_objects_v2(
+            Bucket='bucket', Prefix='a/', StartAfter='a/1'
+        )
+        self.assertEqual([x['Key'] for x in response['Contents']], ['a/2'])
+
+    def test_benchmarks(self):
+        for name, func, requires_numpy in benchmarks:
+            if requires_numpy and (np is None):
+                continue
+            result = run_benchmark(func, self.data)
+            expected = 0 if (name == 'baseline') else 500
+            self.assertEqual(result['records'], expected, name)
+
+
+@skipIf(np is None, 'NumPy is not installed')
+class ColumnarBenchmarksTestCase(TestCase):
+    # The columnar versions are only worth having if they're quicker
+    @classmethod
+    def setUpClass(cls):
+        cls.data = BenchmarkData(SyntheticFlowLogs(50000))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.data.close()
+
+    def _get_seconds(self, name):
+        # The best of a few runs, to smooth out noise
+        func = get_benchmark(name)
+        return min(run_benchmark(func, self.data)['seconds'] for i in range(3))
+
+    def test_iter_batches(self):
+        self.assertLess(
+            self._get_seconds('iter_batches'), self._get_seconds('parse')
+        )
+
+    def test_aggregated_batches(self):
+        self.assertLess(
+            self._get_seconds('aggregated_batches'),
+            self._get_seconds('aggregated_records'),
+        )
@@ -0,0 +1,161 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division, print_function
+
+import os
+from datetime import datetime
+from io import BytesIO
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+try:
+    from unittest.mock import MagicMock, patch
+except ImportError:
+    from mock import MagicMock, patch
+
+from flowlogs_reader import FlowRecord, S3FlowLogsReader
+from flowlogs_reader.cache import FileCache
+
+from .test_flowlogs_reader import compress, SAMPLE_RECORDS
+
+
+class FileCacheTestCase(TestCase):
+    def setUp(self):
+        self.cache_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.cache_dir)
+
+    def _add(self, cache, data, *parts):
+        writer = cache.writer(*parts)
+        writer.write(data)
+        writer.commit()
+
+    def test_open(self):
+        cache = FileCache(self.cache_dir, max_size=100)
+        self.assertIsNone(cache.open('bucket', 'key', 'etag'))
+
+        self._add(cache, b'data', 'bucket', 'key', 'etag')
+        with cache.open('bucket', 'key', 'etag') as f:
+            self.assertEqual(f.read(), b'data')
+
+        # Different parts are different entries
+        self.assertIsNone(cache.open('bucket', 'key', 'other-etag'))
+
+        # Entries persist between instances
+        cache = FileCache(self.cache_dir, max_size=100)
+        self.assertEqual(cache.total_size, 4)
+        with cache.open('bucket', 'key', 'etag') as f:
+            self.assertEqual(f.read(), b'data')
+
+    def test_abort(self):
+        cache = FileCache(self.cache_dir, max_size=100)
+        writer = cache.writer('bucket', 'key', 'etag')
+        writer.write(b'data')
+        writer.abort()
+        writer.commit()
+
+        self.assertIsNone(cache.open('bucket', 'key', 'etag'))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_tee(self):
+        cache = FileCache(self.cache_dir, max_size=100)
+        writer = cache.writer('bucket', 'key', 'etag')
+        stream = writer.tee(BytesIO(b'some data'))
+        self.assertEqual(stream.read(4), b'some')
+        self.assertEqual(stream.read(), b' data')
+        writer.commit()
+
+        with cache.open('bucket', 'key', 'etag') as f:
+            self.assertEqual(f.read(), b'some data')
+
+    def test_eviction(self):
+        cache = FileCache(self.cache_dir, max_size=10)
+        self._add(cache, b'1234', 'key_1')
+        self._add(cache, b'1234', 'key_2')
+
+        # Make key_1 the most recently used
+        for i, key in enumerate(['key_2', 'key_1']):
+            path = cache._get_path([key])
+            os.utime(path, (1000 + i, 1000 + i))
+
+        # Adding a third entry evicts key_2
+        self._add(cache, b'1234', 'key_3')
+        self.assertIsNone(cache.open('key_2'))
+        self.assertIsNotNone(cache.open('key_1'))
+        self.assertIsNotNone(cache.open('key_3'))
+        self.assertEqual(cache.total_size, 8)
+
+        # Entries that are too big aren't stored
+        self._add(cache, b'12345678901', 'key_4')
+        self.assertIsNone(cache.open('key_4'))
+        self.assertEqual(cache.total_size, 8)
+
+
+class S3CacheTestCase(TestCase):
+    def setUp(self):
+        self.cache_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.cache_dir)
+
+    def test_read_file(self):
+        header = ' '.join(FlowRecord.__slots__)
+        data = compress('\n'.join([header] + SAMPLE_RECORDS))
+        mock_client = MagicMock()
+        mock_client.get_object.side_effect = lambda **kwargs: {
+            'Body': BytesIO(data)
+        }
+
+        def read_all(etag):
+            reader = S3FlowLogsReader(
+                'example-bucket',
+                start_time=datetime(2015, 8, 12, 12, 0, 0),
+                end_time=datetime(2015, 8, 12, 13, 0, 0),
+                cache_dir=self.cache_dir,
+                boto_client=mock_client,
+            )
+            all_items = [{'Key': 'key_1', 'ETag': etag}]
+            with patch.object(reader, '_get_all_keys', return_value=all_items):
+                return list(reader)
+
+        expected = [FlowRecord.from_message(x) for x in SAMPLE_RECORDS]
+
+        # The first read downloads the file; the second one doesn't
+        self.assertEqual(read_all('"etag_1"'), expected)
+        self.assertEqual(read_all('"etag_1"'), expected)
+        self.assertEqual(mock_client.get_object.call_count, 1)
+
+        # A changed file is downloaded again
+        self.assertEqual(read_all('"etag_2"'), expected)
+        self.assertEqual(mock_client.get_object.call_count, 2)
+
+    def test_read_file_partial(self):
+        header = ' '.join(FlowRecord.__slots__)
+        data = compress('\n'.join([header] + SAMPLE_RECORDS))
+        mock_client = MagicMock()
+        mock_client.get_object.return_value = {'Body': BytesIO(data)}
+        reader = S3FlowLogsReader(
+            'example-bucket',
+            cache_dir=self.cache_dir,
+            boto_client=mock_client,
+        )
+
+        # Files that aren't read completely aren't cached
+        all_lines = reader._read_file('key_1', '"etag_1"')
+        next(all_lines)
+        all_lines.close()
+        self.assertEqual(os.listdir(self.cache_dir), [])
@@ -0,0 +1,212 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division, print_function
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from botocore.config import Config
+from botocore.exceptions import NoRegionError
+
+try:
+    from unittest.mock import MagicMock, patch
+except ImportError:
+    from mock import MagicMock, patch
+
+from flowlogs_reader import ClientFactory, FlowLogsReader, S3FlowLogsReader
+from flowlogs_reader.clients import DEFAULT_REGION_NAME
+
+
+def _get_credentials(expiration):
+    return {
+        'Credentials': {
+            'AccessKeyId': 'myaccesskeyid',
+            'SecretAccessKey': 'mysecretaccesskey',
+            'SessionToken': 'mysessiontoken',
+            'Expiration': expiration,
+        }
+    }
+
+
+@patch('flowlogs_reader.clients.boto3', autospec=True)
+class ClientFactoryTestCase(TestCase):
+    def setUp(self):
+        self.all_sessions = []
+
+    def _make_session(self, **kwargs):
+        # Each session makes new clients
+        session = MagicMock()
+        session.client.side_effect = lambda *args, **kwargs: MagicMock()
+        self.all_sessions.append((kwargs, session))
+        return session
+
+    def test_get_client(self, mock_boto3):
+        mock_boto3.session.Session.side_effect = self._make_session
+        client_factory = ClientFactory()
+
+        # Clients are re-used
+        client = client_factory.get_client('logs', region_name='pangaea-1')
+        self.assertIs(
+            client_factory.get_client('logs', region_name='pangaea-1'),
+            client
+        )
+        self.assertEqual(len(self.all_sessions), 1)
+        session = self.all_sessions[0][1]
+        __, kwargs = session.client.call_args
+        self.assertEqual(kwargs['region_name'], 'pangaea-1')
+        self.assertEqual(kwargs['config'].max_pool_connections, 10)
+
+        # Other regions and types get their own, from the same session
+        self.assertIsNot(
+            client_factory.get_client('logs', region_name='pangaea-2'),
+            client
+        )
+        self.assertIsNot(
+            client_factory.get_client('s3', region_name='pangaea-1'), client
+        )
+        self.assertEqual(len(self.all_sessions), 1)
+
+        # A client with a bigger connection pool replaces the old one
+        bigger_client = client_factory.get_client(
+            'logs', region_name='pangaea-1', max_pool_connections=32
+        )
+        self.assertIsNot(bigger_client, client)
+        __, kwargs = session.client.call_args
+        self.assertEqual(kwargs['config'].max_pool_connections, 32)
+        self.assertIs(
+            client_factory.get_client('logs', region_name='pangaea-1'),
+            bigger_client
+        )
+
+        # Clients with custom settings aren't kept, but the given config
+        # takes precedence
+        custom_kwargs = {'config': Config(max_pool_connections=4)}
+        self.assertIsNot(
+            client_factory.get_client(
+                'logs', region_name='pangaea-1', client_kwargs=custom_kwargs
+            ),
+            bigger_client
+        )
+        __, kwargs = session.client.call_args
+        self.assertEqual(kwargs['config'].max_pool_connections, 4)
+
+        # Profiles get their own sessions
+        client_factory.get_client('logs', profile_name='my-profile')
+        self.assertEqual(
+            self.all_sessions[1][0], {'profile_name': 'my-profile'}
+        )
+
+    def test_default_region(self, mock_boto3):
+        def mock_client(*args, **kwargs):
+            if 'region_name' not in kwargs:
+                raise NoRegionError
+            return MagicMock()
+
+        mock_boto3.session.Session.return_value.client.side_effect = (
+            mock_client
+        )
+        ClientFactory().get_client('logs')
+        __, kwargs = mock_boto3.session.Session.return_value.client.call_args
+        self.assertEqual(kwargs['region_name'], DEFAULT_REGION_NAME)
+
+    def test_assume_role(self, mock_boto3):
+        mock_boto3.session.Session.side_effect = self._make_session
+        client_factory = ClientFactory()
+        sts_client = client_factory.get_client('sts')
+        sts_client.assume_role.return_value = _get_credentials(
+            datetime.utcnow() + timedelta(hours=1)
+        )
+
+        # The role's session is re-used
+        client = client_factory.get_client(
+            'logs', role_arn='myarn', external_id='uuid4'
+        )
+        self.assertIs(
+            client_factory.get_client(
+                'logs', role_arn='myarn', external_id='uuid4'
+            ),
+            client
+        )
+        self.assertEqual(len(self.all_sessions), 2)
+
+        # The role is assumed when its credentials are needed
+        botocore_session = self.all_sessions[1][0]['botocore_session']
+        credentials = botocore_session.get_credentials()
+        frozen = credentials.get_frozen_credentials()
+        self.assertEqual(frozen.access_key, 'myaccesskeyid')
+        self.assertEqual(frozen.secret_key, 'mysecretaccesskey')
+        self.assertEqual(frozen.token, 'mysessiontoken')
+        credentials.get_frozen_credentials()
+        self.assertEqual(sts_client.assume_role.call_count, 1)
+        __, kwargs = sts_client.assume_role.call_args
+        self.assertEqual(kwargs['RoleArn'], 'myarn')
+        self.assertEqual(kwargs['ExternalId'], 'uuid4')
+
+        # Credentials that are about to expire are renewed, without
+        # replacing the session or its clients
+        sts_client.assume_role.return_value = _get_credentials(
+            datetime.utcnow() + timedelta(minutes=1)
+        )
+        client = client_factory.get_client('s3', role_arn='other-arn')
+        botocore_session = self.all_sessions[2][0]['botocore_session']
+        credentials = botocore_session.get_credentials()
+        self.assertEqual(sts_client.assume_role.call_count, 2)
+        credentials.get_frozen_credentials()
+        self.assertEqual(sts_client.assume_role.call_count, 3)
+        self.assertIs(
+            client_factory.get_client('s3', role_arn='other-arn'), client
+        )
+        self.assertEqual(len(self.all_sessions), 3)
+
+    def test_readers(self, mock_boto3):
+        mock_boto3.session.Session.side_effect = self._make_session
+        client_factory = ClientFactory()
+
+        # Readers share clients, and their pools fit their threads
+        first_reader = FlowLogsReader(
+            'group_name', client_factory=client_factory, max_workers=16
+        )
+        second_reader = FlowLogsReader(
+            'group_name', client_factory=client_factory
+        )
+        self.assertIs(first_reader.boto_client, second_reader.boto_client)
+        session = self.all_sessions[0][1]
+        __, kwargs = session.client.call_args
+        self.assertEqual(kwargs['config'].max_pool_connections, 16)
+
+        s3_reader = S3FlowLogsReader(
+            'bucket', client_factory=client_factory, max_workers=4
+        )
+        args, kwargs = session.client.call_args
+        self.assertEqual(args, ('s3',))
+        self.assertEqual(kwargs['config'].max_pool_connections, 10)
+        self.assertIsNot(s3_reader.boto_client, first_reader.boto_client)
+
+    @patch('flowlogs_reader.flowlogs_reader.boto3', autospec=True)
+    def test_readers_without_factory(self, mock_reader_boto3, mock_boto3):
+        # Readers that make their own clients also size their pools
+        FlowLogsReader('group_name', max_workers=32)
+        session = mock_reader_boto3.session.Session.return_value
+        __, kwargs = session.client.call_args
+        self.assertEqual(kwargs['config'].max_pool_connections, 32)
+
+        # A given config takes precedence
+        S3FlowLogsReader(
+            'bucket',
+            max_workers=16,
+            boto_client_kwargs={'config': Config(max_pool_connections=4)},
+        )
+        __, kwargs = session.client.call_args
+        self.assertEqual(kwargs['config'].max_pool_connections, 4)
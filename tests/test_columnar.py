@@ -0,0 +1,229 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division, print_function
+
+from unittest import skipIf, TestCase
+
+try:
+    from unittest.mock import MagicMock
+except ImportError:
+    from mock import MagicMock
+
+from flowlogs_reader import (
+    aggregated_batches,
+    aggregated_records,
+    FlowBatch,
+    FlowLogsReader,
+    FlowRecord,
+)
+from flowlogs_reader.columnar import (
+    ACTIONS,
+    int_to_ip,
+    ip_to_int,
+    iter_batches,
+    LOG_STATUSES,
+    np,
+)
+
+from .test_flowlogs_reader import SAMPLE_RECORDS
+
+IPV6_RECORD = (
+    '2 123456789010 eni-102010ab 2001:db8::1 2001:db8::2 '
+    '443 49152 6 10 840 1439387263 1439387264 ACCEPT OK'
+)
+
+
+@skipIf(np is None, 'NumPy is not installed')
+class FlowBatchTestCase(TestCase):
+    def test_from_messages(self):
+        batch = FlowBatch.from_messages(SAMPLE_RECORDS + [IPV6_RECORD])
+        self.assertEqual(len(batch), len(SAMPLE_RECORDS))
+        self.assertEqual(batch.unsupported, [IPV6_RECORD])
+
+        self.assertEqual(batch['version'].tolist(), [2, 2, 2, 2, 2])
+        self.assertEqual(batch['account_id'][0], '123456789010')
+        self.assertEqual(
+            batch['interface_id'].tolist(),
+            [
+                'eni-102010ab',
+                'eni-102010ab',
+                'eni-102010cd',
+                'eni-1a2b3c4d',
+                'eni-4b118871',
+            ]
+        )
+        self.assertEqual(
+            [int_to_ip(x) for x in batch['srcaddr']],
+            [
+                '198.51.100.1',
+                '192.0.2.1',
+                '192.0.2.1',
+                '0.0.0.0',
+                '0.0.0.0',
+            ]
+        )
+        self.assertEqual(batch['srcport'].tolist(), [443, 49152, 49152, 0, 0])
+        self.assertEqual(batch['dstport'].tolist(), [49152, 443, 443, 0, 0])
+        self.assertEqual(batch['protocol'].tolist(), [6, 6, 6, 0, 0])
+        self.assertEqual(batch['packets'].tolist(), [10, 20, 20, 0, 0])
+        self.assertEqual(batch['bytes'].sum(), 4200)
+        self.assertEqual(
+            batch['start'].tolist(),
+            [
+                1439387263000,
+                1439387264000,
+                1439387263000,
+                1431280876000,
+                1431280876000,
+            ]
+        )
+        self.assertEqual(
+            [ACTIONS[x] for x in batch['action']],
+            ['ACCEPT', 'ACCEPT', 'REJECT', '-', '-']
+        )
+        self.assertEqual(
+            [LOG_STATUSES[x] for x in batch['log_status']],
+            ['OK', 'OK', 'OK', 'NODATA', 'SKIPDATA']
+        )
+
+        self.assertEqual(batch['srcaddr'].dtype, np.uint32)
+        self.assertEqual(batch['dstport'].dtype, np.uint16)
+        self.assertEqual(batch['protocol'].dtype, np.uint8)
+        self.assertEqual(batch['bytes'].dtype, np.int64)
+        self.assertEqual(batch['end'].dtype, np.int64)
+
+    def test_millisecond_timestamp(self):
+        message = (
+            '2 123456789010 eni-4b118871 - - - - - - - '
+            '1512564058000 1512564059456 - SKIPDATA'
+        )
+        batch = FlowBatch.from_messages([message])
+        self.assertEqual(batch['start'].tolist(), [1512564058000])
+        self.assertEqual(batch['end'].tolist(), [1512564059456])
+
+    def test_unsupported(self):
+        # Fields may be separated by other whitespace
+        spaced = SAMPLE_RECORDS[0].replace(' ', '  ').replace(' 443', '\t443')
+        unknown_action = SAMPLE_RECORDS[1].replace('ACCEPT', 'MAYBE')
+        missing_field = SAMPLE_RECORDS[1].replace(' 6 ', '  ')
+        non_ascii = SAMPLE_RECORDS[1].replace('eni-102010ab', u'eni-\u00e9')
+        messages = [
+            non_ascii,
+            spaced,
+            IPV6_RECORD,
+            SAMPLE_RECORDS[1],
+            missing_field,
+            unknown_action,
+        ]
+        batch = FlowBatch.from_messages(messages)
+        self.assertEqual(batch['srcport'].tolist(), [443, 49152])
+        self.assertEqual(
+            batch.unsupported,
+            [non_ascii, IPV6_RECORD, missing_field, unknown_action],
+        )
+
+        # Messages that are all alike are decoded together
+        batch = FlowBatch.from_messages([unknown_action, SAMPLE_RECORDS[0]])
+        self.assertEqual(batch['srcport'].tolist(), [443])
+        self.assertEqual(batch.unsupported, [unknown_action])
+
+    def test_invalid_number(self):
+        for message in (
+            SAMPLE_RECORDS[0].replace(' 840 ', ' 84O '),
+            SAMPLE_RECORDS[0].replace('198.51.100.1', '198.51.100.256'),
+            SAMPLE_RECORDS[0].replace('198.51.100.1', '198.51.100'),
+        ):
+            with self.assertRaises(ValueError):
+                FlowBatch.from_messages([SAMPLE_RECORDS[1], message])
+
+    def test_empty(self):
+        batch = FlowBatch.from_messages([IPV6_RECORD])
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(batch['srcaddr'].dtype, np.uint32)
+
+        batch = FlowBatch.from_messages(iter([]))
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(batch['end'].dtype, np.int64)
+
+    def test_iter_batches(self):
+        all_batches = list(iter_batches(iter(SAMPLE_RECORDS), size=2))
+        self.assertEqual([len(x) for x in all_batches], [2, 2, 1])
+
+    def test_reader(self):
+        paginator = MagicMock()
+        paginator.paginate.return_value = [
+            {'events': [{'message': x} for x in SAMPLE_RECORDS]},
+        ]
+        mock_client = MagicMock()
+        mock_client.get_paginator.return_value = paginator
+
+        reader = FlowLogsReader('group_name', boto_client=mock_client)
+        all_batches = list(reader.iter_batches(size=3))
+        self.assertEqual([len(x) for x in all_batches], [3, 2])
+        self.assertEqual(
+            all_batches[0]['dstaddr'][0], ip_to_int('192.0.2.1')
+        )
+
+
+@skipIf(np is None, 'NumPy is not installed')
+class AggregatedBatchesTestCase(TestCase):
+    def _check(self, messages, key_fields):
+        def sort_key(item):
+            return [str(item[x]) for x in key_fields]
+
+        all_records = (FlowRecord.from_message(x) for x in messages)
+        expected = sorted(
+            aggregated_records(all_records, key_fields=key_fields),
+            key=sort_key,
+        )
+        all_batches = iter_batches(iter(messages), size=2)
+        actual = sorted(
+            aggregated_batches(all_batches, key_fields=key_fields),
+            key=sort_key,
+        )
+        self.assertEqual(actual, expected)
+
+        # Types match also
+        for actual_item, expected_item in zip(actual, expected):
+            for field in key_fields:
+                self.assertEqual(
+                    type(actual_item[field]), type(expected_item[field])
+                )
+
+    def test_aggregated_batches(self):
+        messages = [
+            SAMPLE_RECORDS[0],
+            SAMPLE_RECORDS[1],
+            SAMPLE_RECORDS[2].replace('REJECT', 'ACCEPT'),
+            SAMPLE_RECORDS[3],
+            SAMPLE_RECORDS[0].replace('840', '1000'),
+            SAMPLE_RECORDS[1].replace('1439387265', '1439387299'),
+            # Millisecond timestamps keep their precision
+            SAMPLE_RECORDS[0].replace('1439387264', '1439387264456'),
+            SAMPLE_RECORDS[2].replace('1439387263', '1439387262123'),
+            IPV6_RECORD,
+            IPV6_RECORD,
+        ]
+        self._check(
+            messages, ('srcaddr', 'dstaddr', 'srcport', 'dstport', 'protocol')
+        )
+        self._check(
+            messages, ('interface_id', 'srcaddr', 'srcport', 'dstport')
+        )
+        self._check(messages, ('account_id', 'action', 'version'))
+
+    def test_no_records(self):
+        all_batches = iter_batches(iter(SAMPLE_RECORDS[3:]))
+        self.assertEqual(list(aggregated_batches(all_batches)), [])
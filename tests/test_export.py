@@ -0,0 +1,188 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division, print_function
+
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import skipIf, TestCase
+
+try:
+    from unittest.mock import MagicMock, patch
+except ImportError:
+    from mock import MagicMock, patch
+
+from flowlogs_reader import (
+    FlowRecord, LazyFlowRecord, ReaderStats, S3FlowLogsReader
+)
+from flowlogs_reader.export import (
+    _iter_region_records,
+    export_records,
+    pa,
+    PartitionedWriter,
+    pq,
+)
+
+from .test_flowlogs_reader import SAMPLE_RECORDS
+
+DAY_PREFIX = 'AWSLogs/123456789010/vpcflowlogs/{}/2015/08/12/'
+
+
+def _get_s3_reader(**kwargs):
+    # Two files from different regions
+    all_files = {
+        DAY_PREFIX.format('pangaea-1') + 'file_1.log.gz': SAMPLE_RECORDS[:2],
+        DAY_PREFIX.format('pangaea-2') + 'file_2.log.gz': SAMPLE_RECORDS[2:],
+    }
+    reader = S3FlowLogsReader(
+        'example-bucket', boto_client=MagicMock(), **kwargs
+    )
+    reader._get_all_keys = lambda: [{'Key': x} for x in sorted(all_files)]
+    reader._read_file = lambda key, etag=None: iter(all_files[key])
+    return reader
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        self.output_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.output_dir)
+
+    def test_iter_region_records(self):
+        actual = list(_iter_region_records(_get_s3_reader()))
+        expected = [
+            ('pangaea-1', FlowRecord.from_message(SAMPLE_RECORDS[0])),
+            ('pangaea-1', FlowRecord.from_message(SAMPLE_RECORDS[1])),
+            ('pangaea-2', FlowRecord.from_message(SAMPLE_RECORDS[2])),
+            ('pangaea-2', FlowRecord.from_message(SAMPLE_RECORDS[3])),
+            ('pangaea-2', FlowRecord.from_message(SAMPLE_RECORDS[4])),
+        ]
+        self.assertEqual(actual, expected)
+
+        # The reader's options apply
+        stats = ReaderStats()
+        reader = _get_s3_reader(
+            lazy=True, filter_expression='action == REJECT', stats=stats
+        )
+        actual = list(_iter_region_records(reader))
+        self.assertEqual(actual, [expected[2]])
+        self.assertIsInstance(actual[0][1], LazyFlowRecord)
+        self.assertEqual(stats.records_parsed, 1)
+
+    @patch('flowlogs_reader.export.pa', None)
+    def test_no_pyarrow(self):
+        with self.assertRaises(RuntimeError):
+            PartitionedWriter(self.output_dir)
+
+    @skipIf(pa is None, 'pyarrow is not installed')
+    def test_export_partitions(self):
+        all_paths = export_records(_get_s3_reader(), self.output_dir)
+        actual = sorted(
+            os.path.dirname(os.path.relpath(x, self.output_dir))
+            for x in all_paths
+        )
+        expected = [
+            os.path.join('account_id=123456789010', x, y)
+            for x, y in [
+                ('region=pangaea-1', 'date=2015-08-12'),
+                ('region=pangaea-2', 'date=2015-05-10'),
+                ('region=pangaea-2', 'date=2015-08-12'),
+            ]
+        ]
+        self.assertEqual(actual, expected)
+
+    @skipIf(pa is None, 'pyarrow is not installed')
+    def test_export_records(self):
+        all_records = [FlowRecord.from_message(x) for x in SAMPLE_RECORDS]
+        for file_format in ('parquet', 'arrow'):
+            output_dir = os.path.join(self.output_dir, file_format)
+            all_paths = export_records(
+                all_records,
+                output_dir,
+                region='pangaea-1',
+                file_format=file_format,
+                row_group_size=2,
+            )
+            self.assertEqual(len(all_paths), 2)
+
+            if file_format == 'parquet':
+                tables = [pq.read_table(x) for x in all_paths]
+                row_groups = sorted(
+                    pq.ParquetFile(x).num_row_groups for x in all_paths
+                )
+                self.assertEqual(row_groups, [1, 2])
+            else:
+                tables = [
+                    pa.ipc.open_file(x).read_all() for x in all_paths
+                ]
+            actual = []
+            for table in tables:
+                columns = table.to_pydict()
+                self.assertEqual(table.num_rows, len(columns['start']))
+                actual.extend(
+                    zip(columns['start'], columns['srcaddr'], columns['bytes'])
+                )
+            actual.sort(key=str)
+            expected = sorted(
+                ((x.start, x.srcaddr, x.bytes) for x in all_records), key=str
+            )
+            self.assertEqual(actual, expected)
+
+        with self.assertRaises(ValueError):
+            PartitionedWriter(self.output_dir, file_format='csv')
+
+    @skipIf(pa is None, 'pyarrow is not installed')
+    def test_millisecond_timestamps(self):
+        message = (
+            '2 123456789010 eni-102010ab 198.51.100.1 192.0.2.1 '
+            '443 49152 6 10 840 1439387263123 1439387264456 ACCEPT OK'
+        )
+        flow_record = FlowRecord.from_message(message)
+        path, = export_records([flow_record], self.output_dir)
+        columns = pq.read_table(path).to_pydict()
+        self.assertEqual(columns['start'], [flow_record.start])
+        self.assertEqual(columns['end'], [flow_record.end])
+        self.assertEqual(flow_record.end.microsecond, 456000)
+
+    @skipIf(pa is None, 'pyarrow is not installed')
+    def test_max_buffered_rows(self):
+        # Records from three days, the first with the most
+        all_records = [
+            FlowRecord.from_message(SAMPLE_RECORDS[i]) for i in (0, 1, 0, 3)
+        ]
+        all_records[2].start = all_records[2].start.replace(day=13)
+        writer = PartitionedWriter(
+            self.output_dir, row_group_size=10, max_buffered_rows=3
+        )
+        with writer:
+            for flow_record in all_records[:2]:
+                writer.write(flow_record)
+            self.assertEqual(writer.buffered_rows, 2)
+            self.assertEqual(writer.paths, [])
+
+            # Reaching the limit writes out the biggest partition
+            writer.write(all_records[2])
+            self.assertEqual(writer.buffered_rows, 1)
+            self.assertEqual(len(writer.paths), 1)
+            self.assertIn('date=2015-08-12', writer.paths[0])
+
+            writer.write(all_records[3])
+            self.assertEqual(writer.buffered_rows, 2)
+
+        self.assertEqual(writer.buffered_rows, 0)
+        self.assertEqual(
+            sum(pq.read_table(x).num_rows for x in writer.paths), 4
+        )
@@ -0,0 +1,263 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division, print_function
+
+from unittest import TestCase
+
+try:
+    from unittest.mock import MagicMock
+except ImportError:
+    from mock import MagicMock
+
+from flowlogs_reader import (
+    FilterExpression,
+    FlowLogsReader,
+    FlowRecord,
+    IPMatcher,
+)
+from flowlogs_reader.flowlogs_reader import DEFAULT_FILTER_PATTERN
+
+from .test_flowlogs_reader import SAMPLE_RECORDS
+
+
+class IPMatcherTestCase(TestCase):
+    def test_match(self):
+        matcher = IPMatcher(
+            [
+                '192.0.2.1',
+                '198.51.100.0/25',
+                '198.51.100.128/25',
+                '203.0.113.7/30',
+                '2001:DB8::1',
+                '2001:db8:1::/48',
+            ]
+        )
+        for ip, expected in [
+            ('192.0.2.1', True),
+            ('192.0.2.2', False),
+            ('198.51.100.0', True),
+            ('198.51.100.255', True),
+            ('198.51.101.0', False),
+            ('203.0.113.3', False),
+            ('203.0.113.4', True),
+            ('203.0.113.7', True),
+            ('203.0.113.8', False),
+            ('2001:db8::1', True),
+            ('2001:db8:0::1', True),
+            ('2001:db8::2', False),
+            ('2001:db8:1:ffff::1', True),
+            ('2001:db8:2::1', False),
+            ('-', False),
+            (None, False),
+        ]:
+            self.assertEqual(matcher.match(ip), expected, ip)
+
+    def test_match_exact(self):
+        # Without any blocks only exact matches count
+        matcher = IPMatcher(['192.0.2.1', '::1'])
+        self.assertTrue(matcher.match('192.0.2.1'))
+        self.assertFalse(matcher.match('192.0.2.10'))
+        self.assertTrue(matcher.match('0::1'))
+        self.assertFalse(matcher.match('::2'))
+
+        # Nothing matches an empty set
+        self.assertFalse(IPMatcher([]).match('192.0.2.1'))
+
+    def test_match_all(self):
+        matcher = IPMatcher(['0.0.0.0/0'])
+        self.assertTrue(matcher.match('255.255.255.255'))
+        self.assertFalse(matcher.match('2001:db8::1'))
+
+    def test_invalid(self):
+        for network in [
+            '192.0.2',
+            '192.0.2.1/33',
+            '2001:db8::/129',
+            '192.0.2.0/x',
+            'example.com',
+        ]:
+            with self.assertRaises(ValueError):
+                IPMatcher([network])
+
+    def test_match_message(self):
+        matcher = IPMatcher(['198.51.100.0/24'])
+        actual = [x for x in SAMPLE_RECORDS if matcher.match_message(x)]
+        self.assertEqual(actual, SAMPLE_RECORDS[:3])
+        self.assertFalse(matcher.match_message('2 123456789010'))
+
+    def test_reader(self):
+        # Filtered messages aren't parsed
+        paginator = MagicMock()
+        paginator.paginate.return_value = [
+            {'events': [{'message': x} for x in SAMPLE_RECORDS]},
+        ]
+        mock_client = MagicMock()
+        mock_client.get_paginator.return_value = paginator
+
+        matcher = IPMatcher(['198.51.100.1'])
+        reader = FlowLogsReader(
+            'group_name',
+            message_filter=matcher.match_message,
+            boto_client=mock_client,
+        )
+        actual = list(reader)
+        expected = [FlowRecord.from_message(x) for x in SAMPLE_RECORDS[:3]]
+        self.assertEqual(actual, expected)
+
+
+class FilterExpressionTestCase(TestCase):
+    def _check(self, expression, expected_indexes):
+        filter_expression = FilterExpression(expression)
+        actual = [
+            i for i, x in enumerate(SAMPLE_RECORDS)
+            if filter_expression.match_message(x)
+        ]
+        self.assertEqual(actual, expected_indexes, expression)
+
+    def test_match_message(self):
+        for expression, expected_indexes in [
+            ('action == REJECT', [2]),
+            ("action == 'ACCEPT'", [0, 1]),
+            ('action != REJECT', [0, 1]),
+            ('dstport in (22, 443)', [1, 2]),
+            ('dstport not in (22, 443)', [0]),
+            ('bytes > 1e3', [1, 2]),
+            ('bytes >= 840 and packets < 20', [0]),
+            ('srcport == 443 or dstport == 443', [0, 1, 2]),
+            ('not (srcport == 443)', [1, 2, 3, 4]),
+            ("interface_id == 'eni-102010ab'", [0, 1]),
+            ('account_id == 123456789010', [0, 1, 2, 3, 4]),
+            ('srcaddr in ("192.0.2.0/24",)', [1, 2]),
+            ('dstaddr in ["198.51.100.1"]', [1, 2]),
+            ('start < 1439387264', [0, 2, 3, 4]),
+            ('log_status in (NODATA, SKIPDATA)', [3, 4]),
+            # Missing values don't match
+            ('dstport != 443', [0]),
+        ]:
+            self._check(expression, expected_indexes)
+
+    def test_millisecond_timestamp(self):
+        filter_expression = FilterExpression('end == 1512564059')
+        message = (
+            '2 123456789010 eni-4b118871 - - - - - - - '
+            '1512564058000 1512564059000 - SKIPDATA'
+        )
+        self.assertTrue(filter_expression.match_message(message))
+
+        # Fractions of a second aren't dropped
+        message = (
+            '2 123456789010 eni-4b118871 - - - - - - - '
+            '1439119654500 1439119655000 - SKIPDATA'
+        )
+        filter_expression = FilterExpression('start > 1439119654')
+        self.assertTrue(filter_expression.match_message(message))
+        filter_expression = FilterExpression('start <= 1439119654')
+        self.assertFalse(filter_expression.match_message(message))
+
+    def test_short_message(self):
+        filter_expression = FilterExpression('action == REJECT')
+        self.assertFalse(filter_expression.match_message('2 123456789010'))
+
+    def test_invalid(self):
+        for expression in [
+            'action ==',
+            'action',
+            '443 == srcport',
+            'srcport == dstport',
+            'bytes > many',
+            '1 < bytes < 2',
+            'bytes + 1 > 2',
+            'srcaddr is None',
+        ]:
+            with self.assertRaises(ValueError):
+                FilterExpression(expression)
+
+    def test_to_filter_pattern(self):
+        for expression, expected in [
+            (
+                'action == REJECT and dstport in (22, 3389) and bytes > 1e6',
+                '[version="2", account_id, interface_id, srcaddr, dstaddr, '
+                'srcport, dstport, protocol, packets, bytes>1000000, '
+                'start, end, action="REJECT", log_status]'
+            ),
+            (
+                'version == 2 and srcport != 0.5 and srcport != 1',
+                '[version="2" && version=2, account_id, interface_id, '
+                'srcaddr, dstaddr, srcport!=0.5 && srcport!=1, dstport, '
+                'protocol, packets, bytes, '
+                'start, end, action, log_status]'
+            ),
+            # Millisecond timestamps are bigger, so only lower bounds on
+            # timestamps are added
+            (
+                'start < 1500000100 and end >= 1500000000',
+                '[version="2", account_id, interface_id, srcaddr, dstaddr, '
+                'srcport, dstport, protocol, packets, bytes, '
+                'start, end>=1500000000, action, log_status]'
+            ),
+            ('start == 1500000000', None),
+            ('action == REJECT or bytes > 10', None),
+            ('not action == REJECT', None),
+        ]:
+            actual = FilterExpression(expression).to_filter_pattern(
+                DEFAULT_FILTER_PATTERN
+            )
+            self.assertEqual(actual, expected)
+
+        # The expression matches a millisecond record that the pattern would
+        # have dropped if the upper bound were added
+        message = (
+            '2 123456789010 eni-102010ab 198.51.100.1 192.0.2.1 '
+            '443 49152 6 10 840 1500000000123 1500000000456 ACCEPT OK'
+        )
+        expression = FilterExpression('start < 1500000100')
+        self.assertTrue(expression.match_message(message))
+        self.assertIsNone(expression.to_filter_pattern(DEFAULT_FILTER_PATTERN))
+
+    def test_reader(self):
+        paginator = MagicMock()
+        paginator.paginate.return_value = [
+            {'events': [{'message': x} for x in SAMPLE_RECORDS]},
+        ]
+        mock_client = MagicMock()
+        mock_client.get_paginator.return_value = paginator
+
+        # The filter pattern is changed, and the expression is also checked
+        # locally
+        reader = FlowLogsReader(
+            'group_name',
+            filter_expression='action == ACCEPT and dstport in (443, 22)',
+            boto_client=mock_client,
+        )
+        actual = list(reader)
+        expected = [FlowRecord.from_message(SAMPLE_RECORDS[1])]
+        self.assertEqual(actual, expected)
+        self.assertEqual(
+            paginator.paginate.call_args[1]['filterPattern'],
+            (
+                '[version="2", account_id, interface_id, srcaddr, dstaddr, '
+                'srcport, dstport, protocol, packets, bytes, '
+                'start, end, action="ACCEPT", log_status]'
+            )
+        )
+
+        # Custom filter patterns aren't changed
+        reader = FlowLogsReader(
+            'group_name',
+            filter_pattern='ACCEPT',
+            filter_expression='action == ACCEPT',
+            boto_client=mock_client,
+        )
+        self.assertEqual(reader.paginator_kwargs['filterPattern'], 'ACCEPT')
@@ -14,9 +14,17 @@
 
 from __future__ import division, print_function
 
-from datetime import datetime
+from calendar import timegm
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from gzip import GzipFile
 from io import BytesIO
+from os import makedirs
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
 from unittest import TestCase
 
 import boto3
@@ -30,11 +38,21 @@ except ImportError:
 
 from flowlogs_reader import (
     aggregated_records,
+    heavy_hitters,
+    merged_aggregates,
+    windowed_aggregated_records,
     FlowRecord,
     FlowLogsReader,
+    LazyFlowRecord,
+    LocalFlowLogsReader,
     S3FlowLogsReader,
 )
+from flowlogs_reader.aggregation import _FlowStats, _SpilledFlows
 from flowlogs_reader.flowlogs_reader import (
+    _iter_chains_merged,
+    _iter_gzip_lines,
+    _load_checkpoint,
+    _save_checkpoint,
     DEFAULT_REGION_NAME,
     DUPLICATE_NEXT_TOKEN_MESSAGE,
 )
@@ -64,6 +82,13 @@ SAMPLE_RECORDS = [
 ]
 
 
+def compress(text):
+    with BytesIO() as f:
+        with GzipFile(fileobj=f, mode='wb') as gz_f:
+            gz_f.write(text.encode('utf-8'))
+        return f.getvalue()
+
+
 class FlowRecordTestCase(TestCase):
     def test_parse(self):
         flow_record = FlowRecord({'message': SAMPLE_RECORDS[0]})
@@ -160,6 +185,88 @@ class FlowRecordTestCase(TestCase):
         self.assertEqual(event_record, message_record)
 
 
+class LazyFlowRecordTestCase(TestCase):
+    def test_parse(self):
+        millisecond_record = (
+            '2 123456789010 eni-4b118871 - - - - - - - '
+            '1512564058000 1512564059000 - SKIPDATA'
+        )
+        for message in SAMPLE_RECORDS + [millisecond_record]:
+            lazy_record = LazyFlowRecord.from_message(message)
+            flow_record = FlowRecord.from_message(message)
+            for attr in FlowRecord.__slots__:
+                self.assertEqual(
+                    getattr(lazy_record, attr), getattr(flow_record, attr)
+                )
+            self.assertEqual(lazy_record.to_dict(), flow_record.to_dict())
+            self.assertEqual(
+                lazy_record.to_message(), flow_record.to_message()
+            )
+            self.assertEqual(str(lazy_record), str(flow_record))
+
+    def test_eq(self):
+        lazy_record = LazyFlowRecord.from_message(SAMPLE_RECORDS[0])
+        self.assertEqual(
+            lazy_record, FlowRecord.from_message(SAMPLE_RECORDS[0])
+        )
+        self.assertNotEqual(
+            lazy_record, LazyFlowRecord.from_message(SAMPLE_RECORDS[1])
+        )
+        self.assertEqual(
+            hash(lazy_record), hash(FlowRecord.from_message(SAMPLE_RECORDS[0]))
+        )
+
+    def test_reader(self):
+        paginator = MagicMock()
+        paginator.paginate.return_value = [
+            {'events': [{'message': x} for x in SAMPLE_RECORDS]},
+        ]
+        mock_client = MagicMock()
+        mock_client.get_paginator.return_value = paginator
+
+        reader = FlowLogsReader(
+            'group_name', lazy=True, boto_client=mock_client
+        )
+        actual = list(reader)
+        self.assertTrue(all(isinstance(x, LazyFlowRecord) for x in actual))
+        expected = [FlowRecord.from_message(x) for x in SAMPLE_RECORDS]
+        self.assertEqual(actual, expected)
+
+
+class GzipLinesTestCase(TestCase):
+    def test_iter_gzip_lines(self):
+        text = '\n'.join(SAMPLE_RECORDS)
+        data = compress(text)
+
+        # Any chunk size gives the same lines
+        expected = [x.encode('utf-8') for x in SAMPLE_RECORDS]
+        for chunk_size in (1, 7, len(data), 65536):
+            actual = list(_iter_gzip_lines(BytesIO(data), chunk_size))
+            self.assertEqual(actual, expected)
+
+        # A trailing newline doesn't produce an empty line
+        data = compress(text + '\n')
+        actual = list(_iter_gzip_lines(BytesIO(data), 7))
+        self.assertEqual(actual, expected)
+
+    def test_iter_gzip_lines_truncated(self):
+        # Truncated files aren't accepted
+        data = compress('\n'.join(SAMPLE_RECORDS))
+        for size in (len(data) // 2, len(data) - 4):
+            with self.assertRaises(EOFError):
+                list(_iter_gzip_lines(BytesIO(data[:size]), 7))
+
+        # Empty files have no lines
+        self.assertEqual(list(_iter_gzip_lines(BytesIO(b''))), [])
+
+    def test_iter_gzip_lines_members(self):
+        # Concatenated gzip files are read in full
+        data = compress(SAMPLE_RECORDS[0] + '\n') + compress(SAMPLE_RECORDS[1])
+        actual = list(_iter_gzip_lines(BytesIO(data), 5))
+        expected = [x.encode('utf-8') for x in SAMPLE_RECORDS[:2]]
+        self.assertEqual(actual, expected)
+
+
 class FlowLogsReaderTestCase(TestCase):
     def setUp(self):
         self.mock_client = MagicMock()
@@ -299,6 +406,347 @@ class FlowLogsReaderTestCase(TestCase):
         # Fail for unexpected PaginationError
         self.assertRaises(PaginationError, lambda: list(self.inst))
 
+    def _get_concurrent_reader(self, **kwargs):
+        # Two log streams with events in our time range, one with events
+        # after it, and one with no events
+        start_ms = self.inst.start_ms
+        streams_page = {
+            'logStreams': [
+                {
+                    'logStreamName': 'log_0',
+                    'firstEventTimestamp': start_ms,
+                    'lastEventTimestamp': start_ms + 4,
+                },
+                {
+                    'logStreamName': 'log_1',
+                    'firstEventTimestamp': start_ms - 1000,
+                    'lastEventTimestamp': start_ms - 1000,
+                    'lastIngestionTime': start_ms + 3,
+                },
+                {
+                    'logStreamName': 'log_2',
+                    'firstEventTimestamp': self.inst.end_ms,
+                    'lastEventTimestamp': self.inst.end_ms + 1,
+                },
+                {'logStreamName': 'log_3'},
+            ]
+        }
+        self.mock_client.get_paginator.return_value.paginate.return_value = [
+            streams_page
+        ]
+
+        def event(i):
+            return {'timestamp': start_ms + i, 'message': SAMPLE_RECORDS[i]}
+
+        # log_0 has two pages; log_1 repeats its token
+        all_pages = {
+            ('log_0', None): {
+                'events': [event(0), event(2)], 'nextToken': 'a'
+            },
+            ('log_0', 'a'): {'events': [event(4)]},
+            ('log_1', None): {'events': [event(1)], 'nextToken': 'b'},
+            ('log_1', 'b'): {'events': [event(3)], 'nextToken': 'b'},
+        }
+
+        def filter_log_events(**kwargs):
+            self.assertEqual(kwargs['filterPattern'], 'REJECT')
+            self.assertEqual(kwargs['startTime'], start_ms)
+            self.assertEqual(kwargs['endTime'], self.inst.end_ms)
+            stream_name, = kwargs['logStreamNames']
+            return all_pages[stream_name, kwargs.get('nextToken')]
+
+        self.mock_client.filter_log_events.side_effect = filter_log_events
+
+        return FlowLogsReader(
+            'group_name',
+            start_time=self.start_time,
+            end_time=self.end_time,
+            filter_pattern='REJECT',
+            boto_client=self.mock_client,
+            **kwargs
+        )
+
+    def test_iteration_concurrent(self):
+        reader = self._get_concurrent_reader(max_workers=2)
+        actual = sorted(x.to_message() for x in reader)
+        expected = sorted(SAMPLE_RECORDS)
+        self.assertEqual(actual, expected)
+        self.assertEqual(self.mock_client.filter_log_events.call_count, 4)
+
+    def test_get_time_shards(self):
+        start_ms = self.inst.start_ms
+        actual = self.inst._get_time_shards(3)
+        expected = [
+            (start_ms, start_ms + 1200000),
+            (start_ms + 1200000, start_ms + 2400000),
+            (start_ms + 2400000, start_ms + 3600000),
+        ]
+        self.assertEqual(actual, expected)
+
+        # Empty windows are left out
+        self.inst.end_ms = start_ms + 2
+        actual = self.inst._get_time_shards(3)
+        expected = [(start_ms, start_ms + 1), (start_ms + 1, start_ms + 2)]
+        self.assertEqual(actual, expected)
+
+    def _get_sharded_reader(self, **kwargs):
+        # Each of the three shards has its own pages of events
+        shard_ms = 1200000
+        all_pages = {
+            (0, None): {'events': [0], 'nextToken': 'a'},
+            (0, 'a'): {'events': [1]},
+            (1, None): {'events': [2, 3]},
+            (2, None): {'events': [4], 'nextToken': 'b'},
+            (2, 'b'): {'events': [5], 'nextToken': 'b'},
+        }
+
+        def filter_log_events(**kwargs):
+            self.assertEqual(kwargs['filterPattern'], 'REJECT')
+            self.assertTrue(kwargs['interleaved'])
+            self.assertEqual(kwargs['endTime'] - kwargs['startTime'], shard_ms)
+            shard = (kwargs['startTime'] - self.inst.start_ms) // shard_ms
+            return all_pages[shard, kwargs.get('nextToken')]
+
+        self.mock_client.filter_log_events.side_effect = filter_log_events
+
+        return FlowLogsReader(
+            'group_name',
+            start_time=self.start_time,
+            end_time=self.end_time,
+            filter_pattern='REJECT',
+            time_shards=3,
+            boto_client=self.mock_client,
+            **kwargs
+        )
+
+    def test_read_time_shards(self):
+        reader = self._get_sharded_reader(max_workers=2)
+        actual = sorted(reader._read_streams())
+        expected = [0, 1, 2, 3, 4, 5]
+        self.assertEqual(actual, expected)
+
+    def test_read_time_shards_ordered(self):
+        reader = self._get_sharded_reader(ordered=True)
+        actual = list(reader._read_streams())
+        expected = [0, 1, 2, 3, 4, 5]
+        self.assertEqual(actual, expected)
+
+    def test_iteration_concurrent_ordered(self):
+        reader = self._get_concurrent_reader(max_workers=2, ordered=True)
+        actual = list(reader)
+        expected = [FlowRecord.from_message(x) for x in SAMPLE_RECORDS]
+        self.assertEqual(actual, expected)
+
+    def test_iter_chains_merged(self):
+        # Four queries, the second and third of which overlap
+        all_pages = {
+            'a': [[1, 2]],
+            'b': [[3], [5, 7]],
+            'c': [[4, 6]],
+            'd': [[8, 9]],
+        }
+        all_kwargs = [(1, 'a'), (3, 'b'), (4, 'c'), (8, 'd')]
+        started = []
+
+        def fetch(kwargs):
+            name = kwargs['name']
+            page_number = kwargs.get('nextToken', 0)
+            if not page_number:
+                started.append(name)
+            page = {'events': all_pages[name][page_number]}
+            if page_number + 1 < len(all_pages[name]):
+                page['nextToken'] = page_number + 1
+            return page
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            all_events = _iter_chains_merged(
+                executor,
+                fetch,
+                [(x, {'name': name}) for x, name in all_kwargs],
+                lambda event: event,
+                1,
+            )
+            actual = []
+            for event in all_events:
+                actual.append((event, list(started)))
+
+        # Queries are only started once the earlier ones are done, or when
+        # their events could come next
+        self.assertEqual(
+            actual,
+            [
+                (1, ['a']),
+                (2, ['a']),
+                (3, ['a', 'b']),
+                (4, ['a', 'b', 'c']),
+                (5, ['a', 'b', 'c']),
+                (6, ['a', 'b', 'c']),
+                (7, ['a', 'b', 'c']),
+                (8, ['a', 'b', 'c', 'd']),
+                (9, ['a', 'b', 'c', 'd']),
+            ]
+        )
+
+    def _get_follow_client(self, all_events, all_queries):
+        # A client for one log stream with the given events. Each query's
+        # parameters are recorded.
+        now_ms = int(time()) * 1000
+
+        def filter_log_events(**kwargs):
+            all_queries.append(kwargs)
+            events = [
+                {
+                    'logStreamName': 'stream_1',
+                    'timestamp': timestamp,
+                    'eventId': event_id,
+                    'message': message,
+                }
+                for timestamp, event_id, message in all_events
+                if timestamp >= kwargs['startTime']
+            ]
+            return {'events': events}
+
+        streams_paginator = MagicMock()
+        streams_paginator.paginate.return_value = [
+            {
+                'logStreams': [
+                    {
+                        'logStreamName': 'stream_1',
+                        'firstEventTimestamp': now_ms - 2000,
+                        'lastIngestionTime': now_ms + 1000,
+                    },
+                ],
+            },
+        ]
+        events_paginator = MagicMock()
+        events_paginator.paginate.side_effect = (
+            lambda **kwargs: [filter_log_events(**kwargs)]
+        )
+        paginators = {
+            'describe_log_streams': streams_paginator,
+            'filter_log_events': events_paginator,
+        }
+
+        mock_client = MagicMock()
+        mock_client.get_paginator.side_effect = paginators.__getitem__
+        mock_client.filter_log_events.side_effect = filter_log_events
+        return mock_client
+
+    def test_follow(self):
+        # One log stream, which gets new events while we're waiting
+        now_ms = int(time()) * 1000
+        for max_workers in (None, 2):
+            all_events = [
+                (now_ms - 2000, 'a', SAMPLE_RECORDS[0]),
+                (now_ms - 2000, 'b', SAMPLE_RECORDS[1]),
+                (now_ms - 1000, 'c', SAMPLE_RECORDS[2]),
+            ]
+            all_queries = []
+            mock_client = self._get_follow_client(all_events, all_queries)
+
+            def sleep(seconds):
+                # The first new event has the same timestamp as the last one
+                # that was read
+                self.assertEqual(seconds, 10)
+                all_events.append((now_ms - 1000, 'd', SAMPLE_RECORDS[3]))
+                all_events.append((now_ms, 'e', SAMPLE_RECORDS[4]))
+
+            def get_reader(**kwargs):
+                return FlowLogsReader(
+                    'group_name',
+                    boto_client=mock_client,
+                    max_workers=max_workers,
+                    **kwargs
+                )
+
+            temp_dir = mkdtemp()
+            checkpoint_path = join(temp_dir, 'checkpoint.json')
+            try:
+                start_time = datetime.utcnow() - timedelta(minutes=10)
+                reader = get_reader(start_time=start_time)
+                with patch('flowlogs_reader.flowlogs_reader.sleep', sleep):
+                    actual = list(
+                        reader.follow(
+                            checkpoint_path, poll_interval=10, max_polls=2
+                        )
+                    )
+                expected = [
+                    FlowRecord.from_message(x) for x in SAMPLE_RECORDS
+                ]
+                self.assertEqual(actual, expected)
+
+                # The second check starts from the stream's mark
+                self.assertEqual(
+                    [x['startTime'] for x in all_queries],
+                    [timegm(start_time.utctimetuple()) * 1000, now_ms - 1000],
+                )
+                for kwargs in all_queries:
+                    self.assertEqual(kwargs['logStreamNames'], ['stream_1'])
+
+                # Resuming from the checkpoint, without a start time, gives
+                # only new events
+                all_events.append((now_ms, 'f', SAMPLE_RECORDS[0]))
+                all_events.append((now_ms + 1000, 'g', SAMPLE_RECORDS[1]))
+                del all_queries[:]
+                reader = get_reader()
+                actual = list(reader.follow(checkpoint_path, max_polls=1))
+                expected = [
+                    FlowRecord.from_message(x) for x in SAMPLE_RECORDS[:2]
+                ]
+                self.assertEqual(actual, expected)
+                self.assertEqual(
+                    [x['startTime'] for x in all_queries], [now_ms]
+                )
+
+                # The marks only have the events at the last timestamp
+                checkpoint = _load_checkpoint(checkpoint_path)
+                mark = checkpoint['streams']['stream_1']
+                self.assertEqual(mark['timestamp'], now_ms + 1000)
+                self.assertEqual(mark['event_ids'], ['g'])
+            finally:
+                rmtree(temp_dir)
+
+    def test_follow_resume(self):
+        # Without a start time, new log streams are read from the overlap
+        # before the last check's end, however long ago that was
+        all_queries = []
+        mock_client = self._get_follow_client([], all_queries)
+        temp_dir = mkdtemp()
+        checkpoint_path = join(temp_dir, 'checkpoint.json')
+        try:
+            _save_checkpoint(
+                checkpoint_path, {'end_time': '2015-08-12T13:00:00.000000'}
+            )
+            reader = FlowLogsReader('group_name', boto_client=mock_client)
+            list(
+                reader.follow(
+                    checkpoint_path,
+                    overlap=timedelta(minutes=10),
+                    max_polls=1,
+                )
+            )
+            self.assertEqual(reader.start_time, datetime(2015, 8, 12, 12, 50))
+            self.assertEqual(
+                [x['startTime'] for x in all_queries], [1439383800000]
+            )
+
+            # The end of the check is saved
+            checkpoint = _load_checkpoint(checkpoint_path)
+            self.assertEqual(
+                checkpoint['end_time'],
+                reader.end_time.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+            )
+
+            # A given start time is used instead
+            start_time = datetime.utcnow() - timedelta(minutes=5)
+            reader = FlowLogsReader(
+                'group_name', start_time=start_time, boto_client=mock_client
+            )
+            list(reader.follow(checkpoint_path, max_polls=1))
+            self.assertEqual(reader.start_time, start_time)
+        finally:
+            rmtree(temp_dir)
+
 
 class S3FlowLogsReaderTestCase(TestCase):
     def setUp(self):
@@ -431,6 +879,353 @@ class S3FlowLogsReaderTestCase(TestCase):
             expected = [FlowRecord.from_message(x) for x in SAMPLE_RECORDS]
             self.assertEqual(actual, expected)
 
+    def test_iteration_max_workers(self):
+        # Each file has a header and one record
+        header = ' '.join(FlowRecord.__slots__)
+        all_keys = ['key_{}'.format(i) for i in range(len(SAMPLE_RECORDS))]
+        file_data = {
+            key: compress('\n'.join([header, message]))
+            for key, message in zip(all_keys, SAMPLE_RECORDS)
+        }
+
+        mock_client = MagicMock()
+        mock_client.get_object.side_effect = lambda Bucket, Key: {
+            'Body': BytesIO(file_data[Key])
+        }
+        reader = S3FlowLogsReader(
+            'example-bucket',
+            start_time=self.start_time,
+            end_time=self.end_time,
+            max_workers=2,
+            boto_client=mock_client,
+        )
+
+        # Records should come back in key order, even though the files are
+        # retrieved concurrently
+        all_items = [{'Key': key} for key in all_keys]
+        with patch.object(reader, '_get_all_keys', return_value=all_items):
+            actual = list(reader)
+        expected = [FlowRecord.from_message(x) for x in SAMPLE_RECORDS]
+        self.assertEqual(actual, expected)
+        self.assertEqual(mock_client.get_object.call_count, len(all_keys))
+
+    def test_get_keys_start_after(self):
+        # Two flow logs with a file every five minutes for the whole day,
+        # listed three keys at a time
+        prefix = 'AWSLogs/123456789010/vpcflowlogs/pangaea-1/2015/08/12/'
+        all_keys = sorted(
+            (
+                '{}123456789010_vpcflowlogs_pangaea-1_{}_'
+                '20150812T{:02}{:02}Z_h45h.log.gz'
+            ).format(prefix, flow_log_id, hour, minute)
+            for flow_log_id in ('fl-102010', 'fl-102011')
+            for hour in range(24)
+            for minute in range(0, 60, 5)
+        )
+
+        def list_objects_v2(
+            Bucket, Prefix, StartAfter='', ContinuationToken=None
+        ):
+            if ContinuationToken is not None:
+                StartAfter = ContinuationToken
+            remaining = [
+                x for x in all_keys if x.startswith(Prefix) and x > StartAfter
+            ]
+            response = {'Contents': [{'Key': x} for x in remaining[:3]]}
+            if len(remaining) > 3:
+                response['IsTruncated'] = True
+                response['NextContinuationToken'] = remaining[2]
+            return response
+
+        mock_client = MagicMock()
+        mock_client.list_objects_v2.side_effect = list_objects_v2
+        reader = S3FlowLogsReader(
+            'example-bucket',
+            start_time=datetime(2015, 8, 12, 12, 4, 30),
+            end_time=datetime(2015, 8, 12, 12, 20),
+            boto_client=mock_client,
+        )
+        actual = [x['Key'] for x in reader._get_keys(prefix)]
+        expected = [
+            (
+                '{}123456789010_vpcflowlogs_pangaea-1_{}_'
+                '20150812T12{:02}Z_h45h.log.gz'
+            ).format(prefix, flow_log_id, minute)
+            for flow_log_id in ('fl-102010', 'fl-102011')
+            for minute in (5, 10, 15)
+        ]
+        self.assertEqual(actual, expected)
+
+        # Rather than listing all 288 keys, we skip to the start of the
+        # window and past its end for each flow log
+        self.assertEqual(mock_client.list_objects_v2.call_count, 7)
+
+    def _get_listing_client(self):
+        # Two accounts with two regions each. The account listing has two
+        # pages.
+        account_pages = [
+            {'CommonPrefixes': [{'Prefix': 'AWSLogs/123456789010/'}]},
+            {'CommonPrefixes': [{'Prefix': 'AWSLogs/123456789011/'}]},
+        ]
+
+        def region_pages(account_id):
+            return [
+                {
+                    'CommonPrefixes': [
+                        {
+                            'Prefix': 'AWSLogs/{}/vpcflowlogs/{}/'.format(
+                                account_id, region_name
+                            ),
+                        }
+                        for region_name in ('pangaea-1', 'pangaea-2')
+                    ]
+                }
+            ]
+
+        def list_keys(Bucket, Prefix):
+            account_id, __, region_name = Prefix.split('/')[1:4]
+            file_name = (
+                '{}_vpcflowlogs_{}_fl-102010_20150812T1200Z_h45h.log.gz'
+            ).format(account_id, region_name)
+            return {'Contents': [{'Key': Prefix + file_name, 'ETag': '"1"'}]}
+
+        def paginate(Bucket, Prefix, Delimiter):
+            self.assertEqual(Bucket, 'example-bucket')
+            if Prefix == 'AWSLogs/':
+                return account_pages
+            return region_pages(Prefix.split('/')[1])
+
+        mock_client = MagicMock()
+        mock_client.get_paginator.return_value.paginate.side_effect = paginate
+        mock_client.list_objects_v2.side_effect = list_keys
+        return mock_client
+
+    def test_get_all_keys(self):
+        mock_client = self._get_listing_client()
+        expected = [
+            (
+                'AWSLogs/{0}/vpcflowlogs/{1}/2015/08/12/'
+                '{0}_vpcflowlogs_{1}_fl-102010_20150812T1200Z_h45h.log.gz'
+            ).format(account_id, region_name)
+            for account_id in ('123456789010', '123456789011')
+            for region_name in ('pangaea-1', 'pangaea-2')
+        ]
+
+        # Concurrent listing gives the same keys in the same order
+        for max_workers in (None, 3):
+            reader = S3FlowLogsReader(
+                'example-bucket',
+                start_time=self.start_time,
+                end_time=self.end_time,
+                max_workers=max_workers,
+                boto_client=mock_client,
+            )
+            actual = [x['Key'] for x in reader._get_all_keys()]
+            self.assertEqual(actual, expected)
+
+    def test_prefix_cache(self):
+        mock_client = self._get_listing_client()
+        paginate = mock_client.get_paginator.return_value.paginate
+        cache_dir = mkdtemp()
+        prefix_cache_path = join(cache_dir, 'prefixes.json')
+
+        def get_reader(prefix_cache_ttl, prefix_cache_path=None):
+            return S3FlowLogsReader(
+                'example-bucket',
+                start_time=self.start_time,
+                end_time=self.end_time,
+                include_regions={'pangaea-2'},
+                prefix_cache_ttl=prefix_cache_ttl,
+                prefix_cache_path=prefix_cache_path,
+                boto_client=mock_client,
+            )
+
+        def list_calls():
+            return [
+                x[2]['Prefix'] for x in paginate.mock_calls
+                if 'Delimiter' in x[2]
+            ]
+
+        try:
+            # Accounts and regions are listed the first time
+            reader = get_reader(60)
+            expected = list(reader._get_all_keys())
+            self.assertEqual(len(expected), 2)
+            self.assertEqual(len(list_calls()), 3)
+
+            # They're remembered the second time
+            paginate.reset_mock()
+            self.assertEqual(list(reader._get_all_keys()), expected)
+            self.assertEqual(list_calls(), [])
+
+            # ...but only in memory, unless a file is given
+            self.assertEqual(list(get_reader(60)._get_all_keys()), expected)
+            self.assertEqual(len(list_calls()), 3)
+
+            paginate.reset_mock()
+            list(get_reader(60, prefix_cache_path)._get_all_keys())
+            self.assertEqual(len(list_calls()), 3)
+            paginate.reset_mock()
+            reader = get_reader(60, prefix_cache_path)
+            self.assertEqual(list(reader._get_all_keys()), expected)
+            self.assertEqual(list_calls(), [])
+
+            # Expired entries are ignored
+            with patch('flowlogs_reader.cache.time') as mock_time:
+                mock_time.return_value = time() + 61
+                actual = list(reader._get_all_keys())
+            self.assertEqual(actual, expected)
+            self.assertEqual(len(list_calls()), 3)
+        finally:
+            rmtree(cache_dir)
+
+    def test_follow(self):
+        # One flow log, which gets new files while we're waiting
+        prefix = 'AWSLogs/123456789010/vpcflowlogs/pangaea-1/2015/08/12/'
+        now = datetime.utcnow()
+
+        def get_key(minutes_ago, file_hash):
+            stamp = (now - timedelta(minutes=minutes_ago)).strftime(
+                '%Y%m%dT%H%MZ'
+            )
+            return (
+                '{}123456789010_vpcflowlogs_pangaea-1_fl-102010_{}_{}.log.gz'
+            ).format(prefix, stamp, file_hash)
+
+        header = ' '.join(FlowRecord.__slots__)
+        all_files = {
+            get_key(20, 'h1'): SAMPLE_RECORDS[0],
+            get_key(10, 'h2'): SAMPLE_RECORDS[1],
+        }
+
+        def list_objects_v2(
+            Bucket, Prefix, StartAfter='', ContinuationToken=None
+        ):
+            if ContinuationToken is not None:
+                StartAfter = ContinuationToken
+            remaining = [x for x in sorted(all_files) if x > StartAfter]
+            response = {'Contents': [{'Key': x} for x in remaining[:1]]}
+            if len(remaining) > 1:
+                response['IsTruncated'] = True
+                response['NextContinuationToken'] = remaining[0]
+            return response
+
+        def get_object(Bucket, Key):
+            data = compress('\n'.join([header, all_files[Key]]))
+            return {'Body': BytesIO(data)}
+
+        def sleep(seconds):
+            # The first new file was delivered late - it's older than the
+            # ones that were already read
+            all_files[get_key(25, 'h0')] = SAMPLE_RECORDS[2]
+            all_files[get_key(10, 'h1')] = SAMPLE_RECORDS[3]
+
+        mock_client = MagicMock()
+        mock_client.list_objects_v2.side_effect = list_objects_v2
+        mock_client.get_object.side_effect = get_object
+
+        def read(checkpoint_path, max_polls, start_time=None):
+            reader = S3FlowLogsReader(
+                'example-bucket',
+                start_time=start_time,
+                boto_client=mock_client,
+            )
+            reader._get_account_prefixes = lambda: ['AWSLogs/123456789010/']
+            reader._get_day_prefixes = lambda account_prefix: [prefix]
+            return list(reader.follow(checkpoint_path, max_polls=max_polls))
+
+        temp_dir = mkdtemp()
+        checkpoint_path = join(temp_dir, 'checkpoint.json')
+        try:
+            with patch('flowlogs_reader.flowlogs_reader.sleep', sleep):
+                actual = read(
+                    checkpoint_path, 2, start_time=now - timedelta(minutes=30)
+                )
+            expected = [
+                FlowRecord.from_message(x) for x in SAMPLE_RECORDS[:4]
+            ]
+            self.assertEqual(actual, expected)
+
+            # Resuming from the checkpoint, without a start time, gives only
+            # new files, late ones included
+            all_files[get_key(20, 'h3')] = SAMPLE_RECORDS[4]
+            actual = read(checkpoint_path, 1)
+            expected = [FlowRecord.from_message(SAMPLE_RECORDS[4])]
+            self.assertEqual(actual, expected)
+        finally:
+            rmtree(temp_dir)
+
+
+class LocalFlowLogsReaderTestCase(TestCase):
+    def setUp(self):
+        self.base_dir = mkdtemp()
+        header = ' '.join(FlowRecord.__slots__)
+        file_name = '123456789010_vpcflowlogs_{}_fl-102010_{}_h45h.log{}'
+        for account_id, region, stamp, ext, message in [
+            # Compressed and uncompressed files are read
+            ('123456789010', 'pangaea-1', '20150812T1200Z', '.gz', 0),
+            ('123456789010', 'pangaea-1', '20150812T1205Z', '', 1),
+            ('123456789010', 'pangaea-2', '20150812T1210Z', '.gz', 2),
+            # This one is too new
+            ('123456789010', 'pangaea-2', '20150812T1300Z', '.gz', 3),
+            # This one is from another account
+            ('123456789011', 'pangaea-1', '20150812T1200Z', '.gz', 4),
+        ]:
+            dir_path = join(
+                self.base_dir,
+                'AWSLogs',
+                account_id,
+                'vpcflowlogs',
+                region,
+                '2015',
+                '08',
+                '12',
+            )
+            try:
+                makedirs(dir_path)
+            except OSError:
+                pass
+
+            path = join(dir_path, file_name.format(region, stamp, ext))
+            text = '\n'.join([header, SAMPLE_RECORDS[message]]) + '\n'
+            data = compress(text) if ext else text.encode('utf-8')
+            with open(path, 'wb') as f:
+                f.write(data)
+
+        # Empty files are skipped
+        path = path.replace('123456789011', '123456789010')
+        open(path.replace('1200Z', '1201Z').replace('.gz', ''), 'wb').close()
+
+    def tearDown(self):
+        rmtree(self.base_dir)
+
+    def test_iteration(self):
+        for max_workers in (None, 2):
+            reader = LocalFlowLogsReader(
+                self.base_dir,
+                start_time=datetime(2015, 8, 12, 12, 0, 0),
+                end_time=datetime(2015, 8, 12, 13, 0, 0),
+                include_accounts=['123456789010'],
+                max_workers=max_workers,
+            )
+            self.assertIsNone(reader.boto_client)
+            actual = list(reader)
+            expected = [FlowRecord.from_message(x) for x in SAMPLE_RECORDS[:3]]
+            self.assertEqual(actual, expected)
+
+        # Regions are also filtered, and missing directories are ignored
+        reader = LocalFlowLogsReader(
+            self.base_dir,
+            start_time=datetime(2015, 8, 12, 12, 0, 0),
+            end_time=datetime(2015, 8, 14, 13, 0, 0),
+            include_regions=['pangaea-2'],
+        )
+        actual = [x.srcaddr for x in reader]
+        expected = [
+            FlowRecord.from_message(x).srcaddr for x in SAMPLE_RECORDS[2:4]
+        ]
+        self.assertEqual(actual, expected)
+
 
 class AggregationTestCase(TestCase):
     def test_aggregated_records(self):
@@ -505,3 +1300,193 @@ class AggregationTestCase(TestCase):
             },
         ]
         self.assertEqual(actual, expected)
+
+    def test_aggregated_records_spill(self):
+        # Having a small flow table gives the same results
+        messages = [
+            SAMPLE_RECORDS[0],
+            SAMPLE_RECORDS[1],
+            SAMPLE_RECORDS[2].replace('REJECT', 'ACCEPT'),
+            SAMPLE_RECORDS[3],
+            SAMPLE_RECORDS[0].replace('198.51.100.1', '198.51.100.2'),
+            SAMPLE_RECORDS[0],
+        ]
+        expected = sorted(
+            aggregated_records(FlowRecord.from_message(x) for x in messages),
+            key=lambda x: x['srcaddr'],
+        )
+
+        spill_dir = mkdtemp()
+        try:
+            for max_flows in (0, 1, 2):
+                results = aggregated_records(
+                    (FlowRecord.from_message(x) for x in messages),
+                    max_flows=max_flows,
+                    spill_dir=spill_dir,
+                )
+                actual = sorted(results, key=lambda x: x['srcaddr'])
+                self.assertEqual(actual, expected)
+        finally:
+            rmtree(spill_dir)
+
+    def test_spill_partitions(self):
+        # Partitions with more than max_flows keys are split up again as
+        # they're read back, so the flow tables stay small
+        all_keys = [(i,) for i in range(1000)]
+        spill_dir = mkdtemp()
+        try:
+            spilled = _SpilledFlows(spill_dir, max_flows=4)
+            for i in range(2):
+                for j in range(0, len(all_keys), 5):
+                    flow_table = defaultdict(_FlowStats)
+                    for key in all_keys[j:j + 5]:
+                        flow_table[key].merge(
+                            datetime(2015, 8, 12), datetime(2015, 8, 12), 1, 0
+                        )
+                    spilled.spill(flow_table)
+
+            all_tables = list(spilled.iter_tables())
+            self.assertLessEqual(max(len(x) for x in all_tables), 4)
+            actual = {
+                key: stats.packets
+                for flow_table in all_tables
+                for key, stats in flow_table.items()
+            }
+            self.assertEqual(actual, {key: 2 for key in all_keys})
+        finally:
+            rmtree(spill_dir)
+
+    def test_merged_aggregates(self):
+        # Aggregating parts of the records and then merging them gives the
+        # same results as aggregating all of them
+        messages = [
+            SAMPLE_RECORDS[0],
+            SAMPLE_RECORDS[1],
+            SAMPLE_RECORDS[2].replace('REJECT', 'ACCEPT'),
+            SAMPLE_RECORDS[3],
+            SAMPLE_RECORDS[0].replace('198.51.100.1', '198.51.100.2'),
+            SAMPLE_RECORDS[0].replace('1439387263', '1439387200'),
+        ]
+        expected = sorted(
+            aggregated_records(FlowRecord.from_message(x) for x in messages),
+            key=lambda x: x['srcaddr'],
+        )
+
+        all_items = []
+        for part in (messages[:2], messages[2:4], messages[4:]):
+            all_items.extend(
+                aggregated_records(FlowRecord.from_message(x) for x in part)
+            )
+        for max_flows in (None, 1):
+            actual = sorted(
+                merged_aggregates(all_items, max_flows=max_flows),
+                key=lambda x: x['srcaddr'],
+            )
+            self.assertEqual(actual, expected)
+
+    def test_heavy_hitters(self):
+        all_records = [FlowRecord.from_message(x) for x in SAMPLE_RECORDS]
+        actual = list(heavy_hitters(all_records, k=1))
+        expected = [
+            {
+                'srcaddr': '192.0.2.1',
+                'dstaddr': '198.51.100.1',
+                'bytes': 3360,
+                'error': 0,
+            }
+        ]
+        self.assertEqual(actual, expected)
+
+        actual = list(
+            heavy_hitters(
+                all_records, key_fields=('dstport',), value='packets'
+            )
+        )
+        expected = [
+            {'dstport': 443, 'packets': 40, 'error': 0},
+            {'dstport': 49152, 'packets': 10, 'error': 0},
+        ]
+        self.assertEqual(actual, expected)
+
+        # With a small capacity the totals may be overstated, but never by
+        # more than the error
+        actual = list(
+            heavy_hitters(
+                all_records, k=1, key_fields=('dstaddr',), capacity=1
+            )
+        )
+        expected = [{'dstaddr': '198.51.100.1', 'bytes': 4200, 'error': 840}]
+        self.assertEqual(actual, expected)
+
+    def test_windowed_aggregated_records(self):
+        # Record the number of records read when each item is yielded
+        consumed = []
+
+        def all_records():
+            # The records end at 13:47:44, 13:47:45, 13:47:46, and then one
+            # ends late, at 13:47:44.
+            messages = SAMPLE_RECORDS[:4] + [SAMPLE_RECORDS[0]]
+            for message in messages:
+                yield FlowRecord.from_message(message)
+                consumed.append(message)
+
+        results = windowed_aggregated_records(
+            all_records(), timedelta(seconds=2), key_fields=('interface_id',)
+        )
+        actual = []
+        for item in results:
+            actual.append((len(consumed), item))
+
+        # The first window is closed by the record that ends at 13:47:46.
+        # The last record is too late for it.
+        expected = [
+            (
+                2,
+                {
+                    'interface_id': 'eni-102010ab',
+                    'start': datetime(2015, 8, 12, 13, 47, 43),
+                    'end': datetime(2015, 8, 12, 13, 47, 45),
+                    'packets': 30,
+                    'bytes': 2520,
+                    'window_start': datetime(2015, 8, 12, 13, 47, 44),
+                    'window_end': datetime(2015, 8, 12, 13, 47, 46),
+                },
+            ),
+            (
+                5,
+                {
+                    'interface_id': 'eni-102010cd',
+                    'start': datetime(2015, 8, 12, 13, 47, 43),
+                    'end': datetime(2015, 8, 12, 13, 47, 46),
+                    'packets': 20,
+                    'bytes': 1680,
+                    'window_start': datetime(2015, 8, 12, 13, 47, 46),
+                    'window_end': datetime(2015, 8, 12, 13, 47, 48),
+                },
+            ),
+        ]
+        self.assertEqual(actual, expected)
+
+    def test_windowed_aggregated_records_sliding(self):
+        messages = SAMPLE_RECORDS[:3]
+        results = windowed_aggregated_records(
+            (FlowRecord.from_message(x) for x in messages),
+            timedelta(seconds=2),
+            key_fields=('protocol',),
+            slide=timedelta(seconds=1),
+            lateness=timedelta(seconds=5),
+        )
+        actual = [
+            (x['window_start'].second, x['packets'], x['bytes'])
+            for x in results
+        ]
+
+        # Each record is counted in two windows. Nothing is closed until the
+        # end because of the lateness allowance.
+        expected = [
+            (43, 10, 840),
+            (44, 30, 2520),
+            (45, 40, 3360),
+            (46, 20, 1680),
+        ]
+        self.assertEqual(actual, expected)
@@ -16,7 +16,7 @@ from __future__ import print_function
 
 import io
 from datetime import datetime
-from unittest import TestCase
+from unittest import skipIf, TestCase
 
 try:
     from itertools import zip_longest
@@ -29,12 +29,14 @@ except ImportError:
     from io import StringIO
 
 try:
-    from unittest.mock import MagicMock, patch
+    from unittest.mock import ANY, MagicMock, patch
 except ImportError:
-    from mock import MagicMock, patch
+    from mock import ANY, MagicMock, patch
 
-from flowlogs_reader import FlowRecord
+from flowlogs_reader import FlowLogsReader, FlowRecord, ReaderStats
 from flowlogs_reader.__main__ import main, actions
+from flowlogs_reader.flowlogs_reader import S3FlowLogsReader
+from flowlogs_reader.columnar import iter_batches, np
 
 
 SAMPLE_INPUT = [
@@ -62,20 +64,42 @@ SAMPLE_INPUT = [
 SAMPLE_RECORDS = [FlowRecord.from_message(m) for m in SAMPLE_INPUT]
 
 
+class _InlinePool(object):
+    # Stands in for multiprocessing.Pool, but does the work in this process
+    def __init__(self, processes, initializer, initargs):
+        self.processes = processes
+        initializer(*initargs)
+
+    def imap(self, func, iterable):
+        return (func(x) for x in iterable)
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
+
 class MainTestCase(TestCase):
     @patch('flowlogs_reader.__main__.FlowLogsReader', autospec=True)
     def test_main(self, mock_reader):
         main(['mygroup'])
-        mock_reader.assert_called_with(log_group_name='mygroup')
+        mock_reader.assert_called_with(
+            log_group_name='mygroup', client_factory=ANY
+        )
 
         main(['-s', '2015-05-05 14:20:00', 'mygroup'])
         mock_reader.assert_called_with(
-            log_group_name='mygroup', start_time=datetime(2015, 5, 5, 14, 20),
+            log_group_name='mygroup',
+            client_factory=ANY,
+            start_time=datetime(2015, 5, 5, 14, 20),
         )
 
         main(['--end-time', '2015-05-05 14:20:00', 'mygroup'])
         mock_reader.assert_called_with(
-            log_group_name='mygroup', end_time=datetime(2015, 5, 5, 14, 20),
+            log_group_name='mygroup',
+            client_factory=ANY,
+            end_time=datetime(2015, 5, 5, 14, 20),
         )
 
         main([
@@ -84,24 +108,44 @@ class MainTestCase(TestCase):
             'mygroup'
         ])
         mock_reader.assert_called_with(
-            log_group_name='mygroup', start_time=datetime(2015, 5, 5),
+            log_group_name='mygroup',
+            client_factory=ANY,
+            start_time=datetime(2015, 5, 5),
         )
 
         main(['--region', 'us-west-1', 'mygroup'])
         mock_reader.assert_called_with(
-            log_group_name='mygroup', region_name='us-west-1',
+            log_group_name='mygroup',
+            client_factory=ANY,
+            region_name='us-west-1',
         )
 
         main(['--profile', 'my-profile', 'mygroup'])
         mock_reader.assert_called_with(
-            log_group_name='mygroup', profile_name='my-profile'
+            log_group_name='mygroup',
+            client_factory=ANY,
+            profile_name='my-profile'
         )
 
         main(['--filter-pattern', 'REJECT', 'mygroup'])
         mock_reader.assert_called_with(
-            log_group_name='mygroup', filter_pattern='REJECT'
+            log_group_name='mygroup',
+            client_factory=ANY,
+            filter_pattern='REJECT'
+        )
+
+        main(['--filter-expression', 'dstport == 22', 'mygroup'])
+        mock_reader.assert_called_with(
+            log_group_name='mygroup',
+            client_factory=ANY,
+            filter_expression='dstport == 22'
         )
 
+        main(['--request-rate', '20', '--max-retries', '3', 'mygroup'])
+        __, kwargs = mock_reader.call_args
+        self.assertEqual(kwargs['rate_limiter'].rate, 20)
+        self.assertEqual(kwargs['max_retries'], 3)
+
     @patch('flowlogs_reader.__main__.FlowLogsReader', autospec=True)
     @patch('flowlogs_reader.__main__.print', create=True)
     def test_main_print(self, mock_out, mock_reader):
@@ -155,6 +199,123 @@ class MainTestCase(TestCase):
             actual_set.add(line)
         self.assertEqual(actual_set, expected_set)
 
+    @patch('flowlogs_reader.__main__.FlowLogsReader', autospec=True)
+    def test_main_ipcount(self, mock_reader):
+        mock_reader.return_value = SAMPLE_RECORDS
+
+        def get_output(*action):
+            with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+                main(['mygroup', 'ipcount'] + list(action))
+            return mock_stdout.getvalue().splitlines()
+
+        # SKIPDATA and NODATA records aren't counted
+        self.assertEqual(get_output(), ['3'])
+        self.assertEqual(get_output('method=exact'), ['3'])
+        self.assertEqual(
+            get_output('group_by=interface_id', 'precision=10'),
+            ['eni-102010ab\t3'],
+        )
+
+        mock_reader.return_value = []
+        self.assertEqual(get_output('group_by=account_id'), [])
+        self.assertEqual(get_output('method=exact'), ['0'])
+
+        for action in (
+            ['method=other'],
+            ['group_by=srcaddr'],
+            ['method=exact', 'precision=10'],
+        ):
+            with self.assertRaises(RuntimeError):
+                get_output(*action)
+
+    @patch('flowlogs_reader.__main__.FlowLogsReader', autospec=True)
+    def test_main_top(self, mock_reader):
+        mock_reader.return_value = SAMPLE_RECORDS
+
+        def get_output(*action):
+            with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+                main(['mygroup', 'top'] + list(action))
+            return mock_stdout.getvalue().splitlines()
+
+        self.assertEqual(
+            get_output('k=2'),
+            [
+                'srcaddr\tdstaddr\tbytes\terror',
+                '192.0.2.1\t198.51.100.1\t1680\t0',
+                '192.0.2.1\t198.51.100.2\t1680\t0',
+            ],
+        )
+        self.assertEqual(
+            get_output('by=interface_id', 'value=packets', 'capacity=5'),
+            ['interface_id\tpackets\terror', 'eni-102010ab\t50\t0'],
+        )
+
+        for action in (['by=other'], ['value=start'], ['count=2']):
+            with self.assertRaises(RuntimeError):
+                get_output(*action)
+
+    @patch('flowlogs_reader.__main__.export_records', autospec=True)
+    @patch('flowlogs_reader.__main__.FlowLogsReader', autospec=True)
+    def test_main_export(self, mock_reader, mock_export):
+        mock_reader.return_value = SAMPLE_RECORDS
+        mock_export.return_value = ['out/a.arrow', 'out/b.arrow']
+        with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            main(['mygroup', 'export', 'out', 'format=arrow'])
+            output = mock_stdout.getvalue().splitlines()
+
+        self.assertEqual(output, ['out/a.arrow', 'out/b.arrow'])
+        mock_export.assert_called_once_with(
+            SAMPLE_RECORDS,
+            'out',
+            file_format='arrow',
+            row_group_size=65536,
+            compression='snappy',
+        )
+
+        with self.assertRaises(RuntimeError):
+            main(['mygroup', 'export'])
+
+    @patch('flowlogs_reader.__main__.FlowLogsReader', autospec=True)
+    def test_main_stats(self, mock_reader):
+        # A real reader is made, with a fake client
+        paginator = MagicMock()
+        paginator.paginate.return_value = [
+            {'events': [{'message': x} for x in SAMPLE_INPUT]},
+        ]
+        mock_client = MagicMock()
+        mock_client.get_paginator.return_value = paginator
+        mock_reader.side_effect = lambda *args, **kwargs: FlowLogsReader(
+            *args, boto_client=mock_client, **kwargs
+        )
+
+        with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            with patch('sys.stderr', new_callable=StringIO) as mock_stderr:
+                main(['--stats', 'mygroup', 'findip', '198.51.100.2'])
+
+        output = mock_stdout.getvalue().splitlines()
+        self.assertEqual(output, SAMPLE_INPUT[2:3])
+        __, kwargs = mock_reader.call_args
+        self.assertIsInstance(kwargs['stats'], ReaderStats)
+        self.assertNotIn('progress_callback', kwargs)
+        stats_output = mock_stderr.getvalue()
+        self.assertIn('api calls: 1 (filter_log_events: 1)', stats_output)
+        self.assertIn('records: 1 parsed', stats_output)
+        self.assertIn('4 skipped', stats_output)
+
+        # Progress may be printed instead
+        main(['--progress-interval', '5', 'mygroup'])
+        __, kwargs = mock_reader.call_args
+        self.assertEqual(kwargs['progress_interval'], 5)
+        self.assertIsNotNone(kwargs['progress_callback'])
+
+        # Worker processes' stats aren't collected
+        with patch('sys.stderr', new_callable=StringIO) as mock_stderr:
+            main(['--stats', '--processes', '2', 'mygroup', 'ipset'])
+        self.assertEqual(
+            mock_stderr.getvalue(),
+            '--processes may not be used with --stats or --progress-interval\n'
+        )
+
     @patch('flowlogs_reader.__main__.FlowLogsReader', autospec=True)
     @patch('flowlogs_reader.__main__.print', create=True)
     def test_main_findip(self, mock_out, mock_reader):
@@ -168,6 +329,19 @@ class MainTestCase(TestCase):
             line = args[0]
             self.assertEqual(line, record)
 
+    @patch('flowlogs_reader.__main__.FlowLogsReader', autospec=True)
+    def test_main_findip_cidr(self, mock_reader):
+        mock_reader.return_value = SAMPLE_RECORDS
+        with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            main(['mygroup', 'findip', '198.51.100.0/31'])
+            output = mock_stdout.getvalue().splitlines()
+        self.assertEqual(output, SAMPLE_INPUT[:2])
+
+        # The reader gets a filter that looks at the messages
+        message_filter = mock_reader.call_args[1]['message_filter']
+        self.assertTrue(message_filter(SAMPLE_INPUT[0]))
+        self.assertFalse(message_filter(SAMPLE_INPUT[2]))
+
     @patch('flowlogs_reader.__main__.FlowLogsReader', autospec=True)
     @patch('flowlogs_reader.__main__.print', create=True)
     def test_main_bad_action(self, mock_out, mock_reader):
@@ -199,30 +373,47 @@ class MainTestCase(TestCase):
             line = args[0]
             self.assertEqual(line, result)
 
+    @patch('flowlogs_reader.__main__.S3FlowLogsReader', autospec=True)
     @patch('flowlogs_reader.__main__.FlowLogsReader', autospec=True)
-    @patch('flowlogs_reader.__main__.boto3', autospec=True)
-    def test_main_assume_role(self, mock_boto3, mock_reader):
-        mock_boto3.client.return_value.assume_role.return_value = {
-            'Credentials': {
-                'AccessKeyId': 'myaccesskeyid',
-                'SecretAccessKey': 'mysecretaccesskey',
-                'SessionToken': 'mysessiontoken',
-            }
-        }
-        mock_client = MagicMock()
-        mock_boto3.session.Session.return_value.client.return_value = (
-            mock_client
-        )
+    def test_main_assume_role(self, mock_reader, mock_s3_reader):
         mock_reader.return_value = []
         main(['--role-arn', 'myarn', '--external-id', 'uuid4', 'mygroup'])
+        mock_reader.assert_called_once_with(
+            log_group_name='mygroup',
+            role_arn='myarn',
+            external_id='uuid4',
+            client_factory=ANY,
+        )
 
-        mock_boto3.session.Session.assert_called_once_with(
-            aws_access_key_id='myaccesskeyid',
-            aws_secret_access_key='mysecretaccesskey',
-            aws_session_token='mysessiontoken',
+        # The same factory is used for each reader, so the role's
+        # credentials are re-used
+        mock_s3_reader.return_value = []
+        main(['--location-type', 's3', '--role-arn', 'myarn', 'mybucket'])
+        mock_s3_reader.assert_called_once_with(
+            location='mybucket',
+            role_arn='myarn',
+            client_factory=mock_reader.call_args[1]['client_factory'],
         )
-        mock_reader.assert_called_once_with(
-            log_group_name='mygroup', boto_client=mock_client
+
+    @patch('flowlogs_reader.__main__.FlowLogsReader', autospec=True)
+    @patch('flowlogs_reader.__main__.print', create=True)
+    def test_main_follow(self, mock_out, mock_reader):
+        mock_follow = mock_reader.return_value.follow
+        mock_follow.return_value = SAMPLE_RECORDS
+
+        # A checkpoint file alone means one check
+        main(['--checkpoint-file', 'checkpoint.json', 'mygroup'])
+        mock_follow.assert_called_once_with(
+            checkpoint_path='checkpoint.json', max_polls=1
+        )
+        self.assertEqual(
+            [call[1][0] for call in mock_out.mock_calls], SAMPLE_INPUT
+        )
+
+        mock_follow.reset_mock()
+        main(['--follow', '--poll-interval', '5', 'mygroup'])
+        mock_follow.assert_called_once_with(
+            checkpoint_path=None, poll_interval=5.0
         )
 
     @patch('flowlogs_reader.__main__.FlowLogsReader', autospec=True)
@@ -260,6 +451,148 @@ class MainTestCase(TestCase):
         ]
         self.assertEqual(actual_line, expected_line)
 
+    @skipIf(np is None, 'NumPy is not installed')
+    @patch('flowlogs_reader.__main__.FlowLogsReader', autospec=True)
+    def test_main_aggregate_numpy(self, mock_reader):
+        mock_reader.return_value.iter_batches.side_effect = (
+            lambda: iter_batches([SAMPLE_INPUT[0], SAMPLE_INPUT[0]])
+        )
+        with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            main(['mygroup', 'aggregate', 'engine=numpy'])
+            output = mock_stdout.getvalue().splitlines()
+
+        self.assertEqual(len(output), 2)
+        actual_line = output[1].split('\t')
+        expected_line = [
+            '1680',
+            '192.0.2.1',
+            '49152',
+            '2015-08-12 13:47:44',
+            '20',
+            '6',
+            '198.51.100.1',
+            '443',
+            '2015-08-12 13:47:43',
+        ]
+        self.assertEqual(actual_line, expected_line)
+
+    @patch('flowlogs_reader.__main__.aggregated_records', autospec=True)
+    @patch('flowlogs_reader.__main__.FlowLogsReader', autospec=True)
+    def test_main_aggregate_max_flows(self, mock_reader, mock_aggregated):
+        mock_reader.return_value = SAMPLE_RECORDS
+        mock_aggregated.return_value = iter([{'bytes': 1}])
+        with patch('sys.stdout', new_callable=StringIO):
+            main(['mygroup', 'aggregate', 'max_flows=100'])
+        mock_aggregated.assert_called_once_with(SAMPLE_RECORDS, max_flows=100)
+
+    @patch('flowlogs_reader.__main__.FlowLogsReader', autospec=True)
+    def test_main_aggregate_window(self, mock_reader):
+        mock_reader.return_value = SAMPLE_RECORDS[:3]
+        with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            main(['mygroup', 'aggregate', 'window=60', 'lateness=10'])
+            output = mock_stdout.getvalue().splitlines()
+
+        header = output[0].split('\t')
+        self.assertEqual(header[-2:], ['window_end', 'window_start'])
+        self.assertEqual(len(output), 4)
+        for line in output[1:]:
+            window_end, window_start = line.split('\t')[-2:]
+            self.assertEqual(window_start, '2015-08-12 13:47:00')
+            self.assertEqual(window_end, '2015-08-12 13:48:00')
+
+    @patch('flowlogs_reader.__main__.FlowLogsReader', autospec=True)
+    def test_main_aggregate_bad_args(self, mock_reader):
+        mock_reader.return_value = SAMPLE_RECORDS
+        with self.assertRaises(RuntimeError):
+            main(['mygroup', 'aggregate', 'engine=other'])
+
+        with self.assertRaises(RuntimeError):
+            main(['mygroup', 'aggregate', 'other=numpy'])
+
+        with self.assertRaises(RuntimeError):
+            main(['mygroup', 'aggregate', 'numpy'])
+
+        with self.assertRaises(RuntimeError):
+            main(['mygroup', 'aggregate', 'window=60', 'engine=numpy'])
+
+        with self.assertRaises(RuntimeError):
+            main(['mygroup', 'aggregate', 'lateness=60'])
+
+    def _get_s3_reader(self):
+        # Each file has one record
+        reader = MagicMock(spec=S3FlowLogsReader)
+        reader._get_all_keys.return_value = [
+            {'Key': 'key_{}'.format(i)} for i in range(len(SAMPLE_INPUT))
+        ]
+        reader._read_file.side_effect = (
+            lambda key, etag: [SAMPLE_INPUT[int(key.split('_')[1])]]
+        )
+        reader._filter_events.side_effect = lambda all_events: all_events
+        return reader
+
+    @patch('flowlogs_reader.__main__.Pool', _InlinePool)
+    @patch('flowlogs_reader.__main__.S3FlowLogsReader', autospec=True)
+    def test_main_processes(self, mock_reader):
+        mock_reader.return_value = self._get_s3_reader()
+        argv = ['--location-type', 's3', '--processes', '2', 'mybucket']
+
+        def get_output(action, processes=2):
+            argv = [
+                '--location-type', 's3', '--processes', str(processes),
+                'mybucket',
+            ]
+            with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+                main(argv + action)
+                return mock_stdout.getvalue().splitlines()
+
+        # Compare with the single process output
+        for action in (
+            ['findip', '198.51.100.2'],
+            ['ipset'],
+            ['ipcount', 'group_by=account_id'],
+            ['ipcount', 'method=exact'],
+            ['top', 'by=srcaddr,dstport'],
+            ['aggregate'],
+            ['aggregate', 'engine=numpy'],
+        ):
+            if ('engine=numpy' in action) and (np is None):
+                continue
+
+            actual = get_output(action)
+            mock_reader.return_value = SAMPLE_RECORDS
+            expected = get_output(action, processes=0)
+            mock_reader.return_value = self._get_s3_reader()
+            self.assertEqual(sorted(actual), sorted(expected))
+            self.assertTrue(actual)
+
+        # Only some options are supported
+        with self.assertRaises(RuntimeError):
+            main(argv + ['aggregate', 'window=60'])
+
+        with patch('sys.stderr', new_callable=StringIO) as mock_stderr:
+            main(argv + ['print'])
+        self.assertEqual(
+            mock_stderr.getvalue(),
+            'action print may not be used with --processes\n'
+        )
+
+    @patch('flowlogs_reader.__main__.Pool', _InlinePool)
+    @patch('flowlogs_reader.__main__.FlowLogsReader', autospec=True)
+    def test_main_processes_cwl(self, mock_reader):
+        # Each part of the time range has a few of the records
+        reader = mock_reader.return_value
+        reader._get_time_shards.return_value = [(0, 3), (3, 5)]
+        reader._filter_events.side_effect = lambda all_events: all_events
+        reader._read_interleaved.side_effect = lambda: [
+            {'message': x} for x in SAMPLE_INPUT[reader.start_ms:reader.end_ms]
+        ]
+        with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            main(['--processes', '2', 'mygroup', 'findip', '192.0.2.1'])
+            output = mock_stdout.getvalue().splitlines()
+
+        self.assertEqual(output, SAMPLE_INPUT[:3])
+        reader._get_time_shards.assert_called_once_with(2)
+
     @patch('flowlogs_reader.__main__.S3FlowLogsReader', autospec=True)
     @patch('flowlogs_reader.__main__.print', create=True)
     def test_s3_destination(self, mock_out, mock_reader):
@@ -277,8 +610,30 @@ class MainTestCase(TestCase):
             location='mybucket/myprefix',
             include_accounts=['999999999998', '999999999999'],
             include_regions=['us-east-1', 'us-east-2'],
+            client_factory=ANY,
         )
         for call, record in zip_longest(mock_out.mock_calls, SAMPLE_INPUT):
             __, args, kwargs = call
             line = args[0]
             self.assertEqual(line, record)
+
+    @patch('flowlogs_reader.__main__.LocalFlowLogsReader', autospec=True)
+    def test_local_destination(self, mock_reader):
+        mock_reader.return_value = SAMPLE_RECORDS
+        with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            main(
+                [
+                    '/data/flowlogs',
+                    '--location-type', 'local',
+                    '--include-accounts', '999999999998',
+                    '--max-workers', '4',
+                ]
+            )
+            output = mock_stdout.getvalue().splitlines()
+
+        mock_reader.assert_called_once_with(
+            location='/data/flowlogs',
+            include_accounts=['999999999998'],
+            max_workers=4,
+        )
+        self.assertEqual(output, SAMPLE_INPUT)
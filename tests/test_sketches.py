@@ -0,0 +1,131 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division, print_function
+
+import pickle
+from random import Random
+from unittest import TestCase
+
+from flowlogs_reader import HyperLogLog, IPCounter, SpaceSaving
+
+
+def _get_ips(first, last):
+    return ['10.{}.{}.{}'.format(i >> 16, (i >> 8) & 255, i & 255)
+            for i in range(first, last)]
+
+
+class HyperLogLogTestCase(TestCase):
+    def test_count(self):
+        for precision, size in [(14, 0), (14, 100), (14, 50000), (10, 20000)]:
+            sketch = HyperLogLog(precision)
+            sketch.update(_get_ips(0, size))
+            # Duplicates don't count
+            sketch.update(_get_ips(0, size // 2))
+            error = 1.04 / (2 ** (precision / 2))
+            self.assertLessEqual(
+                abs(sketch.count() - size), 3 * error * size, precision
+            )
+
+    def test_merge(self):
+        sketch_1 = HyperLogLog()
+        sketch_1.update(_get_ips(0, 20000))
+        sketch_2 = HyperLogLog()
+        sketch_2.update(_get_ips(10000, 30000))
+
+        # Sketches survive being sent between processes
+        sketch_1.merge(pickle.loads(pickle.dumps(sketch_2)))
+        self.assertLessEqual(abs(sketch_1.count() - 30000), 1000)
+
+        with self.assertRaises(ValueError):
+            sketch_1.merge(HyperLogLog(10))
+
+    def test_invalid(self):
+        for precision in (3, 19):
+            with self.assertRaises(ValueError):
+                HyperLogLog(precision)
+
+
+class IPCounterTestCase(TestCase):
+    def test_count(self):
+        counter = IPCounter()
+        counter.update(
+            ['192.0.2.1', '192.0.2.1', '192.0.2.2', '2001:db8::1', '-', None]
+        )
+        self.assertEqual(counter.count(), 3)
+
+        # IPv6 addresses are compared by value
+        counter.add('2001:DB8:0::1')
+        self.assertEqual(counter.count(), 3)
+
+        other = IPCounter()
+        other.update(['192.0.2.2', '192.0.2.3'])
+        counter.merge(other)
+        self.assertEqual(counter.count(), 4)
+
+
+class SpaceSavingTestCase(TestCase):
+    def _get_items(self, seed):
+        # A few heavy keys mixed in with many light ones
+        random = Random(seed)
+        all_items = [('heavy_{}'.format(i), 1000 * i) for i in range(1, 6)]
+        all_items.extend(('light_{}'.format(i), 1) for i in range(5000))
+        random.shuffle(all_items)
+        return all_items
+
+    def test_top(self):
+        summary = SpaceSaving(50)
+        summary.update(self._get_items(0))
+        self.assertEqual(len(summary.counts), 50)
+
+        actual = summary.top(5)
+        self.assertEqual(
+            [key for key, count, error in actual],
+            ['heavy_5', 'heavy_4', 'heavy_3', 'heavy_2', 'heavy_1'],
+        )
+        for key, count, error in actual:
+            true_count = 1000 * int(key.split('_')[1])
+            self.assertLessEqual(count - error, true_count)
+            self.assertGreaterEqual(count, true_count)
+
+        self.assertEqual(len(summary.top()), 50)
+
+    def test_merge(self):
+        summary = SpaceSaving(50)
+        summary.update(self._get_items(1))
+        other = SpaceSaving(50)
+        other.update(self._get_items(2))
+        summary.merge(pickle.loads(pickle.dumps(other)))
+
+        actual = summary.top(5)
+        self.assertEqual(
+            [key for key, count, error in actual],
+            ['heavy_5', 'heavy_4', 'heavy_3', 'heavy_2', 'heavy_1'],
+        )
+        for key, count, error in actual:
+            true_count = 2000 * int(key.split('_')[1])
+            self.assertLessEqual(count - error, true_count)
+            self.assertGreaterEqual(count, true_count)
+
+        # Merging into an empty summary keeps everything
+        empty = SpaceSaving(50)
+        empty.merge(other)
+        self.assertEqual(sorted(empty.top()), sorted(other.top()))
+
+        with self.assertRaises(ValueError):
+            summary.merge(SpaceSaving(10))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            SpaceSaving(0)
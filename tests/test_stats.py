@@ -0,0 +1,155 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division, print_function
+
+from datetime import timedelta
+from unittest import TestCase
+
+try:
+    from unittest.mock import MagicMock
+except ImportError:
+    from mock import MagicMock
+
+from flowlogs_reader import FlowLogsReader, ReaderStats, S3FlowLogsReader
+from flowlogs_reader.stats import InstrumentedClient, STATS_FLUSH_RECORDS
+
+from benchmarks.fakes import FakeS3Client
+from benchmarks.synthetic import HEADER, SyntheticFlowLogs
+
+
+SAMPLE_MESSAGES = [
+    (
+        '2 123456789010 eni-102010ab 198.51.100.1 192.0.2.1 '
+        '443 49152 6 10 840 1439387263 1439387264 ACCEPT OK'
+    ),
+    (
+        '2 123456789010 eni-102010ab 192.0.2.1 198.51.100.1 '
+        '49152 443 6 20 1680 1439387264 1439387265 ACCEPT OK'
+    ),
+    (
+        '2 123456789010 eni-1a2b3c4d - - - - - - - '
+        '1431280876 1431280934 - NODATA'
+    ),
+]
+
+
+class ReaderStatsTestCase(TestCase):
+    def test_add(self):
+        stats = ReaderStats()
+        stats.add(pages=2, network_time=0.5)
+        stats.add(pages=1, network_time=0.25)
+        stats.add_call('get_object', 1.0, pages=0, size=100)
+        self.assertEqual(stats.pages, 3)
+        self.assertEqual(stats.network_time, 1.75)
+        self.assertEqual(stats.api_calls, 1)
+        self.assertEqual(stats.bytes_downloaded, 100)
+        self.assertEqual(stats.operations, {'get_object': 1})
+
+    def test_count_events(self):
+        stats = ReaderStats()
+        all_events = stats.count_events(range(STATS_FLUSH_RECORDS + 10))
+
+        # Counts are added in groups, and when the iteration ends
+        for i in range(STATS_FLUSH_RECORDS + 1):
+            next(all_events)
+        self.assertEqual(stats.events_read, STATS_FLUSH_RECORDS)
+        all_events.close()
+        self.assertEqual(stats.events_read, STATS_FLUSH_RECORDS + 1)
+
+    def test_to_dict(self):
+        stats = ReaderStats()
+        stats.add(events_read=10, records_parsed=7)
+        stats.add_call('filter_log_events', 0.5, size=1024)
+        actual = stats.to_dict()
+        self.assertEqual(actual['records_skipped'], 3)
+        self.assertEqual(actual['operations'], {'filter_log_events': 1})
+        self.assertEqual(actual['api_calls'], 1)
+        self.assertEqual(actual['bytes_downloaded'], 1024)
+        self.assertEqual(actual['decompress_time'], 0.0)
+        self.assertGreaterEqual(actual['elapsed'], 0)
+
+        text = str(stats)
+        self.assertIn('api calls: 1 (filter_log_events: 1)', text)
+        self.assertIn('records: 7 parsed', text)
+        self.assertIn('3 skipped', text)
+
+
+class InstrumentedClientTestCase(TestCase):
+    def test_passthrough(self):
+        mock_client = MagicMock()
+        stats = ReaderStats()
+        client = InstrumentedClient(mock_client, stats)
+        self.assertIs(client.meta, mock_client.meta)
+        client.describe_log_streams(logGroupName='group_name')
+        mock_client.describe_log_streams.assert_called_once_with(
+            logGroupName='group_name'
+        )
+        self.assertEqual(stats.operations, {'describe_log_streams': 1})
+
+    def test_cwl_reader(self):
+        mock_client = MagicMock()
+        paginator = MagicMock()
+        paginator.paginate.return_value = [
+            {'events': [{'message': x} for x in SAMPLE_MESSAGES[:2]]},
+            {'events': [{'message': SAMPLE_MESSAGES[2]}]},
+        ]
+        mock_client.get_paginator.return_value = paginator
+
+        stats = ReaderStats()
+        reader = FlowLogsReader(
+            'group_name',
+            boto_client=mock_client,
+            filter_expression='action == "ACCEPT"',
+            stats=stats,
+        )
+        self.assertEqual(len(list(reader)), 2)
+        self.assertEqual(stats.operations, {'filter_log_events': 2})
+        self.assertEqual(stats.pages, 2)
+        self.assertEqual(
+            stats.bytes_downloaded, sum(len(x) for x in SAMPLE_MESSAGES)
+        )
+        self.assertEqual(stats.events_read, 3)
+        self.assertEqual(stats.records_parsed, 2)
+        self.assertEqual(stats.records_skipped, 1)
+
+    def test_s3_reader(self):
+        synthetic = SyntheticFlowLogs(2500, duration=timedelta(minutes=20))
+        s3_files = synthetic.get_s3_files()
+        progress = []
+        reader = S3FlowLogsReader(
+            'example-bucket',
+            boto_client=FakeS3Client(s3_files),
+            start_time=synthetic.start_time,
+            end_time=synthetic.end_time + timedelta(minutes=10),
+            progress_callback=progress.append,
+            progress_interval=0,
+        )
+        self.assertEqual(len(list(reader)), 2500)
+
+        # The stats object is made for the callback
+        stats = reader.stats
+        self.assertEqual(progress, [stats, stats])
+        self.assertEqual(stats.operations['get_object'], len(s3_files))
+        self.assertEqual(
+            stats.bytes_downloaded, sum(len(x) for x in s3_files.values())
+        )
+        self.assertEqual(
+            stats.bytes_decompressed,
+            synthetic.size + len(s3_files) * (len(HEADER) + 1),
+        )
+        self.assertEqual(stats.events_read, 2500)
+        self.assertEqual(stats.records_parsed, 2500)
+        self.assertGreater(stats.decompress_time, 0)
+        self.assertGreater(stats.parse_time, 0)
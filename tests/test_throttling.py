@@ -0,0 +1,176 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division, print_function
+
+from threading import Thread
+from time import sleep
+from unittest import TestCase
+
+from botocore.exceptions import ClientError
+
+try:
+    from unittest.mock import MagicMock, patch
+except ImportError:
+    from mock import MagicMock, patch
+
+from flowlogs_reader import (
+    FlowLogsReader, FlowRecord, RateLimiter, ReaderStats
+)
+from flowlogs_reader.throttling import ThrottledClient
+
+
+SAMPLE_MESSAGES = [
+    (
+        '2 123456789010 eni-102010ab 198.51.100.1 192.0.2.1 '
+        '443 49152 6 10 840 1439387263 1439387264 ACCEPT OK'
+    ),
+    (
+        '2 123456789010 eni-102010ab 192.0.2.1 198.51.100.1 '
+        '49152 443 6 20 1680 1439387264 1439387265 ACCEPT OK'
+    ),
+]
+
+
+def _get_error(code):
+    return ClientError(
+        {'Error': {'Code': code, 'Message': 'Error'}}, 'FilterLogEvents'
+    )
+
+
+class RateLimiterTestCase(TestCase):
+    def test_adapt(self):
+        rate_limiter = RateLimiter(rate=100, max_rate=100.5, rate_step=20)
+
+        # Successful requests raise the rate, up to the maximum
+        start = rate_limiter.acquire()
+        rate_limiter.release(start)
+        self.assertEqual(rate_limiter.rate, 100.2)
+        for i in range(5):
+            rate_limiter.release(rate_limiter.acquire())
+        self.assertEqual(rate_limiter.rate, 100.5)
+        self.assertIsNone(rate_limiter.concurrency)
+
+        # Throttling halves the rate and the number of requests in progress
+        # is the new limit
+        first = rate_limiter.acquire()
+        second = rate_limiter.acquire()
+        rate_limiter.release(first, throttled=True)
+        self.assertEqual(rate_limiter.rate, 50.25)
+        self.assertEqual(rate_limiter.concurrency, 1.0)
+
+        # Requests from before the decrease don't lower it again
+        rate_limiter.release(second, throttled=True)
+        self.assertEqual(rate_limiter.rate, 50.25)
+        self.assertEqual(rate_limiter.active, 0)
+
+    def test_adapt_unlimited(self):
+        # The rate is estimated from recent requests when there isn't one
+        rate_limiter = RateLimiter(min_rate=1)
+        all_starts = [rate_limiter.acquire() for i in range(8)]
+        self.assertIsNone(rate_limiter.rate)
+        rate_limiter.release(all_starts[0], throttled=True)
+        self.assertEqual(rate_limiter.rate, 4)
+        self.assertEqual(rate_limiter.concurrency, 4)
+
+        for start in all_starts[1:]:
+            rate_limiter.release(start)
+        self.assertGreater(rate_limiter.concurrency, 4)
+
+    def test_max_concurrency(self):
+        rate_limiter = RateLimiter(max_concurrency=1)
+        start = rate_limiter.acquire()
+        waiting = []
+
+        def acquire():
+            waiting.append(rate_limiter.acquire())
+
+        thread = Thread(target=acquire)
+        thread.start()
+        sleep(0.05)
+        self.assertEqual(waiting, [])
+
+        rate_limiter.release(start)
+        thread.join(1)
+        self.assertEqual(len(waiting), 1)
+
+
+@patch('flowlogs_reader.throttling.sleep', autospec=True)
+class ThrottledClientTestCase(TestCase):
+    def test_retry(self, mock_sleep):
+        mock_client = MagicMock()
+        mock_client.get_object.side_effect = [
+            _get_error('SlowDown'), {'Body': 'body'}
+        ]
+        # The rate limit after throttling is high enough not to wait
+        rate_limiter = RateLimiter(min_rate=1000)
+        client = ThrottledClient(mock_client, rate_limiter, max_retries=1)
+        self.assertEqual(
+            client.get_object(Bucket='bucket', Key='key'), {'Body': 'body'}
+        )
+        self.assertEqual(mock_client.get_object.call_count, 2)
+        self.assertEqual(mock_sleep.call_count, 1)
+
+        # Other errors aren't retried, and don't raise the rate
+        rate = rate_limiter.rate
+        mock_client.get_object.side_effect = [_get_error('NoSuchKey')]
+        with self.assertRaises(ClientError):
+            client.get_object(Bucket='bucket', Key='key')
+        mock_client.get_object.side_effect = [ValueError]
+        with self.assertRaises(ValueError):
+            client.get_object(Bucket='bucket', Key='key')
+        self.assertEqual(rate_limiter.rate, rate)
+        self.assertEqual(rate_limiter.active, 0)
+
+        # Neither are requests that have been throttled too often
+        mock_client.get_object.side_effect = [
+            _get_error('SlowDown'), _get_error('SlowDown')
+        ]
+        with self.assertRaises(ClientError):
+            client.get_object(Bucket='bucket', Key='key')
+        self.assertEqual(client.rate_limiter.active, 0)
+
+        # Other attributes are passed through
+        self.assertIs(client.meta, mock_client.meta)
+
+    def test_reader(self, mock_sleep):
+        mock_client = MagicMock()
+        mock_client.filter_log_events.side_effect = [
+            {'events': [{'message': SAMPLE_MESSAGES[0]}], 'nextToken': 'a'},
+            _get_error('ThrottlingException'),
+            {'events': [{'message': SAMPLE_MESSAGES[1]}], 'nextToken': 'a'},
+        ]
+        stats = ReaderStats()
+        reader = FlowLogsReader(
+            'group_name',
+            boto_client=mock_client,
+            rate_limiter=RateLimiter(min_rate=1000),
+            stats=stats,
+        )
+        actual = list(reader)
+        expected = [FlowRecord.from_message(x) for x in SAMPLE_MESSAGES]
+        self.assertEqual(actual, expected)
+
+        # The paginator resumes from the page that was throttled, and stops
+        # when the token repeats
+        all_calls = mock_client.filter_log_events.call_args_list
+        self.assertEqual(len(all_calls), 3)
+        self.assertNotIn('nextToken', all_calls[0][1])
+        self.assertEqual(all_calls[1][1]['nextToken'], 'a')
+        self.assertEqual(all_calls[2][1]['nextToken'], 'a')
+        self.assertFalse(mock_client.get_paginator.called)
+
+        # Each attempt is a request
+        self.assertEqual(stats.throttles, 1)
+        self.assertEqual(stats.operations, {'filter_log_events': 3})